@@ -0,0 +1,97 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import os
+import time
+import config
+import logging
+
+_log = logging.getLogger(__name__)
+
+## Local copies of the release zips for zip_serving: local. Zips live at
+## <artifact_store_dir>/<addon_id>/<addon_id>-<vers>.zip, the last time each was
+## asked for is kept in the artifact_lru sorted set. The web app only records
+## requests, the refresh task downloads missing zips and evicts old ones.
+
+def store_dir():
+    """
+    Absolute path of artifact_store_dir, relative paths are from this directory
+    """
+    path = config.artifact_store_dir
+    if not os.path.isabs(path):
+        path = os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+    return path
+
+def artifact_name(addon_id, vers):
+    return '%s/%s-%s.zip' % (addon_id, addon_id, vers)
+
+def artifact_path(addon_id, vers):
+    return os.path.join(store_dir(), artifact_name(addon_id, vers))
+
+def touch(redisStore, addon_id, vers):
+    """
+    Record a request for a zip, whether it's stored yet or not
+    """
+    redisStore.zadd(config.redis_keys.artifact_lru, time.time(), artifact_name(addon_id, vers))
+
+def wanted(details, requested):
+    """
+    (addon_id, vers, url) of every zip that should be in the store: the newest
+    stable and prerelease of each addon plus any published version requested
+    """
+    requested = set(requested)
+    for addon_id, repo_det in details.items():
+        for vers, url in repo_det.downloads.items():
+            if url and (vers in (repo_det.latest_stable, repo_det.latest_prerelease) or
+                        artifact_name(addon_id, vers) in requested):
+                yield addon_id, vers, url
+
+def stored():
+    """
+    {artifact name: (size, mtime)} of every zip in the store
+    """
+    root = store_dir()
+    artifacts = {}
+    if not os.path.isdir(root):
+        return artifacts
+    for addon_id in os.listdir(root):
+        addon_dir = os.path.join(root, addon_id)
+        if not os.path.isdir(addon_dir):
+            continue
+        for filename in os.listdir(addon_dir):
+            if filename.endswith('.zip'):
+                stat = os.stat(os.path.join(addon_dir, filename))
+                artifacts['%s/%s' % (addon_id, filename)] = (stat.st_size, stat.st_mtime)
+    return artifacts
+
+def evict(redisStore, details):
+    """
+    Delete least recently requested zips until the store fits in artifact_store_max_bytes.
+    Zips of versions no longer published go first, the newest versions of each addon are kept.
+    """
+    artifacts = stored()
+    total = sum(size for size, mtime in artifacts.values())
+    if total <= config.artifact_store_max_bytes:
+        return
+
+    keep = set()
+    published = set()
+    for addon_id, repo_det in details.items():
+        for vers in repo_det.downloads:
+            published.add(artifact_name(addon_id, vers))
+        for vers in (repo_det.latest_stable, repo_det.latest_prerelease):
+            if vers:
+                keep.add(artifact_name(addon_id, vers))
+
+    def last_used(name):
+        score = redisStore.zscore(config.redis_keys.artifact_lru, name)
+        return (name in published, score if score is not None else artifacts[name][1])
+
+    for name in sorted((name for name in artifacts if name not in keep), key=last_used):
+        if total <= config.artifact_store_max_bytes:
+            break
+        _log.info("Evicting %s from artifact store" % name)
+        os.unlink(os.path.join(store_dir(), name))
+        redisStore.zrem(config.redis_keys.artifact_lru, name)
+        total -= artifacts[name][0]
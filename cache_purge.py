@@ -0,0 +1,89 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import re
+import json
+import time
+import config
+import logging
+import importlib
+
+_log = logging.getLogger(__name__)
+
+## Surrogate keys for a caching proxy in front of the web app. Responses carry
+## Surrogate-Key headers naming what they depend on and a Surrogate-Control that
+## lets the proxy keep them indefinitely. After each publish only the keys of what
+## changed are handed to purge_hook, so unchanged addons stay cached.
+
+ADDONS_XML = 'addons-xml'
+HOME = 'home'
+
+# Keys per request to an http purge_hook, keeping the header a sane size
+PURGE_BATCH = 200
+
+def addon_key(addon_id):
+    """
+    Everything of an addon that changes with its newest version: the unversioned zip,
+    its page and artwork
+    """
+    return 'addon/%s' % addon_id
+
+def version_key(addon_id, vers):
+    """
+    What never changes for a published version: its zip and changelog
+    """
+    return 'version/%s/%s' % (addon_id, vers)
+
+def generation_key(generation):
+    return 'gen/%s' % generation
+
+def changed_keys(previous, details):
+    """
+    Surrogate keys of everything that differs between two catalogues of name: RepoDetail
+    """
+    previous = previous or {}
+    keys = []
+    for name in sorted(set(previous) | set(details)):
+        old, new = previous.get(name), details.get(name)
+        if old is not None and new is not None and old.to_record() == new.to_record():
+            continue
+        keys.append(addon_key(name))
+        old_downloads = old.downloads if old is not None else {}
+        new_downloads = new.downloads if new is not None else {}
+        for vers in sorted(set(old_downloads) | set(new_downloads)):
+            if old_downloads.get(vers) != new_downloads.get(vers):
+                keys.append(version_key(name, vers))
+    if keys or list(previous) != list(details):
+        keys.extend([ADDONS_XML, HOME])
+    return keys
+
+def purge(keys, generation=None):
+    """
+    Hand keys to purge_hook, which is one of
+      http(s)://...  sent a PURGE request with the keys in its Surrogate-Key header
+      module:func    called as func(keys)
+      anything else  a file a json line {"generation", "keys", "time"} is appended to
+    or a callable set on config directly. Failures are only logged.
+    """
+    hook = config.purge_hook
+    if not hook or not keys:
+        return
+    _log.info("Purging %d surrogate keys" % len(keys))
+    try:
+        if callable(hook):
+            hook(keys)
+        elif hook.startswith(('http://', 'https://')):
+            import requests
+            for i in range(0, len(keys), PURGE_BATCH):
+                response = requests.request('PURGE', hook, timeout=30,
+                                            headers={'Surrogate-Key': ' '.join(keys[i:i + PURGE_BATCH])})
+                response.raise_for_status()
+        elif re.match(r'^[\w.]+:\w+$', hook):
+            module_name, func_name = hook.split(':')
+            getattr(importlib.import_module(module_name), func_name)(keys)
+        else:
+            with open(hook, 'a') as purgefile:
+                purgefile.write(json.dumps({'generation': generation, 'keys': keys, 'time': time.time()}) + '\n')
+    except Exception:
+        _log.exception("Could not purge %s" % " ".join(keys))
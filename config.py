@@ -3,48 +3,212 @@
 __author__ = 'Andrew Leech'
 
 import os
-import yaml
+
 class dotdict(dict):
     __getattr__ = dict.__getitem__
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
-CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config.yaml')
+CONFIG_FILE = os.environ.get('KODI_GITHUB_REPO_CONFIG') or os.path.join(os.path.dirname(__file__), 'config.yaml')
+
+class Settings(object):
+    """
+    Defaults of every setting, overridden by the kodi_github_repo section of config.yaml.
+    A value from the file has to be the same type as its default, dicts are merged over theirs.
+    """
+    github_personal_access_token = None
+
+    # Base url of a GitHub Enterprise compatible api to use instead of github.com
+    github_api_url = None
+
+    repositories = []
+    debug_server = dotdict(
+        port = 8000,
+        )
+
+    redis_server = dotdict(
+        host='localhost',
+        port=6379,
+        db=0)
+
+    logfile = None
+
+    # Addon zips built from github zipballs, kept by commit sha so no tag is built twice
+    build_cache_dir = '../run/build_cache'
+
+    # Least recently used builds are evicted past this size
+    build_cache_max_bytes = 512*1024**2
+
+    # Seconds a queued release zip build blocks another build of the same version
+    build_timeout = 30*60
+
+    # Seconds a refresh or build lease outlives a worker that died holding it,
+    # holders renew theirs every third of that
+    lease_ttl = 60
+
+    # How addon zips are served: 'redirect' to the github release asset, or 'local' from
+    # copies the refresh task keeps in artifact_store_dir (redirecting until a copy exists)
+    zip_serving = 'redirect'
+    artifact_store_dir = '../run/artifacts'
+
+    # Least recently requested zips are evicted past this size, the newest versions are always kept
+    artifact_store_max_bytes = 2*1024**3
+
+    # Internal nginx location aliased to artifact_store_dir, eg. '/artifacts/'.
+    # When set the web app answers with X-Accel-Redirect and nginx sends the zip
+    artifact_accel_redirect = None
+
+    # Addon icon.png, fanart.jpg and changelogs extracted once per version for the
+    # /repo/<addon_id>/ datadir routes, disabled unless set. Images are scaled down
+    # to fit within these sizes if Pillow is installed
+    media_store_dir = None
+    media_icon_size = [256, 256]
+    media_fanart_size = [1280, 720]
+
+    # Seconds clients may cache icon.png and fanart.jpg, versioned changelogs are cached for a year
+    media_max_age = 24*60*60
+
+    # Directory that addons.xml and addons.xml.md5 are pre-rendered into for nginx to serve
+    static_output_dir = None
+
+    # Minutes between full refreshes of every repository. With the github webhook
+    # set up this is only a safety net for missed events
+    refresh_interval = 60
+
+    # Secret shared with the github webhook, the /hooks/github endpoint is disabled without it
+    github_webhook_secret = None
 
-## Startup
-assert os.path.exists(CONFIG_FILE), "Please create config file in format similar to example: " + CONFIG_FILE
+    # Seconds a repo waits after its last webhook event before it's refreshed, so
+    # bursts of tag / release events only trigger one refresh
+    webhook_debounce = 30
 
-with open(CONFIG_FILE, 'r') as configfile:
-    config = yaml.load(configfile)
+    # Seconds between checks for repos due a webhook triggered refresh
+    webhook_poll_interval = 10
 
-assert config.get('kodi_github_repo'), "Incorrect format of config file, missing kodi_github_repo section"
-config = config.get('kodi_github_repo')
+    # Number of repositories crawled from github in parallel
+    crawl_concurrency = 4
 
-assert isinstance(config.get('repositories'), list) and len(config.get('repositories')), "Missing repositories from config"
+    # Repositories crawled per celery subtask of a full refresh, so refreshes spread over every
+    # worker node (1 for a subtask per repository). 0 crawls them all in a single task
+    refresh_shard_size = 0
 
-## Defaults
-github_personal_access_token = None
+    # Seconds after the start of a sharded refresh that it's published with the shards
+    # finished by then, the repos of the rest keep their previous details
+    refresh_shard_deadline = 10*60
 
-repositories = []
-debug_server = dotdict(
-	port = 8000,
-	)
+    # How repositories are crawled: 'rest', a few requests per repo, or 'graphql', a couple of
+    # requests per batch of graphql_batch_size repos (crawl_concurrency batches in parallel)
+    fetch_backend = 'rest'
+    graphql_batch_size = 20
 
-redis_server = dotdict(
-    host='localhost',
-    port=6379,
-    db=0)
+    # GraphQL endpoint, defaults to github.com or <github_api_url>/api/graphql for enterprise
+    github_graphql_url = None
 
-logfile = None
+    # Requests kept back from the github rate limit for webhooks and manual use
+    github_rate_limit_reserve = 50
 
-## Set up shared static config for app
-redis_url = "redis://{host}:{port}/{db}".format(**redis_server)
+    # Below this many remaining requests the crawl spreads what's left evenly until the rate limit resets
+    github_rate_limit_pace = 500
+
+    # Longest a request waits for rate limit budget before the repo is left for the next refresh
+    github_max_wait = 5*60
+
+    # Times a rate limited request is retried after backing off
+    github_retries = 3
+
+    # Seconds to connect to github, and to wait for each read of a response or download
+    github_timeout = [10, 60]
+
+    # Last known good copy of the published catalogue, written by the refresh task and
+    # served by web workers whenever redis has nothing published or can't be reached
+    snapshot_file = '../run/snapshot.kgr'
+
+    # With purge_hook set, responses carry Surrogate-Key headers for a caching proxy, which
+    # may keep them for surrogate_max_age seconds as only the keys of changed addons get
+    # purged on publish. Clients, and without a purge_hook the proxy too, get client_max_age.
+    # purge_hook is where the purged keys go: a PURGE url, a module:function to call with
+    # them, or a file to append them to
+    purge_hook = None
+    surrogate_max_age = 365*24*60*60
+    client_max_age = 60
+
+    # Seconds a web worker trusts its decoded details snapshot before asking redis
+    # whether a newer generation has been published
+    details_check_interval = 1.0
+
+    # Seconds each process buffers metrics before adding them to redis for /metrics
+    metrics_flush_interval = 1.0
+
+    def __init__(self, values):
+        for key, val in values.items():
+            setattr(self, key, self.convert(key, val))
+
+    @classmethod
+    def convert(cls, key, val):
+        default = getattr(cls, key, None)
+        if default is None:
+            return dotdict(val) if isinstance(val, dict) else val
+        if val is None:
+            return val
+        if isinstance(default, dict):
+            if not isinstance(val, dict):
+                cls.invalid(key, default, val)
+            return dotdict(default, **val)
+        if isinstance(default, (int, float)) and not isinstance(default, bool):
+            if isinstance(val, bool) or not isinstance(val, (int, float)):
+                cls.invalid(key, default, val)
+            return float(val) if isinstance(default, float) else val
+        if not isinstance(val, type(default)):
+            cls.invalid(key, default, val)
+        return val
+
+    @staticmethod
+    def invalid(key, default, val):
+        raise ValueError("%s in %s should be a %s, not %r" % (key, CONFIG_FILE, type(default).__name__, val))
+
+    @property
+    def redis_url(self):
+        return "redis://{host}:{port}/{db}".format(**self.redis_server)
+
+_settings = None
+
+def load():
+    """
+    Settings from CONFIG_FILE, parsed once then shared by the whole process
+    """
+    global _settings
+    if _settings is None:
+        import yaml
+        assert os.path.exists(CONFIG_FILE), "Please create config file in format similar to example: " + CONFIG_FILE
+        with open(CONFIG_FILE, 'r') as configfile:
+            config = yaml.load(configfile, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+        assert config and config.get('kodi_github_repo'), "Incorrect format of config file, missing kodi_github_repo section"
+        _settings = Settings(config.get('kodi_github_repo'))
+    return _settings
+
+# Add every setting directly to module
+for key in dir(load()):
+    if not key.startswith('_') and key not in ('convert', 'invalid'):
+        vars()[key] = getattr(_settings, key)
+
+## Shared static config for app
 class redis_keys(object):
     details    = "kodi_github_repo__details"
+    details_hash = "kodi_github_repo__details_hash"
+    index      = "kodi_github_repo__index"
     addons_xml = "kodi_github_repo__addons_xml"
-
-# Add config.yaml keys directly to module
-for key in config:
-    val = config[key]
-    val = dotdict(val) if isinstance(val, dict) else val
-    vars()[key] = val
\ No newline at end of file
+    generation = "kodi_github_repo__generation"
+    validators = "kodi_github_repo__validators"
+    build_pending = "kodi_github_repo__build_pending"
+    build_lock = "kodi_github_repo__build_lock"
+    refresh_lease = "kodi_github_repo__refresh_lease"
+    refresh_requested = "kodi_github_repo__refresh_requested"
+    refresh_queued = "kodi_github_repo__refresh_queued"
+    refresh_run = "kodi_github_repo__refresh_run"
+    pending_refresh = "kodi_github_repo__pending_refresh"
+    crawl_resume = "kodi_github_repo__crawl_resume"
+    artifact_lru = "kodi_github_repo__artifact_lru"
+    artifact_sync_pending = "kodi_github_repo__artifact_sync_pending"
+    metrics = "kodi_github_repo__metrics"
+    metrics_gauges = "kodi_github_repo__metrics_gauges"
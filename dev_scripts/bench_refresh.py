@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End to end benchmark of update_kodi_repos_redis against the offline fake github.
+
+Each catalogue size runs in its own process: a cold refresh into an empty redis,
+then a warm refresh with nothing changed. Reports wall time, github api calls
+(and how many were answered 304) and peak memory of each.
+
+    python dev_scripts/bench_refresh.py [--sizes 10 100 1000] [--latency 0.02] [--backend graphql]
+
+Uses fakeredis when installed, pass --redis-db to use the configured redis
+server instead (that database is flushed first).
+"""
+__author__ = "Andrew Leech"
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+def write_config(path, github, workdir, args):
+    with open(path, 'w') as configfile:
+        configfile.write('kodi_github_repo:\n')
+        configfile.write('  github_personal_access_token: fake\n')
+        configfile.write('  github_api_url: %s\n' % github.base_url)
+        configfile.write('  crawl_concurrency: %d\n' % args.concurrency)
+        configfile.write('  fetch_backend: %s\n' % args.backend)
+        configfile.write('  static_output_dir: %s\n' % os.path.join(workdir, 'static'))
+        configfile.write('  build_cache_dir: %s\n' % os.path.join(workdir, 'build_cache'))
+        configfile.write('  media_store_dir: %s\n' % os.path.join(workdir, 'media'))
+        configfile.write('  snapshot_file: %s\n' % os.path.join(workdir, 'snapshot.kgr'))
+        if args.redis_db is not None:
+            configfile.write('  redis_server:\n    host: %s\n    port: %d\n    db: %d\n' % (
+                args.redis_host, args.redis_port, args.redis_db))
+        configfile.write('  repositories:\n')
+        for url in github.repository_urls():
+            configfile.write('    - %s\n' % url)
+
+def run_size(args):
+    """
+    Child process: one catalogue size, prints a json result line
+    """
+    import fake_github
+    github = fake_github.FakeGitHub(args.size, args.tags, args.zip_size, args.missing_assets, args.latency)
+    server = fake_github.serve(github)
+
+    workdir = tempfile.mkdtemp(prefix='bench_refresh_')
+    config_path = os.path.join(workdir, 'config.yaml')
+    write_config(config_path, github, workdir, args)
+    os.environ['KODI_GITHUB_REPO_CONFIG'] = config_path
+
+    import redis
+    if args.redis_db is None:
+        import fakeredis
+        fake_server = fakeredis.FakeServer()
+        redis.StrictRedis = lambda **kwargs: fakeredis.FakeStrictRedis(server=fake_server)
+    else:
+        redis.StrictRedis(host=args.redis_host, port=args.redis_port, db=args.redis_db).flushdb()
+
+    import github_handler
+
+    results = {'size': args.size}
+    try:
+        for run in ('cold', 'warm'):
+            calls_before, not_modified_before = sum(github.calls.values()), github.not_modified
+            start = time.perf_counter()
+            github_handler.update_kodi_repos_redis()
+            results[run] = {
+                'seconds': time.perf_counter() - start,
+                'calls': sum(github.calls.values()) - calls_before,
+                'not_modified': github.not_modified - not_modified_before,
+                'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+        results['calls_by_endpoint'] = dict(github.calls)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+    print(json.dumps(results))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='addons in the catalogue')
+    parser.add_argument('--tags', type=int, default=5, help='version tags per repo')
+    parser.add_argument('--zip-size', type=int, default=16 * 1024, help='bytes of payload in each zipball')
+    parser.add_argument('--missing-assets', type=int, default=0,
+                        help='newest tags per repo without a release zip, built inline during the cold run')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every api request')
+    parser.add_argument('--concurrency', type=int, default=4, help='crawl_concurrency for the refresh')
+    parser.add_argument('--backend', default='rest', choices=['rest', 'graphql'], help='fetch_backend for the refresh')
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-db', type=int, default=None, help='use (and flush) this real redis database')
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--json', action='store_true', help='print raw json results')
+    args = parser.parse_args()
+
+    if args.size:
+        return run_size(args)
+
+    print('%6s  %-5s  %10s  %8s  %8s  %12s' % ('addons', 'run', 'seconds', 'calls', '304s', 'maxrss MB'))
+    for size in args.sizes:
+        cmd = [sys.executable, os.path.abspath(__file__), '--size', str(size)]
+        for option in ('tags', 'zip_size', 'missing_assets', 'latency', 'concurrency', 'backend', 'redis_host', 'redis_port', 'redis_db'):
+            value = getattr(args, option)
+            if value is not None:
+                cmd += ['--' + option.replace('_', '-'), str(value)]
+        output = subprocess.check_output(cmd).decode().strip().splitlines()
+        results = json.loads(output[-1])
+        if args.json:
+            print(json.dumps(results))
+            continue
+        for run in ('cold', 'warm'):
+            r = results[run]
+            print('%6d  %-5s  %10.2f  %8d  %8d  %12.1f' % (
+                size, run, r['seconds'], r['calls'], r['not_modified'], r['maxrss_kb'] / 1024.0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare jsonpickle against the repo_store msgpack records for the published repo details.
+
+    python dev_scripts/bench_serialization.py [--repeat 20]
+"""
+__author__ = "Andrew Leech"
+
+import os
+import sys
+import time
+import argparse
+import jsonpickle
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import repo_store
+from repo_store import RepoDetail
+
+ADDON_XML = b'''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<addon id="plugin.video.example%d" name="Example" version="1.%d.0" provider-name="alelec">
+  <requires>
+    <import addon="xbmc.python" version="2.14.0"/>
+    <import addon="script.module.requests" version="2.7.0"/>
+  </requires>
+  <extension point="xbmc.python.pluginsource" library="default.py">
+    <provides>video</provides>
+  </extension>
+  <extension point="xbmc.addon.metadata">
+    <summary lang="en">Example addon</summary>
+    <description lang="en">Synthetic addon used to benchmark serialisation of cached repo details.</description>
+    <platform>all</platform>
+  </extension>
+</addon>
+'''
+
+def synthetic_details(count, tags_per_repo=10):
+    details = OrderedDict()
+    for i in range(count):
+        name = 'plugin.video.example%d' % i
+        repo_det = RepoDetail()
+        repo_det.reponame = name
+        repo_det.description = 'Example addon number %d' % i
+        repo_det.homepage = 'https://example.com/%s' % name
+        repo_det.owner = 'alelec'
+        versions = ['1.%d.0' % t for t in range(tags_per_repo)]
+        repo_det.tagnames = {vers: 'v' + vers for vers in versions}
+        repo_det.downloads = {vers: 'https://github.com/alelec/%s/releases/download/v%s/%s.zip' % (name, vers, name)
+                              for vers in versions}
+        repo_det.newest_version = versions[-1]
+        repo_det.newest_tagname = 'v' + versions[-1]
+        repo_det.newest_tag_sha = '%040x' % i
+        repo_det.addon_xml_fragment = repo_store.addon_xml_fragment(ADDON_XML % (i, tags_per_repo - 1))
+        details[name] = repo_det
+    return details
+
+def timed(func, arg, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=20, help='runs per measurement, best time is reported')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    formats = [
+        ('jsonpickle', lambda d: jsonpickle.encode(d).encode(), lambda b: jsonpickle.decode(b.decode())),
+        ('msgpack', repo_store.encode_details, repo_store.decode_details),
+    ]
+
+    print('%6s  %-10s  %12s  %12s  %12s' % ('repos', 'format', 'encode ms', 'decode ms', 'bytes'))
+    for size in args.sizes:
+        details = synthetic_details(size)
+        for name, encode, decode in formats:
+            encode_time, blob = timed(encode, details, args.repeat)
+            decode_time, decoded = timed(decode, blob, args.repeat)
+            assert list(decoded) == list(details)
+            print('%6d  %-10s  %12.3f  %12.3f  %12d' % (size, name, encode_time * 1000, decode_time * 1000, len(blob)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of the kodi_repo_app routes with a kodi client like request mix.
+
+Seeds redis with synthetic catalogues of each size, then drives /repo/addons.xml.md5,
+/repo/addons.xml, /repo/<addon_id>/<addon_id>[-<vers>].zip and / and reports
+throughput and latency percentiles per route.
+
+    python dev_scripts/bench_serving.py [--sizes 10 100 1000] [--requests 5000] [--threads 4]
+
+By default the app runs in process through the Flask test client on fakeredis.
+Pass --url to load an already running server (uWSGI behind nginx, say) instead,
+that server must be reading the redis database given by --redis-db which gets
+flushed and seeded with each catalogue.
+"""
+__author__ = "Andrew Leech"
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+from collections import defaultdict, Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+# Share of requests per route, kodi mostly polls the md5 and fetches the rest on change
+ROUTE_MIX = [
+    ('addons.xml.md5', 0.55),
+    ('addons.xml', 0.15),
+    ('zip', 0.20),
+    ('zip-version', 0.05),
+    ('home', 0.05),
+]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def request_paths(details, count, seed=0):
+    """
+    Reproducible list of (route, path) following ROUTE_MIX
+    """
+    rand = random.Random(seed)
+    routes, weights = zip(*ROUTE_MIX)
+    names = list(details)
+    paths = []
+    for route in rand.choices(routes, weights, k=count):
+        if route == 'addons.xml.md5':
+            path = '/repo/addons.xml.md5'
+        elif route == 'addons.xml':
+            path = '/repo/addons.xml'
+        elif route == 'home':
+            path = '/'
+        else:
+            name = rand.choice(names)
+            if route == 'zip':
+                path = '/repo/%s/%s.zip' % (name, name)
+            else:
+                path = '/repo/%s/%s-%s.zip' % (name, name, rand.choice(list(details[name].downloads)))
+        paths.append((route, path))
+    return paths
+
+def seed_catalogue(store, details):
+    import repo_store
+    import github_handler
+    for repo_det in details.values():
+        repo_det.versions, repo_det.latest_stable, repo_det.latest_prerelease = repo_store.version_index(repo_det.downloads)
+    store.flushdb()
+    repo_store.publish(store, details, github_handler.addons_xml(details))
+
+def test_client_getter():
+    import kodi_repo_app
+    local = threading.local()
+
+    def get(path):
+        if not hasattr(local, 'client'):
+            local.client = kodi_repo_app.app.test_client()
+        return local.client.get(path).status_code
+    return get
+
+def http_getter(base_url):
+    import requests
+    local = threading.local()
+
+    def get(path):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session.get(base_url + path, allow_redirects=False).status_code
+    return get
+
+def drive(get, paths, threads):
+    """
+    Run every request across threads, returns (wall seconds, {route: [latency]}, {route: Counter(status)})
+    """
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    lock = threading.Lock()
+    chunks = [paths[i::threads] for i in range(threads)]
+
+    def worker(chunk):
+        local_latencies = defaultdict(list)
+        local_statuses = defaultdict(Counter)
+        for route, path in chunk:
+            start = time.perf_counter()
+            status = get(path)
+            local_latencies[route].append(time.perf_counter() - start)
+            local_statuses[route][status] += 1
+        with lock:
+            for route in local_latencies:
+                latencies[route].extend(local_latencies[route])
+                statuses[route].update(local_statuses[route])
+
+    workers = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - start, latencies, statuses
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='addons in the catalogue')
+    parser.add_argument('--requests', type=int, default=5000, help='requests per catalogue size')
+    parser.add_argument('--threads', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--warmup', type=int, default=200, help='requests sent before measuring')
+    parser.add_argument('--url', help='base url of a running server, eg. http://localhost:45210')
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-db', type=int, default=None, help='use (and flush) this real redis database')
+    args = parser.parse_args()
+
+    if args.url and args.redis_db is None:
+        parser.error('--url needs --redis-db so the catalogue can be seeded where the server reads it')
+
+    if not os.environ.get('KODI_GITHUB_REPO_CONFIG'):
+        # Any valid config will do, the catalogue comes from the seeded redis
+        config_path = os.path.join(tempfile.mkdtemp(prefix='bench_serving_'), 'config.yaml')
+        with open(config_path, 'w') as configfile:
+            configfile.write('kodi_github_repo:\n  repositories:\n    - https://github.com/fakeuser/plugin.video.fake\n')
+            if args.redis_db is not None:
+                configfile.write('  redis_server:\n    host: %s\n    port: %d\n    db: %d\n' % (
+                    args.redis_host, args.redis_port, args.redis_db))
+        os.environ['KODI_GITHUB_REPO_CONFIG'] = config_path
+
+    import redis
+    if args.redis_db is None:
+        import fakeredis
+        fake_server = fakeredis.FakeServer()
+        redis.StrictRedis = lambda **kwargs: fakeredis.FakeStrictRedis(server=fake_server)
+    import config
+    from bench_serialization import synthetic_details
+    store = redis.StrictRedis(**config.redis_server)
+
+    get = http_getter(args.url.rstrip('/')) if args.url else test_client_getter()
+
+    print('%6s  %-15s  %8s  %10s  %9s  %9s  %9s  %s' % (
+        'addons', 'route', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'max ms', 'statuses'))
+    for size in args.sizes:
+        details = synthetic_details(size)
+        paths = request_paths(details, args.requests, seed=size)
+        seed_catalogue(store, details)
+
+        drive(get, request_paths(details, args.warmup, seed=-size), args.threads)
+        wall, latencies, statuses = drive(get, paths, args.threads)
+
+        all_latencies = [l for route in latencies for l in latencies[route]]
+        for route, _ in ROUTE_MIX + [('all', None)]:
+            values = all_latencies if route == 'all' else latencies.get(route, [])
+            counts = sum(statuses.values(), Counter()) if route == 'all' else statuses.get(route, Counter())
+            print('%6d  %-15s  %8d  %10.1f  %9.3f  %9.3f  %9.3f  %s' % (
+                size, route, len(values), len(values) / wall,
+                percentile(values, 50) * 1000, percentile(values, 99) * 1000, max(values or [0]) * 1000,
+                ' '.join('%s:%d' % item for item in sorted(counts.items()))))
+
+if __name__ == '__main__':
+    main()
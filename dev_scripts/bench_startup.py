@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time a cold import of each entry module in a fresh interpreter, as a uWSGI worker
+or celery process would at startup, and report which heavy modules it pulled in.
+
+    python dev_scripts/bench_startup.py [--repeat 5]
+"""
+__author__ = "Andrew Leech"
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ('config', 'kodi_repo_app', 'kodi_repo_task', 'github_handler')
+HEAVY = ('yaml', 'github3', 'requests', 'semantic_version', 'jsonpickle', 'github_handler')
+
+CHILD = '''
+import sys, time, json, resource
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'ms': elapsed * 1000,
+    'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'loaded': [name for name in %r if name in sys.modules],
+}))
+'''
+
+CONFIG = '''kodi_github_repo:
+  github_personal_access_token: ""
+  repositories:
+    - https://github.com/alelec/plugin.video.example
+  redis_server:
+    host: localhost
+    port: 6379
+    db: 0
+  logfile: %s
+'''
+
+def run(module, env):
+    output = subprocess.check_output([sys.executable, '-c', CHILD % (module, HEAVY)], cwd=ROOT, env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    config_path = os.path.join(workdir, 'config.yaml')
+    with open(config_path, 'w') as outfile:
+        outfile.write(CONFIG % os.path.join(workdir, 'flask.log'))
+    env = dict(os.environ, KODI_GITHUB_REPO_CONFIG=config_path, PYTHONDONTWRITEBYTECODE='')
+
+    print('%-16s %10s %12s  %s' % ('module', 'import ms', 'maxrss MB', 'heavy modules loaded'))
+    for module in MODULES:
+        results = [run(module, env) for _ in range(args.repeat)]
+        ms = sorted(result['ms'] for result in results)[len(results) // 2]
+        rss = max(result['maxrss_kb'] for result in results) / 1024.0
+        print('%-16s %10.1f %12.1f  %s' % (module, ms, rss, ', '.join(results[-1]['loaded']) or '-'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stand-in for a surrogate key caching proxy (Fastly, Varnish xkey) in front of the web app.
+
+Caches GET responses that carry Surrogate-Control for its max-age, indexed by their
+Surrogate-Key header. A PURGE request with a Surrogate-Key header evicts every entry
+tagged with any of those keys. Responses say X-Cache: HIT or MISS, counts are at /__stats.
+Point purge_hook in config.yaml at it to check what each publish purges.
+
+    python dev_scripts/cache_proxy.py --upstream http://127.0.0.1:8000 --port 8082
+"""
+__author__ = "Andrew Leech"
+
+import re
+import json
+import time
+import argparse
+import threading
+from collections import Counter
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Hop by hop headers and the ones a surrogate consumes rather than passes on
+DROP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'surrogate-key', 'surrogate-control'}
+
+class SurrogateCache(object):
+    """
+    Cached responses by path, and the paths tagged with each surrogate key
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.tagged = {}
+        self.stats = Counter()
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry['expires'] > time.time():
+                self.stats['hits'] += 1
+                return entry
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, path, status, headers, body, keys, max_age):
+        with self.lock:
+            self.entries[path] = {'status': status, 'headers': headers, 'body': body,
+                                  'keys': keys, 'expires': time.time() + max_age}
+            for key in keys:
+                self.tagged.setdefault(key, set()).add(path)
+
+    def purge(self, keys):
+        with self.lock:
+            purged = set()
+            for key in keys:
+                purged.update(self.tagged.pop(key, ()))
+            for path in purged:
+                self.entries.pop(path, None)
+            self.stats['purge_requests'] += 1
+            self.stats['purged'] += len(purged)
+            return sorted(purged)
+
+class CacheProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'CacheProxy/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def cache(self):
+        return self.server.cache
+
+    def send(self, status, headers, body, cache_status=None):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        if cache_status:
+            self.send_header('X-Cache', cache_status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_PURGE(self):
+        keys = (self.headers.get('Surrogate-Key') or '').split()
+        purged = self.cache.purge(keys)
+        self.send(200, [('Content-Type', 'application/json')], json.dumps({'purged': purged}).encode())
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.path == '/__stats':
+            with self.cache.lock:
+                stats = dict(self.cache.stats, entries=len(self.cache.entries))
+            return self.send(200, [('Content-Type', 'application/json')], json.dumps(stats).encode())
+
+        entry = self.cache.get(self.path)
+        if entry is not None:
+            return self.send(entry['status'], entry['headers'], entry['body'], 'HIT')
+
+        upstream = urlparse(self.server.upstream)
+        connection = HTTPConnection(upstream.hostname, upstream.port or 80, timeout=60)
+        headers = {key: value for key, value in self.headers.items()
+                   if key.lower() not in ('connection', 'if-none-match', 'if-modified-since')}
+        connection.request('GET', self.path, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+
+        passed = [(key, value) for key, value in response.getheaders() if key.lower() not in DROP_HEADERS]
+        match = re.search(r'max-age=(\d+)', response.getheader('Surrogate-Control') or '')
+        cache_control = response.getheader('Cache-Control') or ''
+        if match and response.status in (200, 301, 302) and 'no-store' not in cache_control:
+            keys = (response.getheader('Surrogate-Key') or '').split()
+            self.cache.put(self.path, response.status, passed, body, keys, int(match.group(1)))
+        self.send(response.status, passed, body, 'MISS')
+
+def serve(upstream, port=0, host='127.0.0.1'):
+    """
+    Start the proxy in a background thread, returns the server with its cache
+    """
+    server = ThreadingHTTPServer((host, port), CacheProxyHandler)
+    server.daemon_threads = True
+    server.upstream = upstream
+    server.cache = SurrogateCache()
+    server.base_url = 'http://%s:%d' % (host, server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--upstream', default='http://127.0.0.1:8000', help='web app or nginx to cache')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    args = parser.parse_args()
+
+    server = serve(args.upstream, args.port, args.host)
+    print('Caching %s at %s, purge_hook: %s/' % (args.upstream, server.base_url, server.base_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
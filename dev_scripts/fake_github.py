@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline stand-in for the parts of the GitHub API the refresh uses.
+
+Serves synthetic repositories under /api/v3 the way a GitHub Enterprise host
+would, so pointing github_api_url at it makes github3 and download() talk to it
+instead of api.github.com. Covers repos, tags, releases, assets, contents,
+zipball (with the 302 to codeload) and asset upload, with ETag / 304 handling,
+rate-limit headers, pagination and optional injected latency. The GraphQL
+queries of github_graphql are answered from their operationName and variables.
+
+    python dev_scripts/fake_github.py --repos 100 --tags 10 --port 8081
+"""
+__author__ = "Andrew Leech"
+
+import io
+import re
+import json
+import time
+import base64
+import random
+import hashlib
+import struct
+import zlib
+import zipfile
+import argparse
+import threading
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+OWNER = 'fakeuser'
+
+ADDON_XML = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<addon id="{name}" name="{name}" version="{version}" provider-name="{owner}">
+  <requires>
+    <import addon="xbmc.python" version="2.14.0"/>
+  </requires>
+  <extension point="xbmc.python.pluginsource" library="default.py">
+    <provides>video</provides>
+  </extension>
+  <extension point="xbmc.addon.metadata">
+    <summary lang="en">Synthetic addon {name}</summary>
+    <platform>all</platform>
+  </extension>
+</addon>
+'''
+
+def png(width, height, seed=0):
+    """
+    A solid colour RGB png
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    colour = bytes([seed % 256, (seed * 7) % 256, (seed * 13) % 256])
+    rows = b''.join(b'\x00' + colour * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+class FakeRepo(object):
+    """
+    A synthetic repository with version tags, releases and uploaded assets
+    """
+    def __init__(self, owner, name, tag_count, missing_assets=0):
+        self.owner = owner
+        self.name = name
+        self.tags = OrderedDict()
+        for t in range(tag_count):
+            version = '1.%d.0' % t
+            self.tags['v' + version] = hashlib.sha1(('%s/%s/%s' % (owner, name, version)).encode()).hexdigest()
+        self.releases = OrderedDict()
+        self.assets = {}
+        # All but the newest missing_assets tags already have a release with the addon zip uploaded
+        for tagname in list(self.tags)[:max(tag_count - missing_assets, 0)]:
+            release_id = self.add_release(tagname)
+            self.assets[(release_id, name + '.zip')] = None  # zip generated on demand
+
+    def add_release(self, tagname):
+        release_id = len(self.releases) + 1
+        self.releases[release_id] = tagname
+        return release_id
+
+    def addon_xml(self, tagname):
+        return ADDON_XML.format(name=self.name, owner=self.owner, version=tagname.lstrip('v'))
+
+    def files(self, tagname):
+        """
+        path: bytes of the files at tagname the refresh reads through the contents api
+        """
+        return {
+            'addon.xml': self.addon_xml(tagname).encode(),
+            'changelog.txt': ('%s\n- Synthetic change\n' % tagname).encode(),
+            'icon.png': png(300, 300, len(self.name) + list(self.tags).index(tagname)),
+        }
+
+class FakeGitHub(object):
+    """
+    State and request counters of the fake server
+    """
+    def __init__(self, repo_count=10, tag_count=10, zip_size=64 * 1024, missing_assets=0, latency=0.0, rate_limit=5000):
+        self.repos = OrderedDict()
+        for i in range(repo_count):
+            name = 'plugin.video.fake%04d' % i
+            self.repos[name] = FakeRepo(OWNER, name, tag_count, missing_assets)
+        self.zip_size = zip_size
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.remaining = rate_limit
+        self.calls = Counter()
+        self.not_modified = 0
+        self.lock = threading.Lock()
+        self._zips = {}
+        self.base_url = None
+
+    def repository_urls(self):
+        return ['https://github.com/%s/%s' % (repo.owner, repo.name) for repo in self.repos.values()]
+
+    def count(self, kind, method):
+        with self.lock:
+            self.calls['%s %s' % (method, kind)] += 1
+
+    def use_rate_limit(self):
+        with self.lock:
+            self.remaining = max(self.remaining - 1, 0)
+            return self.remaining
+
+    def zipball(self, repo, tagname):
+        key = (repo.name, tagname)
+        with self.lock:
+            if key not in self._zips:
+                sha = repo.tags[tagname]
+                top = '%s-%s-%s/' % (repo.owner, repo.name, sha[:7])
+                buf = io.BytesIO()
+                rand = random.Random(sha)
+                with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+                    zf.writestr(top, b'')
+                    for path, data in sorted(repo.files(tagname).items()):
+                        zf.writestr(top + path, data)
+                    zf.writestr(top + 'default.py', b'print("hello")\n')
+                    zf.writestr(top + '.gitignore', b'*.pyc\n')
+                    zf.writestr(top + 'resources/data.bin', bytes(rand.getrandbits(8) for _ in range(self.zip_size)))
+                self._zips[key] = buf.getvalue()
+            return self._zips[key]
+
+    ## json documents
+
+    def repo_json(self, repo):
+        api = '%s/api/v3/repos/%s/%s' % (self.base_url, repo.owner, repo.name)
+        return {
+            'id': abs(hash(repo.name)) % 10**8,
+            'name': repo.name,
+            'full_name': '%s/%s' % (repo.owner, repo.name),
+            'owner': {'login': repo.owner, 'url': '%s/api/v3/users/%s' % (self.base_url, repo.owner)},
+            'description': 'Synthetic addon %s' % repo.name,
+            'homepage': 'https://example.com/%s' % repo.name,
+            'url': api,
+            'html_url': 'https://github.com/%s/%s' % (repo.owner, repo.name),
+            'pushed_at': '2015-08-01T00:00:00Z',
+            'created_at': '2015-01-01T00:00:00Z',
+            'updated_at': '2015-08-01T00:00:00Z',
+        }
+
+    def tag_json(self, repo, tagname):
+        api = '%s/api/v3/repos/%s/%s' % (self.base_url, repo.owner, repo.name)
+        return {
+            'name': tagname,
+            'zipball_url': '%s/zipball/%s' % (api, tagname),
+            'tarball_url': '%s/tarball/%s' % (api, tagname),
+            'commit': {'sha': repo.tags[tagname], 'url': '%s/commits/%s' % (api, repo.tags[tagname])},
+        }
+
+    def asset_json(self, repo, release_id, name):
+        api = '%s/api/v3/repos/%s/%s' % (self.base_url, repo.owner, repo.name)
+        tagname = repo.releases[release_id]
+        data = repo.assets.get((release_id, name))
+        return {
+            'id': release_id * 1000 + 1,
+            'name': name,
+            'url': '%s/releases/assets/%d' % (api, release_id * 1000 + 1),
+            'browser_download_url': '%s/download/%s/%s/%s/%s' % (self.base_url, repo.owner, repo.name, tagname, name),
+            'content_type': 'application/zip',
+            'state': 'uploaded',
+            'size': len(data) if data is not None else len(self.zipball(repo, tagname)),
+            'download_count': 0,
+            'created_at': '2015-08-01T00:00:00Z',
+            'updated_at': '2015-08-01T00:00:00Z',
+        }
+
+    def tag_ref_node(self, repo, tagname):
+        return {'name': tagname, 'target': {'oid': repo.tags[tagname]}}
+
+    def release_node(self, repo, release_id):
+        tagname = repo.releases[release_id]
+        return {
+            'tagName': tagname,
+            'releaseAssets': {'nodes': [
+                {'name': name, 'downloadUrl': self.asset_json(repo, rid, name)['browser_download_url']}
+                for (rid, name) in repo.assets if rid == release_id]},
+        }
+
+    def connection(self, nodes, after=None, first=100):
+        start = int(after) if after else 0
+        return {
+            'pageInfo': {'hasNextPage': start + first < len(nodes), 'endCursor': str(start + first)},
+            'nodes': nodes[start:start + first],
+        }
+
+    def tag_refs(self, repo, after=None):
+        return self.connection([self.tag_ref_node(repo, tagname) for tagname in reversed(list(repo.tags))], after)
+
+    def release_nodes(self, repo, after=None):
+        return self.connection([self.release_node(repo, rid) for rid in reversed(list(repo.releases))], after)
+
+    def repo_node(self, repo):
+        repo_json = self.repo_json(repo)
+        return {
+            'name': repo.name,
+            'nameWithOwner': repo_json['full_name'],
+            'description': repo_json['description'],
+            'homepageUrl': repo_json['homepage'],
+            'pushedAt': repo_json['pushed_at'],
+            'owner': {'login': repo.owner},
+            'refs': self.tag_refs(repo),
+            'releases': self.release_nodes(repo),
+        }
+
+    def release_json(self, repo, release_id):
+        api = '%s/api/v3/repos/%s/%s' % (self.base_url, repo.owner, repo.name)
+        return {
+            'id': release_id,
+            'tag_name': repo.releases[release_id],
+            'name': repo.releases[release_id],
+            'url': '%s/releases/%d' % (api, release_id),
+            'assets_url': '%s/releases/%d/assets' % (api, release_id),
+            'upload_url': '%s/api/uploads/repos/%s/%s/releases/%d/assets{?name,label}' % (
+                self.base_url, repo.owner, repo.name, release_id),
+            'html_url': 'https://github.com/%s/%s/releases/%s' % (repo.owner, repo.name, repo.releases[release_id]),
+            'draft': False,
+            'prerelease': False,
+            'created_at': '2015-08-01T00:00:00Z',
+            'published_at': '2015-08-01T00:00:00Z',
+            'assets': [self.asset_json(repo, release_id, name) for (rid, name) in repo.assets if rid == release_id],
+        }
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeGitHub/1.0'
+
+    routes = [
+        ('GET', 'repo', re.compile(r'^/api/v3/repos/([^/]+)/([^/]+)$')),
+        ('GET', 'tags', re.compile(r'^/api/v3/repos/([^/]+)/([^/]+)/tags$')),
+        ('GET', 'releases', re.compile(r'^/api/v3/repos/([^/]+)/([^/]+)/releases$')),
+        ('GET', 'release_by_tag', re.compile(r'^/api/v3/repos/([^/]+)/([^/]+)/releases/tags/(.+)$')),
+        ('POST', 'releases', re.compile(r'^/api/v3/repos/([^/]+)/([^/]+)/releases$')),
+        ('GET', 'assets', re.compile(r'^/api/v3/repos/([^/]+)/([^/]+)/releases/(\d+)/assets$')),
+        ('POST', 'upload', re.compile(r'^/api/uploads/repos/([^/]+)/([^/]+)/releases/(\d+)/assets$')),
+        ('GET', 'contents', re.compile(r'^/api/v3/repos/([^/]+)/([^/]+)/contents/(.+)$')),
+        ('GET', 'zipball', re.compile(r'^/api/v3/repos/([^/]+)/([^/]+)/zipball/(.+)$')),
+        ('GET', 'codeload', re.compile(r'^/codeload/([^/]+)/([^/]+)/zip/(.+)$')),
+        ('GET', 'download', re.compile(r'^/download/([^/]+)/([^/]+)/([^/]+)/(.+)$')),
+    ]
+
+    @property
+    def github(self):
+        return self.server.github
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        if self.github.latency:
+            time.sleep(self.github.latency)
+        url = urlparse(self.path)
+        self.query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if method == 'POST' and url.path == '/api/graphql':
+            return self.post_graphql()
+        for route_method, kind, pattern in self.routes:
+            match = pattern.match(url.path)
+            if match and route_method == method:
+                self.github.count(kind, method)
+                owner, name = match.group(1), match.group(2)
+                repo = self.github.repos.get(name)
+                if repo is None or repo.owner != owner:
+                    return self.send_json({'message': 'Not Found'}, 404)
+                return getattr(self, '%s_%s' % (method.lower(), kind))(repo, *match.groups()[2:])
+        self.github.count('unknown', method)
+        self.send_json({'message': 'Not Found'}, 404)
+
+    ## responses
+
+    def send_body(self, body, status=200, content_type='application/json', headers=None, conditional=True):
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if conditional and status == 200 and self.headers.get('If-None-Match') == etag:
+            with self.github.lock:
+                self.github.not_modified += 1
+            status, body = 304, b''
+            remaining = self.github.remaining
+        else:
+            remaining = self.github.use_rate_limit()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('X-RateLimit-Limit', str(self.github.rate_limit))
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def send_json(self, payload, status=200, headers=None):
+        self.send_body(json.dumps(payload).encode(), status, headers=headers)
+
+    def send_paged(self, items):
+        per_page = int(self.query.get('per_page', 30))
+        page = int(self.query.get('page', 1))
+        headers = {}
+        if page * per_page < len(items):
+            query = dict(self.query, page=page + 1, per_page=per_page)
+            headers['Link'] = '<%s%s?%s>; rel="next"' % (
+                self.github.base_url, urlparse(self.path).path, urlencode(sorted(query.items())))
+        self.send_json(items[(page - 1) * per_page:page * per_page], headers=headers)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    ## endpoints
+
+    def get_repo(self, repo):
+        self.send_json(self.github.repo_json(repo))
+
+    def get_tags(self, repo):
+        # github lists newest tags first
+        self.send_paged([self.github.tag_json(repo, tagname) for tagname in reversed(list(repo.tags))])
+
+    def get_releases(self, repo):
+        self.send_paged([self.github.release_json(repo, rid) for rid in reversed(list(repo.releases))])
+
+    def get_release_by_tag(self, repo, tagname):
+        for rid, release_tagname in repo.releases.items():
+            if release_tagname == tagname:
+                return self.send_json(self.github.release_json(repo, rid))
+        self.send_json({'message': 'Not Found'}, 404)
+
+    def post_releases(self, repo):
+        data = json.loads(self.read_body().decode() or '{}')
+        tagname = data.get('tag_name')
+        if tagname not in repo.tags:
+            return self.send_json({'message': 'Validation Failed'}, 422)
+        with self.github.lock:
+            release_id = repo.add_release(tagname)
+        self.send_json(self.github.release_json(repo, release_id), 201)
+
+    def get_assets(self, repo, release_id):
+        release_id = int(release_id)
+        if release_id not in repo.releases:
+            return self.send_json({'message': 'Not Found'}, 404)
+        self.send_paged([self.github.asset_json(repo, rid, name) for (rid, name) in repo.assets if rid == release_id])
+
+    def post_upload(self, repo, release_id):
+        release_id = int(release_id)
+        data = self.read_body()
+        name = self.query.get('name')
+        if release_id not in repo.releases or not name:
+            return self.send_json({'message': 'Not Found'}, 404)
+        with self.github.lock:
+            repo.assets[(release_id, name)] = data
+        self.send_json(self.github.asset_json(repo, release_id, name), 201)
+
+    def get_contents(self, repo, path):
+        tagname = self.query.get('ref') or list(repo.tags)[-1]
+        if tagname not in repo.tags or path not in repo.files(tagname):
+            return self.send_json({'message': 'Not Found'}, 404)
+        content = repo.files(tagname)[path]
+        if self.headers.get('Accept') == 'application/vnd.github.v3.raw':
+            return self.send_body(content, content_type='application/octet-stream')
+        self.send_json({
+            'type': 'file',
+            'name': path.rsplit('/', 1)[-1],
+            'path': path,
+            'encoding': 'base64',
+            'size': len(content),
+            'sha': hashlib.sha1(content).hexdigest(),
+            'content': base64.b64encode(content).decode(),
+        })
+
+    def post_graphql(self):
+        request = json.loads(self.read_body().decode() or '{}')
+        operation = request.get('operationName')
+        variables = request.get('variables') or {}
+        self.github.count('graphql ' + str(operation), 'POST')
+
+        def find(owner, name):
+            repo = self.github.repos.get(name)
+            return repo if repo is not None and repo.owner == owner else None
+
+        data, errors = {}, []
+        if operation in ('RepoCatalogue', 'AddonXml'):
+            i = 0
+            while 'o%d' % i in variables:
+                repo = find(variables['o%d' % i], variables['n%d' % i])
+                if repo is None:
+                    data['r%d' % i] = None
+                    errors.append({'type': 'NOT_FOUND', 'path': ['r%d' % i],
+                                   'message': 'Could not resolve to a Repository'})
+                elif operation == 'RepoCatalogue':
+                    data['r%d' % i] = self.github.repo_node(repo)
+                else:
+                    tagname, _, path = variables['x%d' % i].partition(':')
+                    blob = None
+                    if path == 'addon.xml' and tagname in repo.tags:
+                        blob = {'text': repo.addon_xml(tagname)}
+                    data['r%d' % i] = {'object': blob}
+                i += 1
+        elif operation in ('MoreTags', 'MoreReleases'):
+            repo = find(variables.get('owner'), variables.get('name'))
+            if repo is not None:
+                if operation == 'MoreTags':
+                    data['repository'] = {'refs': self.github.tag_refs(repo, variables.get('after'))}
+                else:
+                    data['repository'] = {'releases': self.github.release_nodes(repo, variables.get('after'))}
+            else:
+                data['repository'] = None
+        else:
+            return self.send_json({'errors': [{'message': 'Unknown operation %s' % operation}]}, 200)
+
+        payload = {'data': data}
+        if errors:
+            payload['errors'] = errors
+        self.send_body(json.dumps(payload).encode(), conditional=False)
+
+    def get_zipball(self, repo, tagname):
+        if tagname not in repo.tags:
+            return self.send_json({'message': 'Not Found'}, 404)
+        location = '%s/codeload/%s/%s/zip/%s' % (self.github.base_url, repo.owner, repo.name, tagname)
+        self.send_body(b'', 302, headers={'Location': location}, conditional=False)
+
+    def get_codeload(self, repo, tagname):
+        if tagname not in repo.tags:
+            return self.send_json({'message': 'Not Found'}, 404)
+        self.send_body(self.github.zipball(repo, tagname), content_type='application/zip', conditional=False)
+
+    def get_download(self, repo, tagname, name):
+        release_ids = [rid for rid, tag in repo.releases.items() if tag == tagname]
+        for release_id in release_ids:
+            if (release_id, name) in repo.assets:
+                data = repo.assets[(release_id, name)]
+                if data is None:
+                    data = self.github.zipball(repo, tagname)
+                return self.send_body(data, content_type='application/zip', conditional=False)
+        self.send_json({'message': 'Not Found'}, 404)
+
+def serve(github, host='127.0.0.1', port=0):
+    """
+    Start the fake server on a background thread, returns the server. github.base_url is set to its address.
+    """
+    server = ThreadingHTTPServer((host, port), FakeGitHubHandler)
+    server.daemon_threads = True
+    server.github = github
+    github.base_url = 'http://%s:%d' % server.server_address[:2]
+    thread = threading.Thread(target=server.serve_forever, name='fake_github')
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repos', type=int, default=10)
+    parser.add_argument('--tags', type=int, default=10, help='version tags per repo')
+    parser.add_argument('--zip-size', type=int, default=64 * 1024, help='bytes of payload in each zipball')
+    parser.add_argument('--missing-assets', type=int, default=0, help='newest tags per repo without a release zip yet')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    github = FakeGitHub(args.repos, args.tags, args.zip_size, args.missing_assets, args.latency)
+    server = serve(github, args.host, args.port)
+    print('Fake github at %s, add to config.yaml:' % github.base_url)
+    print('  github_api_url: %s' % github.base_url)
+    print('  github_personal_access_token: fake')
+    print('  repositories:')
+    for url in github.repository_urls():
+        print('    - %s' % url)
+    try:
+        while True:
+            time.sleep(10)
+            print(dict(github.calls), 'not modified: %d' % github.not_modified)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import json
+import time
+import redis
+import config
+import github3
+import logging
+import metrics
+import requests
+import threading
+from github3 import GitHubError
+from requests.compat import urlencode
+
+_log = logging.getLogger(__name__)
+
+class RateLimitExhausted(Exception):
+    """
+    Raised instead of making a request when the rate limit budget won't recover
+    within github_max_wait seconds, the work is picked up again next refresh
+    """
+
+def rate_limited(response):
+    """
+    True for primary or secondary rate limit rejections
+    """
+    if response.status_code == 429:
+        return True
+    if response.status_code == 403:
+        if response.headers.get('Retry-After') or response.headers.get('X-RateLimit-Remaining') == '0':
+            return True
+        try:
+            return 'rate limit' in response.json().get('message', '').lower()
+        except ValueError:
+            pass
+    return False
+
+def rate_limit_resource(url):
+    """
+    Which of github's rate limit budgets a request to url is counted against
+    """
+    return 'graphql' if url.split('?')[0].rstrip('/').endswith('/graphql') else 'core'
+
+class Budget(object):
+    """
+    What's known of one rate limit resource
+    """
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = 0
+        self.blocked_until = 0
+        self.backoff = 0
+
+class RequestScheduler(object):
+    """
+    Budget accounting shared by every github request. Tracks the remaining rate limit of
+    each X-RateLimit-Resource from response headers, spreads requests over the rest of the
+    window once a budget runs low and backs off after rate limit rejections.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.budgets = {}
+
+    def budget(self, resource):
+        if resource not in self.budgets:
+            self.budgets[resource] = Budget()
+        return self.budgets[resource]
+
+    def observe(self, response, *args, **kwargs):
+        """
+        requests response hook, registered on the github session by login()
+        """
+        now = time.time()
+        headers = response.headers
+        resource = headers.get('X-RateLimit-Resource') or rate_limit_resource(response.url or '')
+        with self.lock:
+            budget = self.budget(resource)
+            if headers.get('X-RateLimit-Remaining') is not None:
+                budget.limit = int(headers.get('X-RateLimit-Limit', 0)) or budget.limit
+                budget.remaining = int(headers['X-RateLimit-Remaining'])
+                budget.reset = int(headers.get('X-RateLimit-Reset', 0))
+                metrics.set_gauge('kodi_repo_github_rate_limit_remaining', budget.remaining, resource=resource)
+                metrics.set_gauge('kodi_repo_github_rate_limit_limit', budget.limit or 0, resource=resource)
+                metrics.set_gauge('kodi_repo_github_rate_limit_reset_timestamp', budget.reset, resource=resource)
+            metrics.inc('kodi_repo_github_requests_total', status=response.status_code)
+
+            if rate_limited(response):
+                if headers.get('Retry-After'):
+                    delay = int(headers['Retry-After'])
+                elif budget.remaining == 0 and budget.reset > now:
+                    delay = budget.reset - now
+                else:
+                    # Secondary rate limit without a hint, back off exponentially
+                    budget.backoff = min(budget.backoff * 2 or 60, 15 * 60)
+                    delay = budget.backoff
+                budget.blocked_until = max(budget.blocked_until, now + delay)
+                _log.warning("Github rate limited (%d) %s, backing off %d seconds" % (
+                    response.status_code, response.url, delay))
+            elif response.status_code < 400:
+                budget.backoff = 0
+        return response
+
+    def delay(self, url):
+        """
+        Seconds the next request to url should wait
+        """
+        now = time.time()
+        with self.lock:
+            budget = self.budget(rate_limit_resource(url))
+            if budget.blocked_until > now:
+                return budget.blocked_until - now
+            if budget.remaining is None or budget.reset <= now:
+                return 0
+            spare = budget.remaining - config.github_rate_limit_reserve
+            if spare <= 0:
+                return budget.reset - now
+            # Count this request against the budget until its response says otherwise
+            budget.remaining -= 1
+            if budget.remaining < config.github_rate_limit_pace:
+                # Spread what's left evenly over the rest of the window
+                return (budget.reset - now) / spare
+        return 0
+
+    def wait(self, url):
+        delay = self.delay(url)
+        if delay > config.github_max_wait:
+            raise RateLimitExhausted("Github rate limit budget exhausted, %d seconds until it recovers" % delay)
+        if delay > 0:
+            time.sleep(delay)
+
+scheduler = RequestScheduler()
+
+def timeout():
+    """
+    (connect, read) timeout of every request to github
+    """
+    return tuple(config.github_timeout)
+
+class TimeoutAdapter(requests.adapters.HTTPAdapter):
+    """
+    Gives requests that don't set their own timeout the github_timeout, github3 never does
+    """
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = timeout()
+        return super(TimeoutAdapter, self).send(request, **kwargs)
+
+def login():
+    """
+    Authenticated github3 session with every response fed to the shared scheduler
+    """
+    _github = github3.login(token=config.github_personal_access_token, url=config.github_api_url)
+    _github._session.hooks['response'].append(scheduler.observe)
+    # Let every crawl thread keep its own connection to github, none of them waiting forever
+    _adapter = TimeoutAdapter(pool_maxsize=max(config.crawl_concurrency, 10))
+    _github._session.mount('https://', _adapter)
+    _github._session.mount('http://', _adapter)
+    return _github
+
+def scheduled(request, url, **kwargs):
+    """
+    request(url, **kwargs) once the scheduler allows it, retried up to github_retries times
+    after rate limit rejections. Raises RateLimitExhausted if it's still rate limited then.
+    """
+    for attempt in range(config.github_retries + 1):
+        scheduler.wait(url)
+        response = request(url, **kwargs)
+        if not rate_limited(response):
+            return response
+    raise RateLimitExhausted("Github still rate limiting %s after %d retries" % (url, config.github_retries))
+
+_redisStore = None
+
+def validator_store():
+    """
+    Redis connection holding the ETag / Last-Modified validators of previous requests
+    """
+    global _redisStore
+    if _redisStore is None:
+        _redisStore = redis.StrictRedis(**config.redis_server)
+    return _redisStore
+
+def cache_key(url, params=None):
+    if params:
+        url += ('&' if '?' in url else '?') + urlencode(sorted(params.items()))
+    return url
+
+def get_json(session, url, params=None, headers=None):
+    """
+    Conditional GET of a github api url, returns (json, next_page_url).
+    Validators and payload of the last 200 response are kept in redis, a 304 Not Modified
+    response returns that stored payload again and doesn't count against the rate limit.
+    A 404 returns None like the github3 objects do.
+    """
+    key = cache_key(url, params)
+    store = validator_store()
+    cached = store.hget(config.redis_keys.validators, key)
+    cached = json.loads(cached.decode()) if cached else None
+
+    headers = dict(headers or {})
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    response = scheduled(session.get, url, params=params, headers=headers)
+
+    if response.status_code == 304 and cached:
+        return cached['payload'], cached['next']
+
+    if response.status_code == 404:
+        store.hdel(config.redis_keys.validators, key)
+        return None, None
+
+    if response.status_code >= 400:
+        raise GitHubError(response)
+
+    payload = response.json() if response.content else None
+    next_url = response.links.get('next', {}).get('url')
+
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag or last_modified:
+        store.hset(config.redis_keys.validators, key, json.dumps({
+            'etag': etag,
+            'last_modified': last_modified,
+            'payload': payload,
+            'next': next_url,
+        }))
+    return payload, next_url
+
+def get_raw(session, url, params=None):
+    """
+    Raw bytes of a github api contents url, or None on 404. Not cached like get_json,
+    callers only fetch each file once.
+    """
+    response = scheduled(session.get, url, params=params, headers={'Accept': 'application/vnd.github.v3.raw'})
+
+    if response.status_code == 404:
+        return None
+    if response.status_code >= 400:
+        raise GitHubError(response)
+    return response.content
+
+def post_json(session, url, payload):
+    """
+    POST json to a github api url through the scheduler, returns the response json
+    """
+    response = scheduled(session.post, url, data=json.dumps(payload))
+
+    if response.status_code >= 400:
+        raise GitHubError(response)
+    return response.json()
+
+def get_paged(session, url, headers=None):
+    """
+    Conditional GET of every page of a github api list url
+    """
+    items = []
+    params = {'per_page': 100}
+    while url:
+        payload, url = get_json(session, url, params=params, headers=headers)
+        params = None  # next page links already carry the query
+        items.extend(payload or [])
+    return items
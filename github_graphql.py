@@ -0,0 +1,303 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import config
+import logging
+import metrics
+import github_api
+import repo_store
+import github_handler
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from github3.repos import Repository
+from github3.repos.tag import RepoTag
+
+_log = logging.getLogger(__name__)
+
+## GraphQL fetch backend for kodi_repos. One query gets the tags, releases and release
+## assets of a whole batch of repos, a second one the addon.xml at the newest tag of
+## those that changed. The RepoDetails produced are the same as the REST crawl's, repos
+## that need a release created or a zip built inline are handed to the REST crawl.
+
+PAGE_SIZE = 100
+
+TAGS_FRAGMENT = '''
+fragment TagRefs on RefConnection {
+  pageInfo { hasNextPage endCursor }
+  nodes { name target { oid ... on Tag { target { oid } } } }
+}'''
+
+RELEASES_FRAGMENT = '''
+fragment Releases on ReleaseConnection {
+  pageInfo { hasNextPage endCursor }
+  nodes { tagName releaseAssets(first: 100) { nodes { name downloadUrl } } }
+}'''
+
+# Same order as the REST api lists them, newest first
+TAGS_CONNECTION = 'refs(refPrefix: "refs/tags/", first: %d, after: %s, orderBy: {field: TAG_COMMIT_DATE, direction: DESC})'
+RELEASES_CONNECTION = 'releases(first: %d, after: %s, orderBy: {field: CREATED_AT, direction: DESC})'
+
+CATALOGUE_FRAGMENT = '''
+fragment CatalogueRepo on Repository {
+  name nameWithOwner description homepageUrl pushedAt owner { login }
+  %s { ...TagRefs }
+  %s { ...Releases }
+}''' % (TAGS_CONNECTION % (PAGE_SIZE, 'null'), RELEASES_CONNECTION % (PAGE_SIZE, 'null'))
+
+MORE_QUERY = '''query %s($owner: String!, $name: String!, $after: String!) {
+  repository(owner: $owner, name: $name) { %s { ...%s } }
+}'''
+
+class GraphQLError(Exception):
+    pass
+
+def graphql_url():
+    """
+    GraphQL endpoint of github.com, or of the enterprise host at github_api_url
+    """
+    if config.github_graphql_url:
+        return config.github_graphql_url
+    if config.github_api_url:
+        return config.github_api_url.rstrip('/') + '/api/graphql'
+    return 'https://api.github.com/graphql'
+
+def query(_github, operation, text, variables, errors=None):
+    """
+    Run a GraphQL query, returns its data. Errors alongside data, such as a
+    repository not found, are logged and appended to errors if given.
+    """
+    with metrics.stage('graphql_' + operation):
+        result = github_api.post_json(_github._session, graphql_url(), {
+            'operationName': operation,
+            'query': text,
+            'variables': variables,
+        })
+    result_errors = result.get('errors') or []
+    for error in result_errors:
+        _log.warning("GraphQL %s: %s" % (operation, error.get('message')))
+    if result.get('data') is None:
+        raise GraphQLError("GraphQL %s failed: %s" % (operation, "; ".join(e.get('message', '') for e in result_errors)))
+    if errors is not None:
+        errors.extend(result_errors)
+    return result['data']
+
+def batch_query(operation, repo_names, selection, fragments, extra=None):
+    """
+    Query text and variables selecting selection from each repo in repo_names, aliased r0, r1, ...
+    extra is a list with a (graphql type, value) per repo for a further variable $x0, $x1, ...
+    """
+    params, fields, variables = [], [], {}
+    for i, (user, name) in enumerate(repo_names):
+        params.append('$o%d: String!, $n%d: String!' % (i, i))
+        variables['o%d' % i] = user
+        variables['n%d' % i] = name
+        field_selection = selection
+        if extra:
+            params.append('$x%d: %s' % (i, extra[i][0]))
+            variables['x%d' % i] = extra[i][1]
+            field_selection = selection.replace('$x', '$x%d' % i)
+        fields.append('  r%d: repository(owner: $o%d, name: $n%d) { %s }' % (i, i, i, field_selection))
+    text = 'query %s(%s) {\n%s\n}%s' % (operation, ', '.join(params), '\n'.join(fields), ''.join(fragments))
+    return text, variables
+
+def all_nodes(_github, node, connection, user, name):
+    """
+    Every node of a connection of the repository node, fetching any further pages
+    """
+    if connection == 'refs':
+        operation, field, fragment, fragment_name = 'MoreTags', TAGS_CONNECTION, TAGS_FRAGMENT, 'TagRefs'
+    else:
+        operation, field, fragment, fragment_name = 'MoreReleases', RELEASES_CONNECTION, RELEASES_FRAGMENT, 'Releases'
+    page = node[connection]
+    nodes = list(page['nodes'])
+    while page['pageInfo']['hasNextPage']:
+        text = MORE_QUERY % (operation, field % (PAGE_SIZE, '$after'), fragment_name) + fragment
+        data = query(_github, operation, text, {'owner': user, 'name': name, 'after': page['pageInfo']['endCursor']})
+        page = data['repository'][connection]
+        nodes.extend(page['nodes'])
+    return nodes
+
+def repository(_github, node):
+    """
+    github3 Repository for a catalogue node, complete enough for the REST crawl to carry on with
+    """
+    user, name = node['owner']['login'], node['name']
+    return Repository({
+        'name': name,
+        'full_name': node['nameWithOwner'],
+        'description': node['description'],
+        'homepage': node['homepageUrl'],
+        'owner': {'login': user},
+        'pushed_at': node['pushedAt'],
+        'url': _github._build_url('repos', user, name),
+    }, _github)
+
+def repo_tags(repo, tag_nodes):
+    """
+    Same as github_handler.repo_tags from the tag refs of a catalogue node
+    """
+    tags = {}
+    for ref in tag_nodes:
+        target = ref['target']
+        # Annotated tags point at a tag object, the REST api gives the commit it tags
+        sha = (target.get('target') or target)['oid']
+        tag = RepoTag({
+            'name': ref['name'],
+            'commit': {'sha': sha},
+            'zipball_url': '%s/zipball/%s' % (repo._api, ref['name']),
+            'tarball_url': '%s/tarball/%s' % (repo._api, ref['name']),
+        })
+        tag_vers = github_handler.vers_from_tag(ref['name'])
+        if tag_vers:
+            tags[tag_vers] = tag
+    return tags
+
+def repo_downloads(repo, releases, build_asset=None):
+    """
+    Same as github_handler.repo_downloads from the release nodes, or None
+    if a zip would have to be built inline
+    """
+    downloads = {}
+    download_asset_name = repo.name + ".zip"
+    for vers, release in releases.items():
+        download_url = None
+        for asset in release['releaseAssets']['nodes']:
+            if asset['name'] == download_asset_name:
+                download_url = asset['downloadUrl']
+        if not download_url:
+            if not build_asset:
+                return None
+            _log.info('Queueing release download zip for %s:%s' % (repo.name, vers))
+            build_asset(repo.full_name, vers)
+        downloads[vers] = download_url
+    return downloads
+
+def repo_detail(_github, node, previous=None, build_asset=None):
+    """
+    RepoDetail of a catalogue node, without its addon.xml unless it came from previous or the REST crawl.
+    previous if no version has a download yet.
+    """
+    user, name = node['owner']['login'], node['name']
+    repo = repository(_github, node)
+    tags = repo_tags(repo, all_nodes(_github, node, 'refs', user, name))
+    version, newest_tag = github_handler.newest_repo_version(tags)
+    if github_handler.repo_unchanged(repo, previous, {vers:tag.name for vers,tag in tags.items()},
+                                     newest_tag.commit.get('sha')):
+        _log.info("No changes in %s" % repo.name)
+        previous.repo = repo
+        return previous
+
+    releases = {github_handler.vers_from_tag(rel['tagName']): rel
+                for rel in all_nodes(_github, node, 'releases', user, name)}
+    downloads = None
+    if all(vers in releases for vers in tags):
+        downloads = repo_downloads(repo, releases, build_asset)
+    if downloads is None:
+        # Releases or zips have to be created, which only the REST crawl does
+        return github_handler.repo_detail(repo, previous, build_asset)
+
+    repo_det = github_handler.new_repo_detail(repo, tags, releases, downloads)
+    if repo_det is None:
+        _log.info("No downloads of %s built yet" % repo.name)
+        if previous is not None:
+            previous.repo = repo
+        return previous
+    return repo_det
+
+def batch_details(_github, batch, previous, build_asset=None, failed=None, unfinished=None):
+    """
+    name: RepoDetail of a batch of (user, repo) names. Names that couldn't be
+    crawled are appended to failed, and to unfinished too if for lack of rate limit.
+    """
+    def fail(name, ex):
+        if isinstance(ex, github_api.RateLimitExhausted):
+            _log.warning("Skipping %s: %s" % (name, ex))
+            if unfinished is not None:
+                unfinished.append(name)
+        else:
+            _log.error("Failed to get details for %s" % name, exc_info=ex)
+        if failed is not None:
+            failed.append(name)
+
+    details = OrderedDict()
+    errors = []
+    try:
+        text, variables = batch_query('RepoCatalogue', batch, '...CatalogueRepo',
+                                      [CATALOGUE_FRAGMENT, TAGS_FRAGMENT, RELEASES_FRAGMENT])
+        data = query(_github, 'RepoCatalogue', text, variables, errors)
+    except Exception as ex:
+        for user, name in batch:
+            fail(name, ex)
+        return details
+
+    for i, (user, name) in enumerate(batch):
+        node = data.get('r%d' % i)
+        if node is None:
+            if any(error.get('type') == 'NOT_FOUND' and error.get('path') == ['r%d' % i] for error in errors):
+                _log.error("Github error: %s/%s not found" % (user, name))
+            else:
+                # Null for any other reason, keep what was published before
+                fail(name, GraphQLError("No repository data for %s/%s" % (user, name)))
+            continue
+        try:
+            repo_det = repo_detail(_github, node, previous.get(node['name']), build_asset)
+            if repo_det is not None:
+                details[node['name']] = repo_det
+        except Exception as ex:
+            fail(node['name'], ex)
+
+    # Fetch the addon.xml at the newest tag of every repo that needs one in one go
+    pending = [repo_det for repo_det in details.values() if repo_det.addon_xml_fragment is None]
+    if pending:
+        try:
+            text, variables = batch_query(
+                'AddonXml', [(repo_det.owner, repo_det.reponame) for repo_det in pending],
+                'object(expression: $x) { ... on Blob { text } }', [],
+                [('String!', '%s:addon.xml' % repo_det.newest_tagname) for repo_det in pending])
+            data = query(_github, 'AddonXml', text, variables)
+        except Exception as ex:
+            data = {}
+            for repo_det in pending:
+                fail(repo_det.reponame, ex)
+        for i, repo_det in enumerate(pending):
+            blob = (data.get('r%d' % i) or {}).get('object')
+            if blob and blob.get('text') is not None:
+                repo_det.addon_xml_fragment = repo_store.addon_xml_fragment(blob['text'])
+            else:
+                if data:
+                    _log.error("No addon.xml in %s at %s" % (repo_det.reponame, repo_det.newest_tagname))
+                    if failed is not None:
+                        failed.append(repo_det.reponame)
+                del details[repo_det.reponame]
+
+    for repo_det in details.values():
+        github_handler.extract_media(repo_det.repo, repo_det)
+    return details
+
+def kodi_repos(repo_names, previous=None, build_asset=None, resume=(), unfinished=None):
+    """
+    github_handler.kodi_repos through the GraphQL api, given (user, repo) names
+    rather than repository objects. Batches of graphql_batch_size repos are
+    crawled crawl_concurrency at a time, repos in resume first.
+    """
+    previous = previous or {}
+    _github = github_api.login()
+
+    resume = set(resume)
+    repo_names = sorted(repo_names, key=lambda user_repo: (user_repo[1] not in resume, user_repo[1]))
+    batches = [repo_names[i:i + config.graphql_batch_size]
+               for i in range(0, len(repo_names), config.graphql_batch_size)]
+
+    failed = []
+    details = {}
+    with ThreadPoolExecutor(max_workers=config.crawl_concurrency) as pool:
+        for batch in pool.map(lambda batch: batch_details(_github, batch, previous, build_asset, failed, unfinished),
+                              batches):
+            details.update(batch)
+
+    for name in failed:
+        if name in previous:
+            details[name] = previous[name]
+
+    return OrderedDict(sorted(details.items()))
@@ -4,73 +4,84 @@ __author__ = "Andrew Leech"
 
 import os
 import re
+import stat
 import redis
+import gzip
+import time
 import base64
 import config
 import zipfile
 import hashlib
 import logging
+import metrics
+import locks
 import requests
+import shutil
 import tempfile
-import subprocess
-import jsonpickle
+import posixpath
+import github_api
+import repo_store
+import media_store
+import cache_purge
+import artifact_store
 import semantic_version
+from repo_store import RepoDetail
 from collections import OrderedDict
-from distutils.dir_util import remove_tree
-from github3 import login, GitHubError, utils
+from concurrent.futures import ThreadPoolExecutor
+from github3 import GitHubError, utils
+from github3.repos import Repository
+from github3.repos.tag import RepoTag
+from github3.repos.release import Release, Asset
+from github3.repos.contents import Contents
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 _log = logging.getLogger(__name__)
 
-class RepoDetail(object):
+def repository_names(names=None):
     """
-    Basic structure to hold all desired repo details in cache
+    (user, repo) of each configured repository, or just those in names if given
     """
-    def __init__(self, repo=None):
-        # These hold binary github objects
-        self.repo = repo
-        self.tags = {}
-        self.releases = {}
-
-        # These hold simple information
-        self.reponame = repo.name if repo else ""
-        self.description = repo.description if repo else ""
-        self.homepage = repo.homepage if repo else ""
-        self.owner = repo.owner if repo else ""
-        self.tagnames = {}
-        self.downloads = {}
-        self.newest_version = None
-        self.newest_zip = None
-        self.newest_tagname = None
-        self.addon_xml = None
-
-    def __getstate__(self):
-        d = self.__dict__
-        del d['repo']
-        del d['tags']
-        del d['releases']
-        return d
-
-    def __setstate__(self, d):
-        self.__dict__.update(d)
+    assert isinstance(config.repositories, list) and len(config.repositories), "Missing repositories from config"
+    url_re = re.compile('github\.com/(.*?)/(.*?)(?:\.git$|$)')
+    repo_names = []
+    for repo_url in config.repositories:
+        repo_parts = re.findall(url_re, repo_url)
+        if repo_parts and (names is None or repo_parts[0][1] in names):
+            repo_names.append(repo_parts[0][0:2])
+    return repo_names
 
-def repositories():
+@metrics.stage('repositories')
+def repositories(names=None, unfinished=None):
     """
-    Gets list of repository objects for each configured repository name
+    Gets list of repository objects for each configured repository name,
+    or just those in names if given. Only repositories github says don't exist
+    are left out, names skipped for lack of rate limit or a github error are
+    appended to unfinished so they keep their previous details.
     """
     _log.info("Getting configured repositories details...")
-    _repos = []
-    _github = login(token=config.github_personal_access_token)
+    _github = github_api.login()
+    repo_names = repository_names(names)
 
-    url_re = re.compile('github\.com/(.*?)/(.*?)(?:\.git$|$)')
-    for repo_url in config.repositories:
-        repo_parts = re.findall(url_re, repo_url)
-        if repo_parts:
-            user, repo = repo_parts[0][0:2]
-            try:
-                github_repo = _github.repository(user,repo)
-            except GitHubError:
-                raise Exception("Github error: %s/%s"%(user, repo))
-            _repos.append(github_repo)
+    def get_repo(user_repo):
+        user, repo = user_repo
+        try:
+            url = _github._build_url('repos', user, repo)
+            json, _ = github_api.get_json(_github._session, url)
+            return Repository(json, _github) if json else None
+        except (GitHubError, requests.RequestException):
+            _log.exception("Github error: %s/%s" % (user, repo))
+        except github_api.RateLimitExhausted as ex:
+            _log.warning("Skipping %s/%s: %s" % (user, repo, ex))
+        if unfinished is not None:
+            unfinished.append(repo)
+        return None
+
+    with ThreadPoolExecutor(max_workers=config.crawl_concurrency) as pool:
+        _repos = [r for r in pool.map(get_repo, repo_names) if r is not None]
     return _repos
 
 def vers_from_tag(tagname):
@@ -80,12 +91,15 @@ def vers_from_tag(tagname):
         tag_vers = tag_vers_match[0]
     return tag_vers
 
+@metrics.stage('tags')
 def repo_tags(repo):
     """
     Parses all git tags on the repo for semantic version numbers
     """
     tags = {}
-    for tag in repo.iter_tags():
+    url = repo._build_url('tags', base_url=repo._api)
+    for tag in github_api.get_paged(repo._session, url):
+        tag = RepoTag(tag)
         name = tag.name
         tag_vers = vers_from_tag(name)
         if tag_vers:
@@ -93,78 +107,110 @@ def repo_tags(repo):
 
     return tags
 
+@metrics.stage('releases')
 def repo_releases(repo, tags):
     """
     finds matching release for each tag. Creates one if not available
     """
-    releases = {vers_from_tag(rel.tag_name) : rel for rel in repo.iter_releases()}
+    url = repo._build_url('releases', base_url=repo._api)
+    releases = [Release(rel, repo) for rel in github_api.get_paged(repo._session, url, headers=Release.CUSTOM_HEADERS)]
+    releases = {vers_from_tag(rel.tag_name) : rel for rel in releases}
     # for release in repo.iter_releases():
     #     name = release.tag_name
     for vers, tag in tags.items():
         if vers not in releases:
-            # create release
-            _log.warning('Generating new release for %s:%s' % (repo.name, tag.name))
-            release = repo.create_release(tag.name)
-            releases[vers] = release
+            with locks.build_lock(repo.full_name, vers) as lease:
+                if lease is None:
+                    _log.info('Release for %s:%s is being created elsewhere' % (repo.name, tag.name))
+                    continue
+                # Another process may have created it since the list was fetched
+                url = repo._build_url('releases', 'tags', tag.name, base_url=repo._api)
+                json, _ = github_api.get_json(repo._session, url, headers=Release.CUSTOM_HEADERS)
+                if json:
+                    releases[vers] = Release(json, repo)
+                    continue
+                # create release
+                _log.warning('Generating new release for %s:%s' % (repo.name, tag.name))
+                release = repo.create_release(tag.name)
+                releases[vers] = release
     return releases
 
-def repo_downloads(repo, releases, tags):
+def release_assets(release):
+    """
+    Lists the uploaded assets of a release
+    """
+    url = release._build_url('assets', base_url=release._api)
+    return [Asset(asset, release) for asset in github_api.get_paged(release._session, url, headers=Release.CUSTOM_HEADERS)]
+
+def upload_release_asset(repo, release, tag):
+    """
+    Builds the addon zip for tag and uploads it to the release, returns the new asset
+    """
+    download_asset = None
+    download_asset_name = repo.name + ".zip"
+    try:
+        zip_path = build_addon_zip(repo.name, tag)
+        if zip_path:
+            extract_zip_media(repo.name, vers_from_tag(tag.name), zip_path)
+            with open(zip_path, 'rb') as assetfile, metrics.stage('zip_upload'):
+                download_asset = release.upload_asset(
+                                        content_type='application/zip, application/octet-stream',
+                                        name=download_asset_name,
+                                        asset=assetfile)
+            _log.warning('Finished new release download zip for %s:%s' % (repo.name, tag.name))
+    except:
+        _log.exception("zip_url: %s" % tag.zipball_url)
+    return download_asset
+
+def locked_upload_release_asset(repo, release, tag):
     """
-    finds matching download for each release. Creates one if not available
+    upload_release_asset under the version's build lock, unless another process got there
+    first. Returns the asset, or None if it's still being built elsewhere.
+    """
+    vers = vers_from_tag(tag.name)
+    with locks.build_lock(repo.full_name, vers) as lease:
+        if lease is None:
+            _log.info('Release download zip for %s:%s is being built elsewhere' % (repo.name, vers))
+            return None
+        download_asset = release_download_asset(repo, release)
+        if not download_asset:
+            # Create download... this will take a while
+            _log.warning('Generating new release download zip for %s:%s' % (repo.name, vers))
+            download_asset = upload_release_asset(repo, release, tag)
+        return download_asset
+
+def release_download_asset(repo, release):
+    """
+    The addon zip asset uploaded to release, or None
+    """
+    download_asset_name = repo.name + ".zip"
+    for asset in release_assets(release):
+        if asset.name == download_asset_name:
+            return asset
+    return None
+
+@metrics.stage('downloads')
+def repo_downloads(repo, releases, tags, build_asset=None):
+    """
+    finds matching download for each release. Creates one if not available,
+    or hands it to build_asset(full_name, vers) to create in the background if given
     """
     downloads = {}
     # for release in repo.iter_releases():
     #     name = release.tag_name
     for vers, release in releases.items():
         download_url = None
-        download_asset = None
-        download_asset_name = repo.name + ".zip"
-        for asset in release.iter_assets():
-            if asset.name == download_asset_name:
-                download_asset = asset
-                break
+        download_asset = release_download_asset(repo, release)
 
         if not download_asset:
-            # Create download... this will take a while
-            _log.warning('Generating new release download zip for %s:%s' % (repo.name, vers))
-            zip_url = tags[vers].zipball_url
-            temp_dir = tempfile.mkdtemp()
-            try:
-                zip_dlfile = os.path.join(temp_dir, download_asset_name)
-                _log.warning('downloading')
-                download(zip_url, zip_dlfile)
-                if os.path.exists(zip_dlfile):
-                    _log.warning('extracting')
-                    # outdir = extract(zip_dlfile)
-                    outdir = os.path.splitext(zip_dlfile)[0]
-                    subprocess.check_output(['/usr/bin/unzip', zip_dlfile, '-d', outdir])
-                    contents = os.listdir(outdir)
-                    _log.warning('renaming')
-                    if len(contents) == 1 and os.path.isdir(os.path.join(outdir,contents[0])):
-                        innerdir = contents[0]
-                        newdir = os.path.join(outdir,innerdir)
-                        if innerdir != repo.name:
-                            os.rename(newdir, os.path.join(outdir,repo.name))
-                        outdir = os.path.join(outdir,repo.name)
-                    os.rename(zip_dlfile, zip_dlfile+".dl")
-                    _log.warning('zipping')
-                    zipdir(dirPath=outdir, zipFilePath=zip_dlfile, includeDirInZip=True, excludeDotFiles=True)
-
-                    if os.path.exists(zip_dlfile):
-                        with open(zip_dlfile, 'rb') as assetfile:
-                            _log.warning('uploading')
-                            download_asset = release.upload_asset(
-                                                    content_type='application/zip, application/octet-stream',
-                                                    name=download_asset_name,
-                                                    asset=assetfile)
-                        _log.warning('Finished new release download zip for %s:%s' % (repo.name, vers))
-            except:
-                _log.exception("zip_url: %s"%zip_url)
-            finally:
-                remove_tree(temp_dir)
+            if build_asset:
+                _log.info('Queueing release download zip for %s:%s' % (repo.name, vers))
+                build_asset(repo.full_name, vers)
+            else:
+                download_asset = locked_upload_release_asset(repo, release, tags[vers])
 
         if download_asset:
-            download_url = download_asset.browser_download_url
+            download_url = download_asset.to_json().get('browser_download_url')
 
         downloads[vers] = download_url
     return downloads
@@ -182,78 +228,426 @@ def newest_repo_version(tags):
             _log.exception("invalid tag version (%s) from %s" % (entry, tags[entry][1]))
     return newest_version, tags[newest_version]
 
-def kodi_repos(repos):
+def repo_unchanged(repo, previous, tagnames, newest_tag_sha):
     """
-    For all repositories in provided list, construct a RepoDetail container with details we need
+    True if the previous RepoDetail of this repo is still current
     """
-    
-    # Get list of repository objects and wrap in RepoDetail class
-    details = OrderedDict([
-          (repo.name, RepoDetail(repo)) for repo in sorted(repos, key=lambda r:r.name)
-    ])
-    
-    for repo_det in details.values():
-        # Get latest version
-        tags = repo_tags(repo_det.repo)
-        repo_det.tags = tags
-        repo_det.tagnames = {vers:tag.name for vers,tag in tags.items()}
-        
-        releases = repo_releases(repo_det.repo, tags)
-        repo_det.releases = releases
-
-        downloads = repo_downloads(repo_det.repo, releases, tags)
-        repo_det.downloads = downloads
-
-        version, newest_tag = newest_repo_version(tags)
-        repo_det.newest_version = version
-        repo_det.newest_tagname = newest_tag.name
-
-        # Grab a copy of addon.xml from the latest version
-        addon_xml_handle = repo_det.repo.contents('addon.xml',repo_det.newest_tagname)
-        if addon_xml_handle.encoding == 'base64':
-            addon_xml = base64.b64decode(addon_xml_handle.content)
-        else:
-            addon_xml = addon_xml_handle.content
-            _log.warning('Unexpected encoding (%s) on file: %s' % (addon_xml_handle.encoding, addon_xml_handle.name))
-        repo_det.addon_xml = addon_xml
+    return (previous is not None and
+            previous.tagnames == tagnames and
+            getattr(previous, 'newest_tag_sha', None) == newest_tag_sha and
+            previous.description == repo.description and
+            previous.homepage == repo.homepage and
+            None not in previous.downloads.values())
+
+def repo_detail(repo, previous=None, build_asset=None):
+    """
+    Construct the RepoDetail container for a single repository.
+    If the tags haven't moved since the previous RepoDetail it's returned as is,
+    as it is if none of the versions has a download yet (None without one).
+    """
+    # Get latest version
+    tags = repo_tags(repo)
+    tagnames = {vers:tag.name for vers,tag in tags.items()}
+    version, newest_tag = newest_repo_version(tags)
+    newest_tag_sha = newest_tag.commit.get('sha')
+
+    if repo_unchanged(repo, previous, tagnames, newest_tag_sha):
+        _log.info("No changes in %s" % repo.name)
+        previous.repo = repo
+        return previous
+
+    releases = repo_releases(repo, tags)
+    downloads = repo_downloads(repo, releases, tags, build_asset)
+    repo_det = new_repo_detail(repo, tags, releases, downloads)
+    if repo_det is None:
+        _log.info("No downloads of %s built yet" % repo.name)
+        if previous is not None:
+            previous.repo = repo
+        return previous
+
+    # Grab a copy of addon.xml from the latest version
+    url = repo._build_url('contents', 'addon.xml', base_url=repo._api)
+    with metrics.stage('addon_xml'):
+        json, _ = github_api.get_json(repo._session, url, params={'ref': repo_det.newest_tagname})
+    addon_xml_handle = Contents(json, repo)
+    if addon_xml_handle.encoding == 'base64':
+        addon_xml = base64.b64decode(addon_xml_handle.content)
+    else:
+        addon_xml = addon_xml_handle.content
+        _log.warning('Unexpected encoding (%s) on file: %s' % (addon_xml_handle.encoding, addon_xml_handle.name))
+    repo_det.addon_xml_fragment = repo_store.addon_xml_fragment(addon_xml)
+
+    return repo_det
+
+@metrics.stage('media')
+def extract_media(repo, repo_det):
+    """
+    Copy the artwork and changelog at newest_tagname into the media store, once per version.
+    Failures are only logged, the version is tried again next refresh.
+    """
+    if (not media_store.enabled() or not repo_det.addon_xml_fragment or not repo_det.newest_version or
+            media_store.extracted(repo.name, repo_det.newest_version)):
+        return
+    try:
+        files = {}
+        for kind, path in media_store.sources(repo_det.addon_xml_fragment).items():
+            url = repo._build_url('contents', *path.split('/'), base_url=repo._api)
+            data = github_api.get_raw(repo._session, url, params={'ref': repo_det.newest_tagname})
+            if data is not None and len(data) <= media_store.MAX_SOURCE_BYTES:
+                files[kind] = data
+        media_store.store(repo.name, repo_det.newest_version, files)
+    except Exception:
+        _log.exception("Could not store media of %s:%s" % (repo.name, repo_det.newest_version))
+
+def extract_zip_media(repo_name, vers, zip_path):
+    """
+    Same as extract_media from a freshly built addon zip, without any github requests
+    """
+    if not media_store.enabled() or media_store.extracted(repo_name, vers):
+        return
+    try:
+        with metrics.stage('media'):
+            media_store.store(repo_name, vers, media_store.zip_files(zip_path, repo_name))
+    except Exception:
+        _log.exception("Could not store media of %s:%s" % (repo_name, vers))
+
+def crawl_repo(repo, previous=None, build_asset=None):
+    """
+    repo_detail, plus its newest version's media in the media store
+    """
+    repo_det = repo_detail(repo, previous, build_asset)
+    if repo_det is not None:
+        extract_media(repo, repo_det)
+    return repo_det
+
+def new_repo_detail(repo, tags, releases, downloads):
+    """
+    RepoDetail of a changed repo from its crawled tags, releases and downloads,
+    everything but the addon.xml of newest_tagname. None if no version has a download yet.
+    """
+    if not any(downloads.values()):
+        return None
+
+    repo_det = RepoDetail(repo)
+    repo_det.tags = tags
+    repo_det.tagnames = {vers:tag.name for vers,tag in tags.items()}
+    repo_det.releases = releases
+    repo_det.downloads = downloads
+    version, newest_tag = newest_repo_version(tags)
+
+    repo_det.versions, repo_det.latest_stable, repo_det.latest_prerelease = repo_store.version_index(downloads)
+
+    # Only advertise versions that can actually be downloaded yet
+    if not downloads.get(version):
+        version = repo_det.latest_version
+        newest_tag = tags[version]
+
+    repo_det.newest_version = version
+    repo_det.newest_tagname = newest_tag.name
+    repo_det.newest_tag_sha = newest_tag.commit.get('sha')
+    return repo_det
+
+def crawl_order(repos, resume=()):
+    """
+    Repos left unfinished by the last refresh first, then the most recently pushed,
+    so whatever the rate limit budget covers is what's most likely to have changed
+    """
+    resume = set(resume)
+    return sorted(repos, key=lambda r: (r.name not in resume, -(r.pushed_at.timestamp() if r.pushed_at else 0), r.name))
+
+def kodi_repos(repos, previous=None, build_asset=None, resume=(), unfinished=None):
+    """
+    For all repositories in provided list, construct a RepoDetail container with details we need.
+    RepoDetails from the previous refresh are reused for any repo that hasn't changed.
+    Repos in resume are crawled first, those skipped for lack of rate limit are appended to unfinished.
+    """
+    previous = previous or {}
+
+    # Each repository is crawled independently, results are collected in name order
+    with ThreadPoolExecutor(max_workers=config.crawl_concurrency) as pool:
+        futures = {repo.name: (repo, pool.submit(crawl_repo, repo, previous.get(repo.name), build_asset))
+                   for repo in crawl_order(repos, resume)}
+
+    details = OrderedDict()
+    for name in sorted(futures):
+        repo, future = futures[name]
+        try:
+            repo_det = future.result()
+            if repo_det is not None:
+                details[name] = repo_det
+            continue
+        except github_api.RateLimitExhausted as ex:
+            _log.warning("Skipping %s: %s" % (name, ex))
+            if unfinished is not None:
+                unfinished.append(name)
+        except Exception:
+            _log.exception("Failed to get details for %s" % name)
+        if name in previous:
+            details[name] = previous[name]
 
     return details
 
+def fetch_details(names=None, previous=None, build_asset=None, resume=(), unfinished=None):
+    """
+    kodi_repos of the configured repositories (or just those in names) through the
+    configured fetch_backend, 'rest' or 'graphql'
+    """
+    if config.fetch_backend == 'graphql':
+        import github_graphql
+        return github_graphql.kodi_repos(repository_names(names), previous, build_asset, resume, unfinished)
+    return kodi_repos(repositories(names, unfinished), previous, build_asset, resume, unfinished)
+
+ADDONS_XML_HEADER = u"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>\n<addons>"
+ADDONS_XML_FOOTER = u"\n</addons>\n"
+
+@metrics.stage('addons_xml')
 def addons_xml(details):
     """
     Generate kodi repo addons.xml with md5 hash
     """
+    md5 = hashlib.md5()
+    parts = []
+
+    def write(part):
+        md5.update(part.encode())
+        parts.append(part)
+
     # repo addons header
-    _addons_xml = u"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>\n<addons>\n"
-    
-    # add addon.xml from each addon verbatim
+    write(ADDONS_XML_HEADER)
+
+    # add addon.xml from each addon verbatim, blank line between each
+    separator = u"\n"
     for repo_det in details.values():
-        xml = repo_det.addon_xml.rstrip()
-        if isinstance(xml, bytes):
-            xml = xml.decode()
-        if xml.startswith('<?xml'):
-            xml = xml[xml.index('\n'):]
-        _addons_xml += xml + u"\n\n"
-    
-    # clean and add closing tag
-    _addons_xml = _addons_xml.strip() + u"\n</addons>\n"
-    _addons_xml_md5 = hashlib.md5(_addons_xml.encode()).digest()
-    return _addons_xml, _addons_xml_md5
-        
-def update_kodi_repos_redis():
+        fragment = repo_det.addon_xml_fragment
+        if fragment:
+            write(separator)
+            write(fragment)
+            separator = u"\n\n"
+
+    # add closing tag
+    write(ADDONS_XML_FOOTER)
+    return u"".join(parts), md5.hexdigest()
+
+def local_path(path):
     """
-    Generate details of all repos and the addons.xml then store them to redis cache
+    Configured paths are relative to this directory unless absolute, None stays None
     """
-    _redisStore = redis.StrictRedis(**config.redis_server)
-    _details = kodi_repos(repositories())
-    _addons_xml = addons_xml(_details)
-    
+    if path and not os.path.isabs(path):
+        path = os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+    return path
+
+def static_output_dir():
+    """
+    Absolute path of the directory nginx serves addons.xml from, or None if not configured
+    """
+    return local_path(config.static_output_dir)
+
+def write_atomic(path, data, mtime):
+    """
+    Write data to a temp file beside path then rename it over path, so nginx only ever sees complete files
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+        os.chmod(temp_path, 0o644)
+        # All variants share one mtime so nginx's Last-Modified / ETag agree between them
+        os.utime(temp_path, (mtime, mtime))
+        os.replace(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+@metrics.stage('static_files')
+def write_static_addons_xml(_addons_xml):
+    """
+    Pre-render addons.xml and addons.xml.md5, with gzip and brotli variants, for nginx to serve directly
+    """
+    outdir = static_output_dir()
+    if not outdir:
+        return
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    xml, md5 = _addons_xml
+    xml = xml.encode()
+    mtime = time.time()
+
+    path = os.path.join(outdir, 'addons.xml')
+    write_atomic(path + '.gz', gzip.compress(xml, 9), mtime)
+    if brotli:
+        write_atomic(path + '.br', brotli.compress(xml), mtime)
+    write_atomic(path, xml, mtime)
+    # md5 goes last, kodi only fetches addons.xml once it sees a new md5
+    write_atomic(path + '.md5', md5.encode(), mtime)
+
+def static_addons_xml_current():
+    """
+    False if static output is configured but hasn't been written yet
+    """
+    outdir = static_output_dir()
+    return not outdir or os.path.exists(os.path.join(outdir, 'addons.xml.md5'))
+
+@metrics.stage('artifacts')
+def sync_artifacts(redisStore, details):
+    """
+    With zip_serving: local, download the zips the web app should serve into the
+    artifact store then evict old ones down to artifact_store_max_bytes
+    """
+    if config.zip_serving != 'local':
+        return
+    requested = [name.decode() for name in redisStore.zrange(config.redis_keys.artifact_lru, 0, -1)]
+    for addon_id, vers, url in artifact_store.wanted(details, requested):
+        path = artifact_store.artifact_path(addon_id, vers)
+        if os.path.exists(path):
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        os.close(fd)
+        try:
+            download(url, temp_path)
+            # download() leaves the file empty on a 404
+            if zipfile.is_zipfile(temp_path):
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, path)
+                _log.info("Stored %s" % artifact_store.artifact_name(addon_id, vers))
+        except Exception:
+            _log.exception("Failed to store %s from %s" % (artifact_store.artifact_name(addon_id, vers), url))
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+    artifact_store.evict(redisStore, details)
+
+def previous_details(redisStore):
+    """
+    Details published by the last refresh, or None
+    """
+    try:
+        return repo_store.load_details(redisStore)
+    except Exception:
+        _log.exception("Could not decode previous details, doing full refresh")
+        return None
+
+def publish_details(redisStore, details, previous=None, purge=None):
+    """
+    Generate the addons.xml for details then store both to redis cache.
+    Surrogate keys of whatever differs from previous are then handed to
+    purge(keys, generation) if given, or purged straight away.
+    """
+    _addons_xml = addons_xml(details)
+    _purge_keys = cache_purge.changed_keys(previous, details)
+
     # Don't store reference to repo object to reduce serialiser load
-    for repo_det in _details.values():
+    for repo_det in details.values():
         repo_det.repo = None
-    
-    _redisStore.set(config.redis_keys.details, jsonpickle.encode(_details))
-    _redisStore.set(config.redis_keys.addons_xml, jsonpickle.encode(_addons_xml))
+
+    with metrics.stage('publish'):
+        generation = repo_store.publish(redisStore, details, _addons_xml)
+
+    try:
+        repo_store.save_snapshot(generation, details, _addons_xml)
+    except Exception:
+        _log.exception("Could not write last known good snapshot")
+
+    write_static_addons_xml(_addons_xml)
+
+    if _purge_keys and config.purge_hook:
+        (purge or cache_purge.purge)(_purge_keys, generation)
+
+@metrics.refresh('refresh')
+def update_kodi_repos_redis(build_asset=None, purge=None, sync=None):
+    """
+    Generate details of all repos and the addons.xml then store them to redis cache
+    """
+    _redisStore = redis.StrictRedis(**config.redis_server)
+    _previous = previous_details(_redisStore) or {}
+    _resume = [name.decode() for name in _redisStore.smembers(config.redis_keys.crawl_resume)]
+    _unfinished = []
+    _details = fetch_details(None, _previous, build_asset, _resume, _unfinished)
+    _changed = [name for name, repo_det in _details.items() if _previous.get(name) is not repo_det]
+    complete_refresh(_redisStore, _previous, _details, _unfinished, _changed, purge, sync)
+
+def complete_refresh(_redisStore, _previous, _details, _unfinished, _changed, purge=None, sync=None):
+    """
+    Second half of a full refresh: record what to resume next time and publish the
+    details, unless none of the repos in _changed did, then sync the artifact store.
+    sync(redisStore, details) takes the place of sync_artifacts if given.
+    """
+    # Repos the rate limit or a github error kept from being crawled keep their previous details
+    for name in _unfinished:
+        if name not in _details and name in _previous:
+            _details[name] = _previous[name]
+    _details = OrderedDict(sorted(_details.items()))
+
+    pipe = _redisStore.pipeline(transaction=True)
+    pipe.delete(config.redis_keys.crawl_resume)
+    if _unfinished:
+        _log.warning("Refresh incomplete, resuming next refresh with: %s" % ", ".join(_unfinished))
+        pipe.sadd(config.redis_keys.crawl_resume, *_unfinished)
+    pipe.execute()
+
+    if (not _changed and list(_details) == list(_previous) and
+            repo_store.is_published(_redisStore) and static_addons_xml_current()):
+        _log.info("No repositories changed, keeping published details")
+    else:
+        _log.info("Changed repositories: %s" % ", ".join(_changed))
+        publish_details(_redisStore, _details, _previous, purge)
+
+    # Zips are only downloaded once the details are out, zip_url redirects to github until then
+    (sync or sync_artifacts)(_redisStore, _details)
+
+@metrics.refresh('repo_refresh')
+def update_kodi_repo_redis(repo_name, build_asset=None, purge=None, sync=None):
+    """
+    Refresh the details of a single repo and republish it alongside the others
+    """
+    _redisStore = redis.StrictRedis(**config.redis_server)
+    _previous = previous_details(_redisStore) or {}
+    if not repository_names(names=[repo_name]):
+        _log.warning("Not a configured repository: %s" % repo_name)
+        return
+
+    _fetched = fetch_details([repo_name], _previous, build_asset)
+    if _fetched.get(repo_name) is None:
+        _log.warning("Could not get details of %s" % repo_name)
+        return
+
+    _details = OrderedDict(_previous)
+    _details[repo_name] = _fetched[repo_name]
+    if _details[repo_name] is _previous.get(repo_name):
+        _log.info("No changes in %s, keeping published details" % repo_name)
+    else:
+        _details = OrderedDict(sorted(_details.items()))
+        publish_details(_redisStore, _details, _previous, purge)
+
+    (sync or sync_artifacts)(_redisStore, _details)
+
+@metrics.refresh('build')
+def build_release_asset(full_name, vers):
+    """
+    Background half of repo_downloads: build and upload the addon zip for one version.
+    Returns the repo name once the zip is there, for that repo to be republished.
+    """
+    _github = github_api.login()
+    user, name = full_name.split('/', 1)
+    json, _ = github_api.get_json(_github._session, _github._build_url('repos', user, name))
+    if not json:
+        _log.warning("Repository not found: %s" % full_name)
+        return
+    repo = Repository(json, _github)
+
+    tags = repo_tags(repo)
+    if vers not in tags:
+        _log.warning("Tag for %s:%s no longer exists" % (full_name, vers))
+        return
+    release = repo_releases(repo, {vers: tags[vers]}).get(vers)
+    if release is None:
+        return
+
+    if not locked_upload_release_asset(repo, release, tags[vers]):
+        return
+    return repo.name
 
 ## The functions below are used for creating the assets for a release
 
@@ -274,7 +668,8 @@ def download(url, path=''):
     resp = None
     status_code = 302
     while status_code == 302:
-        resp = requests.get(url, allow_redirects=False, stream=True, headers=headers)
+        resp = requests.get(url, allow_redirects=False, stream=True, headers=headers,
+                            timeout=github_api.timeout())
         status_code = resp.status_code
         if status_code == 302:
             url = resp.headers['location']
@@ -297,76 +692,126 @@ def resp_check(response, true_code, false_code):
             response.raise_for_status()
     return False
 
-## This is failing for unicode errors with some zip's
-## https://bugs.python.org/issue20329
-# def extract(filename):
-#     folder, extension = os.path.splitext(filename)
-#     if extension.endswith('zip'):
-#         import zipfile
-#         if os.path.exists(folder):
-#             remove_tree(folder)
-#         if not os.path.exists(folder):
-#             os.makedirs(folder)
-#         zip = zipfile.ZipFile(filename, 'r')
-#         zip.extractall(folder)
-#     return folder
-
-def zipdir(dirPath=None, zipFilePath=None, includeDirInZip=True, excludeDotFiles=True):
-    """Create a zip archive from a directory.
-    
-    Note that this function is designed to put files in the zip archive with
-    either no parent directory or just one parent directory, so it will trim any
-    leading directories in the filesystem paths and not include them inside the
-    zip archive paths. This is generally the case when you want to just take a
-    directory and make it into a zip file that can be extracted in different
-    locations. 
-    
-    Keyword arguments:
-    
-    dirPath -- string path to the directory to archive. This is the only
-    required argument. It can be absolute or relative, but only one or zero
-    leading directories will be included in the zip archive.
-    zipFilePath -- string path to the output zip file. This can be an absolute
-    or relative path. If the zip file already exists, it will be updated. If
-    not, it will be created. If you want to replace it from scratch, delete it
-    prior to calling this function. (default is computed as dirPath + ".zip")
-    includeDirInZip -- boolean indicating whether the top level directory should
-    be included in the archive or omitted. (default True)
-"""
-    if not zipFilePath:
-        zipFilePath = dirPath + ".zip"
-    if not os.path.isdir(dirPath):
-        raise OSError("dirPath argument must point to a directory. "
-            "'%s' does not." % dirPath)
-    parentDir, dirToZip = os.path.split(dirPath)
-    #Little nested function to prepare the proper archive path
-    def trimPath(path):
-        archivePath = path.replace(parentDir, "", 1)
-        if parentDir:
-            archivePath = archivePath.replace(os.path.sep, "", 1)
-        if not includeDirInZip:
-            archivePath = archivePath.replace(dirToZip + os.path.sep, "", 1)
-        return os.path.normcase(archivePath)
-        
-    outFile = zipfile.ZipFile(zipFilePath, "w",
-        compression=zipfile.ZIP_DEFLATED)
-    for (archiveDirPath, dirNames, fileNames) in os.walk(dirPath):
-        if excludeDotFiles:
-            fileNames = [f for f in fileNames if not f[0] == '.']
-            dirNames[:] = [d for d in dirNames if not d[0] == '.']
-        for fileName in fileNames:
-            filePath = os.path.join(archiveDirPath, fileName)
-            outFile.write(filePath, trimPath(filePath))
-        #Make sure we get empty directories as well
-        if not fileNames and not dirNames:
-            zipInfo = zipfile.ZipInfo(trimPath(archiveDirPath) + "/")
-            #some web sites suggest doing
-            #zipInfo.external_attr = 16
-            #or
-            #zipInfo.external_attr = 48
-            #Here to allow for inserting an empty directory.  Still TBD/TODO.
-            outFile.writestr(zipInfo, "")
-    outFile.close()
+def zip_symlink(info):
+    return stat.S_ISLNK(info.external_attr >> 16)
+
+def symlink_target(zin, info, entries):
+    """
+    Entry of zin a symlink entry points at, None if that's a directory, another
+    symlink or isn't in the zip at all
+    """
+    target = zin.read(info).decode('utf-8', 'replace')
+    path = posixpath.normpath(posixpath.join(posixpath.dirname(info.filename), target))
+    target_info = entries.get(path)
+    if target_info is None or target_info.is_dir() or zip_symlink(target_info):
+        return None
+    return target_info
+
+def repackage_zip(src, dest, top_dir, excludeDotFiles=True):
+    """
+    Copy a github zipball into a kodi addon zip one entry at a time, without extracting it.
+    Github's single top level directory (user-repo-sha) is renamed to top_dir,
+    any other layout gets top_dir added as the top level directory.
+    Symlinks are replaced by a copy of the file they point at, or dropped.
+    """
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dest, 'w', compression=zipfile.ZIP_DEFLATED) as zout:
+        infos = zin.infolist()
+        entries = {info.filename: info for info in infos}
+        top_dirs = {info.filename.split('/', 1)[0] for info in infos}
+        strip = ''
+        if len(top_dirs) == 1 and all('/' in info.filename for info in infos):
+            strip = top_dirs.pop() + '/'
+
+        for info in infos:
+            name = info.filename[len(strip):]
+            if not name:
+                continue
+            if excludeDotFiles and any(part.startswith('.') for part in name.split('/')):
+                continue
+
+            if zip_symlink(info):
+                # Kodi doesn't cope with symlinks in addon zips
+                target_info = symlink_target(zin, info, entries)
+                if target_info is None:
+                    _log.warning("Dropping symlink %s from %s" % (name, top_dir))
+                    continue
+                info = target_info
+
+            out_info = zipfile.ZipInfo(top_dir + '/' + name, info.date_time)
+            out_info.external_attr = info.external_attr
+            if info.is_dir():
+                zout.writestr(out_info, b'')
+                continue
+            out_info.compress_type = zipfile.ZIP_DEFLATED
+            with zin.open(info) as infile, zout.open(out_info, 'w') as outfile:
+                shutil.copyfileobj(infile, outfile, 64 * 1024)
+
+def build_addon_zip(repo_name, tag):
+    """
+    Path to the kodi addon zip of a tag. Built from the github zipball the first time,
+    then kept in the build cache keyed by the tag's commit sha.
+    """
+    cache_dir = local_path(config.build_cache_dir)
+    sha = tag.commit.get('sha')
+    zip_path = os.path.join(cache_dir, sha, repo_name + '.zip')
+    if os.path.exists(zip_path):
+        _log.warning('using cached build %s' % zip_path)
+        # Mark it recently used for evict_build_cache
+        os.utime(zip_path, None)
+        return zip_path
+
+    if not os.path.isdir(os.path.dirname(zip_path)):
+        os.makedirs(os.path.dirname(zip_path))
+    temp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.build-')
+    try:
+        zip_dlfile = os.path.join(temp_dir, 'zipball.zip')
+        with metrics.stage('zip_download'):
+            download(tag.zipball_url, zip_dlfile)
+        if not os.path.exists(zip_dlfile):
+            return None
+        built_zip = os.path.join(temp_dir, repo_name + '.zip')
+        with metrics.stage('zip_repackage'):
+            repackage_zip(zip_dlfile, built_zip, repo_name)
+        os.replace(built_zip, zip_path)
+    finally:
+        shutil.rmtree(temp_dir)
+    evict_build_cache(cache_dir, zip_path)
+    return zip_path
+
+def evict_build_cache(cache_dir, keep):
+    """
+    Delete the least recently used builds until the build cache fits in build_cache_max_bytes,
+    apart from keep
+    """
+    builds = []
+    for sha in os.listdir(cache_dir):
+        # Builds in progress are in dot directories
+        if sha.startswith('.'):
+            continue
+        try:
+            filenames = os.listdir(os.path.join(cache_dir, sha))
+        except OSError:
+            continue
+        for filename in filenames:
+            path = os.path.join(cache_dir, sha, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            builds.append((st.st_mtime, st.st_size, path))
+    total = sum(size for mtime, size, path in builds)
+    for mtime, size, path in sorted(builds):
+        if total <= config.build_cache_max_bytes:
+            break
+        if path == keep:
+            continue
+        _log.info("Evicting %s from build cache" % path)
+        try:
+            os.unlink(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+        total -= size
 
 if __name__ == '__main__':
     import pprint
@@ -374,7 +819,6 @@ if __name__ == '__main__':
                         datefmt='%Y%m%d %H:%M',
                         level=logging.INFO)
     
-    repos = repositories()
-    details = kodi_repos(repos)
+    details = fetch_details()
     pprint.pprint(details)
     print(addons_xml(details))
@@ -10,28 +10,162 @@ __maintainer__ = "Andrew Leech"
 __email__ = "andrew@alelec.net"
 __status__ = "Development"
 
-from flask import Flask, redirect, abort, url_for, render_template, send_from_directory, request
-from flask.ext.cache import Cache
+from flask import Flask, redirect, abort, url_for, render_template, send_from_directory, request, make_response, g
 
 import os
+import hmac
+import json
+import time
 import redis
+import hashlib
 import config
 import pprint
-import jsonpickle
-import github_handler
-import semantic_version
+import metrics
+import repo_store
+import media_store
+import cache_purge
+import artifact_store
 from functools import wraps
+from werkzeug.wsgi import wrap_file
 
 app = Flask(__name__)
 
-cache = Cache(app,config={'CACHE_TYPE': 'redis',
-                          'CACHE_KEY_PREFIX': 'kodi_repo_app',
-                          'CACHE_REDIS_URL': config.redis_url
-                           })
 redisStore = redis.StrictRedis(**config.redis_server)
 
 app.config['PROPAGATE_EXCEPTIONS'] = True
 
+class RepoSnapshot(object):
+    """
+    Per worker copy of the decoded repo details and addons.xml, tagged with the
+    generation number the refresh task bumps each time it publishes.
+    Addons are fetched and decoded one at a time as they're asked for, the
+    whole catalogue only for pages that list every addon.
+
+    Everything successfully loaded is also kept as last known good, seeded from
+    the on-disk snapshot_file, and served whenever redis has nothing published
+    or can't be reached.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.generation = None
+        self.checked = 0
+        self.good_details = None
+        self.good_addons = {}
+        self.good_addons_xml = None
+        self.clear()
+        self.load_snapshot()
+
+    def clear(self):
+        self._details = None
+        self._addons = {}
+        self._addons_xml = None
+        self._home = None
+
+    def load_snapshot(self):
+        """
+        Start from the on-disk snapshot, if its generation is still the published
+        one nothing has to be loaded from redis at all
+        """
+        try:
+            snapshot = repo_store.load_snapshot()
+        except Exception:
+            app.logger.exception("Could not read last known good snapshot")
+            return
+        if snapshot is None:
+            return
+        generation, details, addons_xml = snapshot
+        self.generation = str(generation).encode()
+        self._details = self.good_details = details
+        self._addons = dict(details)
+        self.good_addons = dict(details)
+        self._addons_xml = self.good_addons_xml = addons_xml
+
+    def refresh(self):
+        now = time.time()
+        if self.generation is not None and now - self.checked < config.details_check_interval:
+            return
+
+        self.checked = now
+        try:
+            generation = self.store.get(config.redis_keys.generation)
+        except redis.RedisError:
+            app.logger.exception("Redis unavailable, serving last known good details")
+            return
+        if generation is not None and generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def load(self, loader, *args):
+        """
+        Result of a repo_store loader, None if redis fails or has nothing published
+        """
+        try:
+            return loader(self.store, *args)
+        except redis.RedisError:
+            app.logger.exception("Redis unavailable, serving last known good details")
+            return None
+
+    def details(self):
+        self.refresh()
+        if self._details is None:
+            metrics.inc('kodi_repo_cache_lookups_total', cache='details', result='miss')
+            details = self.load(repo_store.load_details)
+            if details is None:
+                return self.good_details
+            self._details = self.good_details = details
+            self._addons.update(details)
+            self.good_addons = dict(details)
+        else:
+            metrics.inc('kodi_repo_cache_lookups_total', cache='details', result='hit')
+        return self._details
+
+    def addon(self, addon_id):
+        self.refresh()
+        if addon_id not in self._addons:
+            metrics.inc('kodi_repo_cache_lookups_total', cache='addon', result='miss')
+            repo_det = self.load(repo_store.load_addon, addon_id)
+            if repo_det is None:
+                # Only a real 404 once redis says a catalogue is published
+                if self.load(repo_store.is_published):
+                    return None
+                return self.good_addons.get(addon_id)
+            self._addons[addon_id] = self.good_addons[addon_id] = repo_det
+        else:
+            metrics.inc('kodi_repo_cache_lookups_total', cache='addon', result='hit')
+        return self._addons[addon_id]
+
+    def addons_xml(self):
+        self.refresh()
+        if self._addons_xml is None:
+            metrics.inc('kodi_repo_cache_lookups_total', cache='addons_xml', result='miss')
+            addons_xml = self.load(repo_store.load_addons_xml)
+            if addons_xml is None:
+                return self.good_addons_xml
+            self._addons_xml = self.good_addons_xml = addons_xml
+        else:
+            metrics.inc('kodi_repo_cache_lookups_total', cache='addons_xml', result='hit')
+        return self._addons_xml
+
+    def home(self, render):
+        """
+        (html, etag) of the home page, rendered once per generation by render(details)
+        """
+        self.refresh()
+        if self._home is None:
+            metrics.inc('kodi_repo_cache_lookups_total', cache='home', result='miss')
+            details = self.details()
+            html = render(details or {}).encode('utf-8')
+            home = (html, hashlib.sha1(html).hexdigest())
+            if details is None:
+                # Nothing published yet, don't keep the empty page around
+                return home
+            self._home = home
+        else:
+            metrics.inc('kodi_repo_cache_lookups_total', cache='home', result='hit')
+        return self._home
+
+snapshot = RepoSnapshot(redisStore)
+
 if not app.debug and config.logfile:
     import logging
     from logging.handlers import TimedRotatingFileHandler
@@ -59,6 +193,47 @@ def log_exception(exception=Exception, logger=app.logger):
         return wrapper
     return deco
 
+def cacheable(response, *keys):
+    """
+    Tag a response with the surrogate keys it depends on, with a purge_hook set a caching
+    proxy can keep it until one of them is purged. Clients, and the proxy without a
+    purge_hook, get client_max_age unless it already has one.
+    Left untagged until something is published, as no purge would follow the first publish.
+    """
+    if snapshot.generation is None:
+        return response
+    if config.purge_hook:
+        keys += (cache_purge.generation_key(snapshot.generation.decode()),)
+        response.headers['Surrogate-Key'] = ' '.join(keys)
+        response.headers['Surrogate-Control'] = 'max-age=%d' % config.surrogate_max_age
+    response.cache_control.public = True
+    if response.cache_control.max_age is None:
+        response.cache_control.max_age = config.client_max_age
+    return response
+
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+
+@app.after_request
+def record_request(response):
+    if hasattr(g, 'request_start'):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('kodi_repo_request_seconds', time.time() - g.request_start,
+                        route=route, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics_page():
+    """
+    Prometheus scrape endpoint, totals from every web worker and celery process
+    """
+    metrics.flush(force=True)
+    response = make_response(metrics.render(redisStore))
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
 @app.route('/favicon.<ext>')
 def favicon(ext):
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.'+ext)
@@ -70,67 +245,221 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 @app.route('/')
-# @cache.cached(timeout=5*60)
 @log_exception()
 def home():
-    details = jsonpickle.decode(redisStore.get(config.redis_keys.details).decode())
-    return render_template('home.html', details=details)
+    html, etag = snapshot.home(lambda details: render_template('home.html', details=details))
+    response = make_response(html)
+    response.set_etag(etag)
+    return cacheable(response.make_conditional(request), cache_purge.HOME)
+
+def unavailable():
+    """
+    Nothing has ever been published and there's no snapshot on disk, kodi retries later
+    """
+    response = make_response("Repository not published yet, try again shortly\n", 503)
+    response.mimetype = 'text/plain'
+    response.headers['Retry-After'] = '60'
+    abort(response)
+
+def addons_xml_response(body, md5, mimetype):
+    """
+    Same validators as the pre-rendered files nginx serves from static_output_dir
+    """
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(md5)
+    return cacheable(response.make_conditional(request), cache_purge.ADDONS_XML)
 
 @app.route('/repo/addons.xml')
-@cache.cached(timeout=5*60)
 @log_exception()
 def addons_xml_page():
-    addons_xml, addons_xml_md5 = jsonpickle.decode(redisStore.get(config.redis_keys.addons_xml).decode())
-    return addons_xml
+    addons_xml, addons_xml_md5 = snapshot.addons_xml() or unavailable()
+    return addons_xml_response(addons_xml, addons_xml_md5, 'text/xml')
 
 @app.route('/repo/addons.xml.md5')
-@cache.cached(timeout=5*60)
 @log_exception()
 def addons_xml_md5_page():
-    addons_xml, addons_xml_md5 = jsonpickle.decode(redisStore.get(config.redis_keys.addons_xml).decode())
-    return addons_xml_md5
+    addons_xml, addons_xml_md5 = snapshot.addons_xml() or unavailable()
+    return addons_xml_response(addons_xml_md5, addons_xml_md5, 'text/plain')
 
 @app.route('/repo/<addon_id>')
-@cache.cached(timeout=5*60)
 @log_exception()
 def addon_page(addon_id):
-    details = jsonpickle.decode(redisStore.get(config.redis_keys.details).decode())
-    if addon_id in details:
-        # return render_template('addon.html', repo=details[addon_id])
-        repo = details[addon_id]
+    repo = snapshot.addon(addon_id)
+    if repo:
+        # return render_template('addon.html', repo=repo)
         url = "https://github.com/{owner}/{reponame}/tree/{newest_tagname}".format(
                 owner=repo.owner, reponame=repo.reponame, newest_tagname=repo.newest_tagname)
-        return redirect(url)
+        return cacheable(redirect(url), cache_purge.addon_key(addon_id))
     else:
         return abort(404)
 
+def artifact_response(addon_id, vers):
+    """
+    A zip from the artifact store, handed to nginx with X-Accel-Redirect when
+    artifact_accel_redirect is set, otherwise sent with ETag, Range and
+    conditional GET support. None if it isn't stored yet.
+    """
+    path = artifact_store.artifact_path(addon_id, vers)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    response = app.response_class(mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % os.path.basename(path)
+    if config.artifact_accel_redirect:
+        # nginx serves the file from an internal location aliased to artifact_store_dir
+        response.headers['X-Accel-Redirect'] = config.artifact_accel_redirect + artifact_store.artifact_name(addon_id, vers)
+        return response
+
+    # Versions never change once stored, so the file's size and mtime make a strong validator
+    etag = '%x-%x' % (int(stat.st_mtime), stat.st_size)
+    response.set_etag(etag)
+    response.last_modified = int(stat.st_mtime)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    size = stat.st_size
+    byte_range = request.range
+    if request.headers.get('If-Range') and request.if_range.etag != etag:
+        # Resuming a different file, send all of this one
+        byte_range = None
+    if byte_range is not None and len(byte_range.ranges) > 1:
+        # Multiple ranges would need a multipart/byteranges body, the whole file will do
+        byte_range = None
+    if byte_range is not None:
+        content_range = byte_range.range_for_length(size)
+        if content_range is None:
+            response.status_code = 416
+            response.headers['Content-Range'] = 'bytes */%d' % size
+            return response
+        start, stop = content_range
+        with open(path, 'rb') as zipfile:
+            zipfile.seek(start)
+            response.set_data(zipfile.read(stop - start))
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        return response
+
+    response.response = wrap_file(request.environ, open(path, 'rb'))
+    response.direct_passthrough = True
+    response.content_length = size
+    return response
+
+@app.route('/repo/<addon_id>/icon.png')
+@app.route('/repo/<addon_id>/fanart.jpg')
+@app.route('/repo/<addon_id>/changelog-<vers>.txt')
+@log_exception()
+def media_file(addon_id, vers=None):
+    """
+    Artwork and changelogs from the media store, nginx serves these itself when
+    set up as in the example conf. Changelogs never change for a version, the
+    artwork follows the newest one.
+    """
+    if not media_store.enabled() or snapshot.addon(addon_id) is None:
+        return abort(404)
+    filename = media_store.changelog_name(vers) if vers else request.path.rsplit('/', 1)[1]
+    path = media_store.served_path(addon_id, filename)
+    if path is None:
+        return abort(404)
+
+    with open(path, 'rb') as mediafile:
+        response = make_response(mediafile.read())
+    response.mimetype = {'.png': 'image/png', '.jpg': 'image/jpeg'}.get(os.path.splitext(filename)[1], 'text/plain')
+    # Blobs are named by their sha256
+    response.set_etag(os.path.splitext(os.path.basename(os.path.realpath(path)))[0])
+    response.cache_control.public = True
+    response.cache_control.max_age = 365*24*60*60 if vers else config.media_max_age
+    key = cache_purge.version_key(addon_id, vers) if vers else cache_purge.addon_key(addon_id)
+    return cacheable(response.make_conditional(request), key)
+
 @app.route('/repo/<addon_id>/<zip_addon_id>-<vers>.zip')
 @app.route('/repo/<addon_id>/<zip_addon_id>.zip')
-@cache.cached(timeout=5*60)
 @log_exception()
 def zip_url(addon_id, zip_addon_id, vers=None):
+    # A version's zip url never changes, the unversioned one follows the newest version
+    key = cache_purge.version_key(addon_id, vers) if vers else cache_purge.addon_key(addon_id)
     url = None
-    details = jsonpickle.decode(redisStore.get(config.redis_keys.details).decode())
-    if (addon_id == zip_addon_id or zip_addon_id is None) and addon_id in details:
-        repo_dets = details[zip_addon_id]
-        assert isinstance(repo_dets, github_handler.RepoDetail)
+    repo_dets = snapshot.addon(addon_id) if (addon_id == zip_addon_id or zip_addon_id is None) else None
+    if repo_dets:
+        assert isinstance(repo_dets, repo_store.RepoDetail)
 
         if not vers:
-            vers = sorted(repo_dets.downloads.keys(), key=lambda v:semantic_version.Version(v))[-1]
+            vers = repo_dets.latest_version
 
-        if vers and vers in repo_dets.downloads:
-            url = repo_dets.downloads[vers]
+        if vers:
+            url = repo_dets.downloads.get(vers)
 
     if url:
-        return redirect(url)
+        if config.zip_serving == 'local':
+            artifact_store.touch(redisStore, addon_id, vers)
+            response = artifact_response(addon_id, vers)
+            if response is not None:
+                metrics.inc('kodi_repo_cache_lookups_total', cache='artifact', result='hit')
+                return cacheable(response, key)
+            metrics.inc('kodi_repo_cache_lookups_total', cache='artifact', result='miss')
+            # Not downloaded by the refresh task yet, github has it. Not for the proxy
+            # to keep, the zip is served from here once it's downloaded
+            response = redirect(url)
+            response.cache_control.no_store = True
+            return response
+        return cacheable(redirect(url), key)
     else:
         return abort(404)
 
-if __name__ == '__main__':
-    from werkzeug.contrib.profiler import ProfilerMiddleware
-    app.config['PROFILE'] = True
+def webhook_signature_valid(req):
+    """
+    Checks the HMAC github signs each webhook delivery with using the shared secret
+    """
+    secret = config.github_webhook_secret.encode()
+    for header, prefix, digestmod in (('X-Hub-Signature-256', 'sha256=', hashlib.sha256),
+                                      ('X-Hub-Signature', 'sha1=', hashlib.sha1)):
+        signature = req.headers.get(header)
+        if signature:
+            expected = prefix + hmac.new(secret, req.get_data(), digestmod).hexdigest()
+            # Compared as bytes, compare_digest raises on a str with anything non-ascii
+            return hmac.compare_digest(signature.encode('utf-8'), expected.encode())
+    return False
+
+def webhook_tag_event(event, payload):
+    """
+    True for the webhook events that can add or change an addon version
+    """
+    if event in ('create', 'delete'):
+        return payload.get('ref_type') == 'tag'
+    if event == 'push':
+        return payload.get('ref', '').startswith('refs/tags/')
+    return event == 'release'
+
+@app.route('/hooks/github', methods=['POST'])
+@log_exception()
+def github_webhook():
+    if not config.github_webhook_secret:
+        return abort(404)
+    if not webhook_signature_valid(request):
+        return abort(403)
 
-    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[30])
+    event = request.headers.get('X-GitHub-Event')
+    if event == 'ping':
+        return 'pong'
 
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = json.loads(request.form.get('payload', '{}'))
+    repo_name = (payload.get('repository') or {}).get('name')
+
+    if not repo_name or not webhook_tag_event(event, payload):
+        return 'ignored'
+
+    # Every event pushes the repo's refresh back by the debounce period, the
+    # celery process_pending_refreshes task picks it up once it's due
+    redisStore.zadd(config.redis_keys.pending_refresh, time.time() + config.webhook_debounce, repo_name)
+    return 'queued', 202
+
+if __name__ == '__main__':
+    # For load testing / tuning see dev_scripts/bench_serving.py
     app.run(debug=True, host='0.0.0.0', port=config.debug_server.port)
 
@@ -10,9 +10,13 @@ __maintainer__ = "Andrew Leech"
 __email__ = "andrew@alelec.net"
 __status__ = "Development"
 
+import time
+import redis
+import locks
 import config
-import github_handler
+import logging
 from celery import Celery
+from celery.signals import worker_ready
 from datetime import timedelta
 
 app = Celery('kodi_repo_task', 
@@ -25,10 +29,23 @@ app.conf.update(
     CELERY_TASK_SERIALIZER = 'json',
     CELERY_RESULT_SERIALIZER = 'json',
 
+    # Release zips are built, and downloaded into the artifact store, by their own worker
+    # so a slow build never holds up publishing metadata, see upstart_scripts/kodi_repo_celery_builds.conf
+    CELERY_ROUTES = {
+        'kodi_repo_task.build_release_asset': {'queue': 'kodi_repo_builds'},
+        'kodi_repo_task.sync_artifact_store': {'queue': 'kodi_repo_builds'},
+    },
+
     CELERYBEAT_SCHEDULE = {
         'update_kodi_repos_details': {
             'task': 'kodi_repo_task.periodic_update_kodi_repos_details',
-            'schedule': timedelta(minutes=15),
+            'schedule': timedelta(minutes=config.refresh_interval),
+            # A trigger still queued when the next one is due is superseded by it
+            'options': {'expires': config.refresh_interval * 60},
+        },
+        'process_pending_refreshes': {
+            'task': 'kodi_repo_task.process_pending_refreshes',
+            'schedule': timedelta(seconds=config.webhook_poll_interval),
         },
     }
 )
@@ -43,10 +60,159 @@ app.conf.update(
 #     #     crontab(hour=7, minute=30, day_of_week=1),
 #     #     test.s('Happy Mondays!'),
 
+redisStore = redis.StrictRedis(**config.redis_server)
+
+_log = logging.getLogger(__name__)
+
+def enqueue_asset_build(full_name, vers):
+    """
+    Queue a release zip build unless one for the same repo and version is already queued or running
+    """
+    key = "%s:%s:%s" % (config.redis_keys.build_pending, full_name, vers)
+    if redisStore.set(key, 1, nx=True, ex=config.build_timeout):
+        build_release_asset.delay(full_name, vers)
+
+def enqueue_purge(keys, generation):
+    """
+    Purge surrogate keys once every web worker has had details_check_interval to notice
+    the new generation, or the proxy could fetch and keep the old responses again
+    """
+    purge_surrogate_keys.apply_async((keys, generation), countdown=config.details_check_interval)
+
+def enqueue_artifact_sync(store, details):
+    """
+    With zip_serving: local, queue a sync of the artifact store with the published
+    details unless one is already queued
+    """
+    if config.zip_serving != 'local':
+        return
+    if redisStore.set(config.redis_keys.artifact_sync_pending, 1, nx=True, ex=config.build_timeout):
+        sync_artifact_store.delay()
+
+def request_refresh():
+    """
+    Queue a full refresh unless one is already queued
+    """
+    if redisStore.set(config.redis_keys.refresh_queued, 1, nx=True, ex=config.refresh_interval * 60):
+        periodic_update_kodi_repos_details.delay()
+
+## Only one refresh publishes at a time across the cluster: full and webhook
+## triggered refreshes all hold the refresh lease. A full refresh triggered while
+## it's held is folded into one more run after the current one finishes.
+
+## github_handler (and github3, requests, zipfile with it) is only imported once
+## a task actually runs, so celery beat and worker boot don't pay for it
+
 @app.task
 def periodic_update_kodi_repos_details():
-    return github_handler.update_kodi_repos_redis()
+    redisStore.delete(config.redis_keys.refresh_queued)
+    started = start_sharded_refresh() if config.refresh_shard_size else refresh_in_one_task()
+    if not started:
+        _log.info("Refresh already running, folding this one into the next run")
+        redisStore.set(config.redis_keys.refresh_requested, 1)
+
+def refresh_in_one_task():
+    """
+    Crawl and publish every repo in this task, False if a refresh is already running
+    """
+    with locks.refresh_lease() as lease:
+        if lease is None:
+            return False
+        # Whatever asked for a refresh before this point is covered by this one
+        redisStore.delete(config.redis_keys.refresh_requested)
+        import github_handler
+        github_handler.update_kodi_repos_redis(build_asset=enqueue_asset_build, purge=enqueue_purge,
+                                               sync=enqueue_artifact_sync)
+    refresh_finished()
+    return True
+
+def start_sharded_refresh():
+    """
+    Fan the crawl out to a refresh_shard task per refresh_shard_size repos, any worker
+    on the default queue can pick them up. The last shard to finish queues finish_refresh,
+    which also runs at the deadline in case some never do. False if a refresh is already running.
+    """
+    import refresh_shards
+    run = refresh_shards.start(redisStore)
+    if run is None:
+        return False
+    redisStore.delete(config.redis_keys.refresh_requested)
+    run_id, shards = run
+    for names in shards:
+        refresh_shard.delay(run_id, names)
+    finish_refresh.apply_async((run_id,), countdown=config.refresh_shard_deadline)
+    return True
 
+@app.task
+def refresh_shard(run_id, names):
+    import refresh_shards
+    if refresh_shards.crawl(redisStore, run_id, names, build_asset=enqueue_asset_build):
+        finish_refresh.delay(run_id)
+
+@app.task
+def finish_refresh(run_id):
+    import refresh_shards
+    if refresh_shards.finish(redisStore, run_id, purge=enqueue_purge, sync=enqueue_artifact_sync):
+        refresh_finished()
+
+def refresh_finished():
+    """
+    Run again for anything that asked for a refresh while this one was running
+    """
+    if redisStore.delete(config.redis_keys.refresh_requested):
+        request_refresh()
+
+@app.task
+def process_pending_refreshes():
+    """
+    Refresh each repo whose webhook debounce period has passed, unless a refresh
+    is running in which case they're left for the next poll
+    """
+    due = redisStore.zrangebyscore(config.redis_keys.pending_refresh, 0, time.time())
+    if not due:
+        return
+    with locks.refresh_lease() as lease:
+        if lease is None:
+            return
+        for repo_name in due:
+            # Only one worker wins the zrem, an event arriving during the refresh re-adds the repo
+            if redisStore.zrem(config.redis_keys.pending_refresh, repo_name):
+                import github_handler
+                github_handler.update_kodi_repo_redis(repo_name.decode(), build_asset=enqueue_asset_build,
+                                                      purge=enqueue_purge, sync=enqueue_artifact_sync)
+
+@app.task
+def purge_surrogate_keys(keys, generation):
+    import cache_purge
+    cache_purge.purge(keys, generation)
+
+@app.task
+def build_release_asset(full_name, vers):
+    import github_handler
+    try:
+        repo_name = github_handler.build_release_asset(full_name, vers)
+    finally:
+        redisStore.delete("%s:%s:%s" % (config.redis_keys.build_pending, full_name, vers))
+    if repo_name:
+        # Republished by process_pending_refreshes under the refresh lease
+        redisStore.zadd(config.redis_keys.pending_refresh, time.time(), repo_name)
+
+@app.task
+def sync_artifact_store():
+    # Cleared first so a publish during the downloads queues another sync
+    redisStore.delete(config.redis_keys.artifact_sync_pending)
+    import repo_store
+    import github_handler
+    details = repo_store.load_details(redisStore)
+    if details is not None:
+        github_handler.sync_artifacts(redisStore, details)
 
-# Update cached details once at startup
-periodic_update_kodi_repos_details.delay()
+@worker_ready.connect
+def refresh_on_startup(sender=None, **kwargs):
+    """
+    Update cached details once when the metadata worker comes up, rather than on every
+    import of this module. The builds worker only consumes kodi_repo_builds so skips it.
+    """
+    queues = [queue.name for queue in sender.task_consumer.queues]
+    if app.conf.CELERY_DEFAULT_QUEUE in queues:
+        request_refresh()
@@ -0,0 +1,148 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import time
+import uuid
+import redis
+import config
+import logging
+import threading
+from contextlib import contextmanager
+
+_log = logging.getLogger(__name__)
+
+## Leases shared by every celery process through redis. The key holds a random
+## token for as long as its holder keeps renewing it, a holder that dies lets it
+## expire after lease_ttl seconds. Renewal and release only touch the key while
+## it still holds our token, so an expired lease taken over by another process
+## is never renewed or deleted by the old holder. Renewal stops after max_hold
+## seconds, so a holder stuck on a dead connection loses the lease like one that died.
+
+_redisStore = None
+
+def lock_store():
+    global _redisStore
+    if _redisStore is None:
+        _redisStore = redis.StrictRedis(**config.redis_server)
+    return _redisStore
+
+class Lease(object):
+    """
+    Redis lease on key, renewed every third of ttl by a heartbeat thread while held,
+    for at most max_hold seconds if given. Given the token of a lease taken by another
+    process, adopt() carries it on.
+    """
+    def __init__(self, key, ttl=None, store=None, token=None, max_hold=None):
+        self.key = key
+        self.ttl = ttl or config.lease_ttl
+        self.store = store or lock_store()
+        self.token = token or uuid.uuid4().hex.encode()
+        self.max_hold = max_hold
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self, heartbeat=True):
+        """
+        Take the lease and start renewing it, False if another process holds it.
+        Without heartbeat it's only held for ttl unless adopted.
+        """
+        if not self.store.set(self.key, self.token, nx=True, px=int(self.ttl * 1000)):
+            return False
+        if heartbeat:
+            self.start_heartbeat()
+        return True
+
+    def adopt(self):
+        """
+        Renew a lease taken elsewhere with our token and keep renewing it, False if it has expired
+        """
+        if not self.renew():
+            return False
+        self.start_heartbeat()
+        return True
+
+    def start_heartbeat(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self.heartbeat, name='lease %s' % self.key)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def if_held(self, action):
+        """
+        Run action(pipeline) in a transaction only if the key still holds our token
+        """
+        with self.store.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.get(self.key) != self.token:
+                    return False
+                pipe.multi()
+                action(pipe)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def renew(self):
+        return self.if_held(lambda pipe: pipe.pexpire(self.key, int(self.ttl * 1000)))
+
+    def heartbeat(self):
+        started = time.time()
+        while not self._stop.wait(self.ttl / 3.0):
+            if self.max_hold is not None and time.time() - started > self.max_hold:
+                _log.error("Lease %s held for over %d seconds, letting it expire" % (self.key, self.max_hold))
+                self.lost = True
+                return
+            try:
+                renewed = self.renew()
+            except redis.RedisError:
+                _log.exception("Could not renew lease %s" % self.key)
+                continue
+            if not renewed:
+                _log.error("Lease %s expired while held" % self.key)
+                self.lost = True
+                return
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            self.if_held(lambda pipe: pipe.delete(self.key))
+        except redis.RedisError:
+            _log.exception("Could not release lease %s, it expires in %d seconds" % (self.key, self.ttl))
+
+@contextmanager
+def held(key, ttl=None, store=None, max_hold=None):
+    """
+    with block holding the lease on key, gives None instead if another process holds it
+    """
+    lease = Lease(key, ttl, store, max_hold=max_hold)
+    if not lease.acquire():
+        yield None
+        return
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+def refresh_max_hold():
+    """
+    Longest a refresh holds the refresh lease, the next full refresh is due by then
+    """
+    return config.refresh_interval * 60
+
+def refresh_lease(store=None):
+    """
+    Lease held while a full or webhook triggered refresh crawls and publishes
+    """
+    return held(config.redis_keys.refresh_lease, store=store, max_hold=refresh_max_hold())
+
+def build_lock(full_name, vers):
+    """
+    Lease held while a release or addon zip is created for one version of a repo
+    """
+    return held("%s:%s:%s" % (config.redis_keys.build_lock, full_name, vers), max_hold=config.build_timeout)
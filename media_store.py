@@ -0,0 +1,213 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import io
+import os
+import json
+import uuid
+import config
+import hashlib
+import logging
+import zipfile
+import tempfile
+from xml.etree import ElementTree
+
+_log = logging.getLogger(__name__)
+
+## Artwork and changelogs of each addon, laid out like a kodi repo datadir:
+## <media_store_dir>/<addon_id>/icon.png, fanart.jpg and changelog-<vers>.txt.
+## Those are symlinks into blobs/, where every file is stored once by its sha256,
+## so nginx can serve them straight from disk. icon.png and fanart.jpg follow the
+## newest version stored, <addon_id>/.media.json records which versions are done.
+
+# (kind, served as, Pillow format, size setting)
+IMAGES = (
+    ('icon', 'icon.png', 'PNG', 'media_icon_size'),
+    ('fanart', 'fanart.jpg', 'JPEG', 'media_fanart_size'),
+)
+
+# Source files bigger than this are skipped rather than read into memory
+MAX_SOURCE_BYTES = 20*1024**2
+
+def enabled():
+    return bool(config.media_store_dir)
+
+def store_dir():
+    """
+    Absolute path of media_store_dir, relative paths are from this directory
+    """
+    path = config.media_store_dir
+    if not os.path.isabs(path):
+        path = os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+    return path
+
+def changelog_name(vers):
+    return 'changelog-%s.txt' % vers
+
+def media_path(addon_id, filename):
+    return os.path.join(store_dir(), addon_id, filename)
+
+def served_path(addon_id, filename):
+    """
+    media_path of names taken from a url, None unless that's a file within the store
+    """
+    for name in (addon_id, filename):
+        if name in ('', '.', '..') or '/' in name or os.sep in name:
+            return None
+    path = media_path(addon_id, filename)
+    if not os.path.realpath(path).startswith(os.path.realpath(store_dir()) + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+def sources(addon_xml):
+    """
+    {kind: path within the addon} of the artwork addon_xml declares and the changelog.
+    Addons without an <assets> element use the pre Kodi 17 icon.png and fanart.jpg.
+    """
+    paths = {'icon': 'icon.png', 'fanart': 'fanart.jpg', 'changelog': 'changelog.txt'}
+    try:
+        root = ElementTree.fromstring(addon_xml)
+    except ElementTree.ParseError:
+        return paths
+    assets = root.find("extension[@point='xbmc.addon.metadata']/assets")
+    if assets is not None:
+        for kind, filename, image_format, size_setting in IMAGES:
+            element = assets.find(kind)
+            if element is not None and (element.text or '').strip():
+                paths[kind] = element.text.strip()
+            else:
+                del paths[kind]
+    return paths
+
+def index(addon_id):
+    """
+    {'current': version icon.png and fanart.jpg are from, 'versions': {vers: {filename: blob}}}
+    """
+    try:
+        with open(media_path(addon_id, '.media.json')) as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError):
+        return {'current': None, 'versions': {}}
+
+def extracted(addon_id, vers):
+    return vers in index(addon_id)['versions']
+
+def write_atomic(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+def write_blob(data, ext):
+    """
+    Store data by its content, returns its path relative to the store
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    blob = 'blobs/%s/%s%s' % (digest[:2], digest, ext)
+    path = os.path.join(store_dir(), blob)
+    if not os.path.exists(path):
+        write_atomic(path, data)
+    return blob
+
+def link(addon_id, filename, blob):
+    """
+    Atomically point <addon_id>/filename at blob
+    """
+    path = media_path(addon_id, filename)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    os.symlink(os.path.join('..', blob), temp_path)
+    os.replace(temp_path, path)
+
+_warned_no_pillow = False
+
+def thumbnail(data, size, image_format):
+    """
+    Image scaled down to fit within size and re-encoded as image_format. Returned as
+    is if it already fits in that format, or if Pillow isn't installed.
+    """
+    global _warned_no_pillow
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _warned_no_pillow:
+            _warned_no_pillow = True
+            _log.warning("Pillow isn't installed, storing artwork without scaling it down")
+        return data
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.format == image_format and image.size[0] <= size[0] and image.size[1] <= size[1]:
+            return data
+        image.thumbnail(tuple(size), Image.LANCZOS)
+        options = {'optimize': True}
+        if image_format == 'JPEG':
+            options['quality'] = 85
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, image_format, **options)
+        return output.getvalue()
+    except Exception:
+        _log.warning("Could not re-encode image, storing it as is", exc_info=True)
+        return data
+
+def newer(vers, current):
+    import semantic_version
+    try:
+        return semantic_version.Version(vers) > semantic_version.Version(current)
+    except ValueError:
+        return vers > current
+
+def store(addon_id, vers, files):
+    """
+    Add the artwork and changelog of one version of an addon, files is {kind: bytes}
+    with the kinds of sources(). icon.png and fanart.jpg are switched over to it if
+    it's newer than the version they're from.
+    """
+    media = index(addon_id)
+    entry = {}
+    if files.get('changelog') is not None:
+        entry[changelog_name(vers)] = write_blob(files['changelog'], '.txt')
+    for kind, filename, image_format, size_setting in IMAGES:
+        if files.get(kind) is not None:
+            data = thumbnail(files[kind], getattr(config, size_setting), image_format)
+            entry[filename] = write_blob(data, os.path.splitext(filename)[1])
+
+    if changelog_name(vers) in entry:
+        link(addon_id, changelog_name(vers), entry[changelog_name(vers)])
+    if media['current'] is None or newer(vers, media['current']):
+        for kind, filename, image_format, size_setting in IMAGES:
+            if filename in entry:
+                link(addon_id, filename, entry[filename])
+            elif os.path.lexists(media_path(addon_id, filename)):
+                # Dropped by the newer version
+                os.unlink(media_path(addon_id, filename))
+        media['current'] = vers
+
+    media['versions'][vers] = entry
+    write_atomic(media_path(addon_id, '.media.json'), json.dumps(media, sort_keys=True).encode())
+    _log.info("Stored %s for %s:%s" % (", ".join(sorted(entry)) or "no media", addon_id, vers))
+
+def zip_files(zip_path, addon_id):
+    """
+    {kind: bytes} of the artwork and changelog in a built addon zip
+    """
+    files = {}
+    with zipfile.ZipFile(zip_path) as addon_zip:
+        infos = {info.filename: info for info in addon_zip.infolist()}
+        addon_xml_name = '%s/addon.xml' % addon_id
+        addon_xml = addon_zip.read(addon_xml_name) if addon_xml_name in infos else b''
+        for kind, path in sources(addon_xml).items():
+            info = infos.get('%s/%s' % (addon_id, path))
+            if info is not None and info.file_size <= MAX_SOURCE_BYTES:
+                files[kind] = addon_zip.read(info)
+    return files
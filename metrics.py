@@ -0,0 +1,170 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import time
+import redis
+import config
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from functools import wraps
+from contextlib import contextmanager
+
+_log = logging.getLogger(__name__)
+
+## Counters and histograms are kept in redis so every uWSGI worker and celery
+## process adds to the same series, /metrics renders them in the Prometheus text
+## format. Each process buffers its updates and writes them in one pipeline at
+## most every metrics_flush_interval seconds.
+
+INF = float('inf')
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, INF)
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, INF)
+
+# name: (type, help, histogram buckets)
+FAMILIES = OrderedDict([
+    ('kodi_repo_refresh_stage_seconds', ('histogram', 'Time spent in each stage of refreshing from github', STAGE_BUCKETS)),
+    ('kodi_repo_refresh_total', ('counter', 'Refreshes by kind and outcome', None)),
+    ('kodi_repo_github_requests_total', ('counter', 'Github api responses by status code', None)),
+    ('kodi_repo_github_rate_limit_remaining', ('gauge', 'Github api requests left in the current rate limit window', None)),
+    ('kodi_repo_github_rate_limit_limit', ('gauge', 'Github api requests allowed per rate limit window', None)),
+    ('kodi_repo_github_rate_limit_reset_timestamp', ('gauge', 'Unix time the github rate limit window resets', None)),
+    ('kodi_repo_request_seconds', ('histogram', 'Web app response time by route and status', REQUEST_BUCKETS)),
+    ('kodi_repo_cache_lookups_total', ('counter', 'Web app cache lookups by cache and result', None)),
+])
+
+_lock = threading.Lock()
+_counts = defaultdict(float)
+_gauges = {}
+_flushed = time.time()
+_redisStore = None
+
+def metrics_store():
+    global _redisStore
+    if _redisStore is None:
+        _redisStore = redis.StrictRedis(**config.redis_server)
+    return _redisStore
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def series(name, labels):
+    """
+    Prometheus sample name with its labels, le last for histogram buckets
+    """
+    if not labels:
+        return name
+    keys = sorted(k for k in labels if k != 'le') + (['le'] if 'le' in labels else [])
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (k, escape(labels[k])) for k in keys))
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        _counts[series(name, labels)] += amount
+    flush()
+
+def observe(name, value, **labels):
+    buckets = FAMILIES[name][2]
+    with _lock:
+        for bound in buckets:
+            # Every bucket gets written, even when still empty
+            _counts[series(name + '_bucket', dict(labels, le='+Inf' if bound == INF else repr(bound)))] += value <= bound
+        _counts[series(name + '_sum', labels)] += value
+        _counts[series(name + '_count', labels)] += 1
+    flush()
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[series(name, labels)] = value
+    flush()
+
+@contextmanager
+def stage(name):
+    """
+    Time a refresh stage, as a with block or function decorator
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe('kodi_repo_refresh_stage_seconds', time.time() - start, stage=name)
+
+def refresh(kind):
+    """
+    Decorator timing and counting a whole refresh as stage kind, flushing
+    afterwards so /metrics shows it without waiting for the next update
+    """
+    def deco(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            outcome = 'error'
+            try:
+                with stage(kind):
+                    result = func(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                inc('kodi_repo_refresh_total', kind=kind, outcome=outcome)
+                flush(force=True)
+        return wrapper
+    return deco
+
+def flush(force=False):
+    """
+    Add this process's buffered updates to redis, if metrics_flush_interval has passed or forced
+    """
+    global _flushed
+    now = time.time()
+    if not force and now - _flushed < config.metrics_flush_interval:
+        return
+    with _lock:
+        counts, gauges = dict(_counts), dict(_gauges)
+        _counts.clear()
+        _gauges.clear()
+        _flushed = now
+    if not counts and not gauges:
+        return
+    try:
+        pipe = metrics_store().pipeline(transaction=False)
+        for key, amount in counts.items():
+            pipe.hincrbyfloat(config.redis_keys.metrics, key, amount)
+        if gauges:
+            pipe.hmset(config.redis_keys.metrics_gauges, gauges)
+        pipe.execute()
+    except redis.RedisError:
+        _log.exception("Could not store metrics")
+
+def sort_key(sample):
+    """
+    Series grouped by labels, histogram buckets first in ascending le order
+    """
+    name, _, labels = sample.partition('{')
+    labels = labels.rstrip('}')
+    le = 0.0
+    if name.endswith('_bucket'):
+        labels, _, le = labels.rpartition('le="')
+        labels = labels.rstrip(',')
+        le = INF if le.rstrip('"') == '+Inf' else float(le.rstrip('"'))
+    return labels, not name.endswith('_bucket'), name, le
+
+def render(store=None):
+    """
+    Every stored metric in the Prometheus text exposition format
+    """
+    store = store or metrics_store()
+    samples = {}
+    for key, value in store.hgetall(config.redis_keys.metrics).items():
+        samples[key.decode()] = float(value)
+    for key, value in store.hgetall(config.redis_keys.metrics_gauges).items():
+        samples[key.decode()] = float(value)
+
+    lines = []
+    for name, (kind, help_text, buckets) in FAMILIES.items():
+        family = [s for s in samples if s.partition('{')[0] in (name, name + '_bucket', name + '_sum', name + '_count')]
+        if not family:
+            continue
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for sample in sorted(family, key=sort_key):
+            lines.append('%s %s' % (sample, repr(samples[sample])))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,154 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import time
+import uuid
+import redis
+import locks
+import config
+import logging
+import metrics
+import repo_store
+import github_handler
+
+_log = logging.getLogger(__name__)
+
+## Full refresh split across celery workers. start() takes the refresh lease and
+## records the run in redis, each shard task crawls refresh_shard_size repos and
+## adds its RepoDetails to the run. finish() publishes once every shard is done
+## or refresh_shard_deadline has passed, repos whose shard hadn't finished keep
+## their previous details and are crawled first next time.
+##
+## Run keys, all under <refresh_run>:<run id>:
+##   lease      token of the refresh lease, adopted by finish()
+##   started    time the run started
+##   shards     shards still running
+##   crawled    repos of the shards done
+##   details    hash of repo name: encoded RepoDetail
+##   changed    repos whose details aren't the previous ones
+##   unfinished repos skipped for lack of rate limit or after a github error
+##   finished   set by whichever finish() gets to publish
+
+def run_key(run_id, name):
+    return "%s:%s:%s" % (config.redis_keys.refresh_run, run_id, name)
+
+def run_ttl():
+    return config.refresh_shard_deadline + config.lease_ttl
+
+def start(redisStore):
+    """
+    Take the refresh lease and record a new run, returns (run_id, shards of repo names)
+    or None if a refresh is already running. The lease is held without a heartbeat until
+    finish() adopts it, so it expires by itself if the run is lost.
+    """
+    lease = locks.Lease(config.redis_keys.refresh_lease, run_ttl(), redisStore)
+    if not lease.acquire(heartbeat=False):
+        return None
+
+    names = [name for user, name in github_handler.repository_names()]
+    # Repos left over from the last run go out first
+    resume = set(name.decode() for name in redisStore.smembers(config.redis_keys.crawl_resume))
+    names.sort(key=lambda name: (name not in resume, name))
+    size = config.refresh_shard_size
+    shards = [names[i:i + size] for i in range(0, len(names), size)]
+
+    run_id = uuid.uuid4().hex
+    pipe = redisStore.pipeline(transaction=True)
+    pipe.set(run_key(run_id, 'lease'), lease.token, ex=run_ttl())
+    pipe.set(run_key(run_id, 'started'), time.time(), ex=run_ttl())
+    pipe.set(run_key(run_id, 'shards'), len(shards), ex=run_ttl())
+    pipe.execute()
+    _log.info("Refresh %s: %d repos in %d shards" % (run_id, len(names), len(shards)))
+    return run_id, shards
+
+@metrics.refresh('shard')
+def crawl(redisStore, run_id, names, build_asset=None):
+    """
+    Crawl one shard of a run and add its details to it, returns True if it was the last shard
+    """
+    if redisStore.exists(run_key(run_id, 'finished')) or not redisStore.exists(run_key(run_id, 'shards')):
+        _log.warning("Refresh %s already published, dropping shard %s" % (run_id, ", ".join(names)))
+        return False
+
+    _previous = {}
+    for name in names:
+        repo_det = repo_store.load_addon(redisStore, name)
+        if repo_det is not None:
+            _previous[name] = repo_det
+    _unfinished = []
+    _details = github_handler.fetch_details(names, _previous, build_asset, (), _unfinished)
+
+    _changed = [name for name, repo_det in _details.items() if _previous.get(name) is not repo_det]
+    with redisStore.pipeline(transaction=True) as pipe:
+        # Nothing is added once finish() has started, or the keys it deletes would be recreated
+        try:
+            pipe.watch(run_key(run_id, 'finished'))
+            if pipe.exists(run_key(run_id, 'finished')) or not pipe.exists(run_key(run_id, 'shards')):
+                raise redis.WatchError()
+            pipe.multi()
+            if _details:
+                pipe.hmset(run_key(run_id, 'details'),
+                           {name: repo_store.encode_repo(repo_det) for name, repo_det in _details.items()})
+                pipe.expire(run_key(run_id, 'details'), run_ttl())
+            if _changed:
+                pipe.sadd(run_key(run_id, 'changed'), *_changed)
+                pipe.expire(run_key(run_id, 'changed'), run_ttl())
+            if _unfinished:
+                pipe.sadd(run_key(run_id, 'unfinished'), *_unfinished)
+                pipe.expire(run_key(run_id, 'unfinished'), run_ttl())
+            pipe.sadd(run_key(run_id, 'crawled'), *names)
+            pipe.expire(run_key(run_id, 'crawled'), run_ttl())
+            pipe.decr(run_key(run_id, 'shards'))
+            return pipe.execute()[-1] <= 0
+        except redis.WatchError:
+            _log.warning("Refresh %s published while crawling, dropping shard %s" % (run_id, ", ".join(names)))
+            return False
+
+def finish(redisStore, run_id, purge=None, sync=None):
+    """
+    Publish a run with whatever its shards have added so far, once. Returns False if
+    it had already been published or its lease has expired.
+    """
+    if not redisStore.set(run_key(run_id, 'finished'), 1, nx=True, ex=run_ttl()):
+        return False
+    token = redisStore.get(run_key(run_id, 'lease'))
+    lease = locks.Lease(config.redis_keys.refresh_lease, store=redisStore, token=token,
+                        max_hold=locks.refresh_max_hold())
+    if token is None or not lease.adopt():
+        _log.error("Refresh %s outlived its lease, not publishing it" % run_id)
+        return False
+
+    try:
+        with metrics.stage('shard_aggregate'):
+            pipe = redisStore.pipeline(transaction=True)
+            pipe.hgetall(run_key(run_id, 'details'))
+            pipe.smembers(run_key(run_id, 'crawled'))
+            pipe.smembers(run_key(run_id, 'changed'))
+            pipe.smembers(run_key(run_id, 'unfinished'))
+            pipe.get(run_key(run_id, 'started'))
+            records, crawled, changed, unfinished, started = pipe.execute()
+
+            _previous = github_handler.previous_details(redisStore) or {}
+            _details = dict((name.decode(), repo_store.decode_repo(data)) for name, data in records.items())
+            _changed = [name.decode() for name in changed]
+            _unfinished = [name.decode() for name in unfinished]
+            _crawled = set(name.decode() for name in crawled)
+            for user, name in github_handler.repository_names():
+                if name not in _crawled:
+                    # Shard still running at the deadline, crawled first next time
+                    _log.warning("Refresh %s: %s didn't finish in time" % (run_id, name))
+                    _unfinished.append(name)
+            # Unchanged repos come back from redis as copies, keep the previous objects
+            for name, repo_det in _details.items():
+                if name not in _changed and name in _previous:
+                    _details[name] = _previous[name]
+
+            github_handler.complete_refresh(redisStore, _previous, _details, _unfinished, _changed, purge, sync)
+        if started is not None:
+            metrics.observe('kodi_repo_refresh_stage_seconds', time.time() - float(started), stage='sharded_refresh')
+    finally:
+        redisStore.delete(*[run_key(run_id, name) for name in
+                            ('lease', 'started', 'shards', 'crawled', 'details', 'changed', 'unfinished')])
+        lease.release()
+    return True
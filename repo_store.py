@@ -0,0 +1,298 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import os
+import config
+import msgpack
+import tempfile
+from collections import OrderedDict
+
+# Blobs written by this module start with MAGIC followed by the schema version byte.
+# Anything else is a jsonpickle blob from before the switch.
+MAGIC = b'KGR'
+SCHEMA_VERSION = 4
+
+class RepoDetail(object):
+    """
+    Basic structure to hold all desired repo details in cache
+    """
+    # Stored in this order as one record per repo, append new fields to the end
+    # and bump SCHEMA_VERSION so older records can still be read
+    FIELDS = (
+        'reponame',
+        'description',
+        'homepage',
+        'owner',
+        'tagnames',
+        'downloads',
+        'newest_version',
+        'newest_zip',
+        'newest_tagname',
+        'newest_tag_sha',
+        # Only in records before schema 4, addon_xml_fragment holds it since
+        'addon_xml',
+        # schema 2
+        'versions',
+        'latest_stable',
+        'latest_prerelease',
+        # schema 3
+        'addon_xml_fragment',
+    )
+    # Kept in FIELDS for the position of older records, always stored as None
+    DROPPED_FIELDS = ('addon_xml',)
+    # Only used while crawling, never stored
+    CRAWL_FIELDS = ('repo', 'tags', 'releases')
+
+    __slots__ = FIELDS + CRAWL_FIELDS
+
+    def __init__(self, repo=None):
+        # These hold binary github objects
+        self.repo = repo
+        self.tags = {}
+        self.releases = {}
+
+        # These hold simple information
+        self.reponame = repo.name if repo else ""
+        self.description = repo.description if repo else ""
+        self.homepage = repo.homepage if repo else ""
+        self.owner = repo.owner.login if repo else ""
+        self.tagnames = {}
+        self.downloads = {}
+        self.newest_version = None
+        self.newest_zip = None
+        self.newest_tagname = None
+        self.newest_tag_sha = None
+        self.addon_xml = None
+
+        # Precomputed at refresh so requests never parse version strings
+        self.versions = []
+        self.latest_stable = None
+        self.latest_prerelease = None
+
+        # addon.xml of newest_tagname as it appears in addons.xml
+        self.addon_xml_fragment = None
+
+    @property
+    def latest_version(self):
+        """
+        Version served for <addon_id>.zip without a version
+        """
+        return self.latest_stable or self.latest_prerelease
+
+    def __getstate__(self):
+        return {field: getattr(self, field, None) for field in self.FIELDS}
+
+    def __setstate__(self, d):
+        self.repo = None
+        self.tags = {}
+        self.releases = {}
+        for field in self.FIELDS:
+            setattr(self, field, d.get(field))
+        # jsonpickle restores the github3 User object for owner
+        self.owner = str(self.owner) if self.owner else ""
+        self.downloads = self.downloads or {}
+        if self.versions is None:
+            # Stored before schema 2
+            self.versions, self.latest_stable, self.latest_prerelease = version_index(self.downloads)
+        if self.addon_xml_fragment is None and self.addon_xml:
+            # Stored before schema 4
+            self.addon_xml_fragment = addon_xml_fragment(self.addon_xml)
+        self.addon_xml = None
+
+    def to_record(self):
+        return [None if field in self.DROPPED_FIELDS else getattr(self, field, None) for field in self.FIELDS]
+
+    @classmethod
+    def from_record(cls, record):
+        repo_det = cls.__new__(cls)
+        repo_det.__setstate__(dict(zip(cls.FIELDS, record)))
+        return repo_det
+
+def addon_xml_fragment(addon_xml):
+    """
+    An addon.xml normalised for inclusion in addons.xml, ie. without its xml declaration
+    """
+    xml = addon_xml.rstrip()
+    if isinstance(xml, bytes):
+        xml = xml.decode()
+    if xml.startswith('<?xml'):
+        xml = xml[xml.index('\n'):]
+    return xml
+
+def version_index(downloads):
+    """
+    Versions that have a download in ascending order, plus the newest stable and newest prerelease of them
+    """
+    import semantic_version
+    parsed = []
+    for vers, url in downloads.items():
+        if not url:
+            continue
+        try:
+            parsed.append((semantic_version.Version(vers), vers))
+        except ValueError:
+            continue
+    parsed.sort()
+
+    versions = [vers for semvers, vers in parsed]
+    stable = [vers for semvers, vers in parsed if not semvers.prerelease]
+    prerelease = [vers for semvers, vers in parsed if semvers.prerelease]
+    return versions, (stable[-1] if stable else None), (prerelease[-1] if prerelease else None)
+
+def is_legacy(data):
+    return not data.startswith(MAGIC)
+
+def pack(obj):
+    return MAGIC + bytes([SCHEMA_VERSION]) + msgpack.packb(obj, use_bin_type=True)
+
+def unpack(data):
+    schema = data[len(MAGIC)]
+    if schema > SCHEMA_VERSION:
+        raise ValueError("Unsupported repo details schema version %d" % schema)
+    return msgpack.unpackb(data[len(MAGIC) + 1:], raw=False)
+
+def legacy_decode(data):
+    """
+    Blobs published before the switch to msgpack were jsonpickle encoded
+    """
+    import jsonpickle
+    return jsonpickle.decode(data.decode())
+
+def encode_details(details):
+    """
+    OrderedDict of name: RepoDetail to bytes
+    """
+    return pack([[name, repo_det.to_record()] for name, repo_det in details.items()])
+
+def decode_details(data):
+    """
+    bytes from encode_details (or an old jsonpickle blob) back to OrderedDict of name: RepoDetail
+    """
+    if is_legacy(data):
+        return legacy_decode(data)
+    return OrderedDict((name, RepoDetail.from_record(record)) for name, record in unpack(data))
+
+def encode_repo(repo_det):
+    return pack(repo_det.to_record())
+
+def decode_repo(data):
+    return RepoDetail.from_record(unpack(data))
+
+def encode_addons_xml(addons_xml):
+    """
+    (addons_xml, md5) tuple to bytes
+    """
+    return pack(list(addons_xml))
+
+def decode_addons_xml(data):
+    if is_legacy(data):
+        return legacy_decode(data)
+    return tuple(unpack(data))
+
+## Redis layout: each addon's record is a field of the details hash, the index
+## holds the addon names in catalogue order. Everything is replaced in a single
+## MULTI/EXEC along with addons.xml and the generation counter.
+
+def publish(redisStore, details, addons_xml):
+    """
+    Atomically replace the published catalogue and bump its generation, returns the new generation
+    """
+    pipe = redisStore.pipeline(transaction=True)
+    pipe.delete(config.redis_keys.details_hash)
+    if details:
+        pipe.hmset(config.redis_keys.details_hash,
+                   {name: encode_repo(repo_det) for name, repo_det in details.items()})
+    pipe.set(config.redis_keys.index, pack(list(details)))
+    pipe.set(config.redis_keys.addons_xml, encode_addons_xml(addons_xml))
+    pipe.delete(config.redis_keys.details)
+    pipe.incr(config.redis_keys.generation)
+    return pipe.execute()[-1]
+
+def is_published(redisStore):
+    """
+    False until a catalogue has been published in the per addon layout
+    """
+    return bool(redisStore.exists(config.redis_keys.index))
+
+def load_legacy_details(redisStore):
+    """
+    Whole catalogue blob written before the per addon layout, or None
+    """
+    data = redisStore.get(config.redis_keys.details)
+    return decode_details(data) if data else None
+
+def load_details(redisStore):
+    """
+    OrderedDict of every published name: RepoDetail, or None if nothing is published
+    """
+    pipe = redisStore.pipeline(transaction=True)
+    pipe.get(config.redis_keys.index)
+    pipe.hgetall(config.redis_keys.details_hash)
+    index, records = pipe.execute()
+    if index is None:
+        return load_legacy_details(redisStore)
+    records = {name.decode(): data for name, data in records.items()}
+    return OrderedDict((name, decode_repo(records[name])) for name in unpack(index) if name in records)
+
+def load_addon(redisStore, name):
+    """
+    RepoDetail of a single published addon, or None
+    """
+    data = redisStore.hget(config.redis_keys.details_hash, name)
+    if data is not None:
+        return decode_repo(data)
+    if not is_published(redisStore):
+        details = load_legacy_details(redisStore)
+        return details.get(name) if details else None
+    return None
+
+def load_addons_xml(redisStore):
+    """
+    Published (addons_xml, md5) tuple, or None
+    """
+    data = redisStore.get(config.redis_keys.addons_xml)
+    return decode_addons_xml(data) if data else None
+
+## Last known good copy of the published catalogue on local disk, written after
+## each publish so web workers can serve before redis has anything to offer
+
+def snapshot_path():
+    """
+    Absolute path of snapshot_file, relative paths are from this directory. None if not configured.
+    """
+    path = config.snapshot_file
+    if path and not os.path.isabs(path):
+        path = os.path.abspath(os.path.join(os.path.dirname(__file__), path))
+    return path
+
+def save_snapshot(generation, details, addons_xml):
+    """
+    Atomically write the catalogue published as generation to snapshot_file
+    """
+    path = snapshot_path()
+    if not path:
+        return
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    data = pack([generation, [[name, repo_det.to_record()] for name, repo_det in details.items()], list(addons_xml)])
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+        os.replace(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+def load_snapshot():
+    """
+    (generation, details, addons_xml) from snapshot_file, or None if there isn't one
+    """
+    path = snapshot_path()
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as infile:
+        generation, records, addons_xml = unpack(infile.read())
+    details = OrderedDict((name, RepoDetail.from_record(record)) for name, record in records)
+    return generation, details, tuple(addons_xml)
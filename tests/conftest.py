@@ -0,0 +1,91 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config reads its file on import, so point it at a throwaway one before anything imports it
+WORKDIR = tempfile.mkdtemp(prefix='kodi_repo_tests_')
+REPOSITORIES = ['plugin.video.one', 'plugin.video.two', 'plugin.video.three']
+
+with open(os.path.join(WORKDIR, 'config.yaml'), 'w') as configfile:
+    configfile.write('kodi_github_repo:\n')
+    configfile.write('  github_personal_access_token: test\n')
+    for setting in ('build_cache_dir', 'artifact_store_dir', 'snapshot_file'):
+        configfile.write('  %s: %s\n' % (setting, os.path.join(WORKDIR, setting)))
+    configfile.write('  repositories:\n')
+    for name in REPOSITORIES:
+        configfile.write('    - https://github.com/alelec/%s\n' % name)
+os.environ['KODI_GITHUB_REPO_CONFIG'] = os.path.join(WORKDIR, 'config.yaml')
+
+import redis
+import fakeredis
+
+SERVER = fakeredis.FakeServer()
+
+class StrictRedis(fakeredis.FakeStrictRedis):
+    """
+    Every connection shares one in memory server, like the processes of a deployment share redis
+    """
+    def __init__(self, *args, **kwargs):
+        super(StrictRedis, self).__init__(server=SERVER)
+
+    if redis.VERSION >= (3,):
+        def zadd(self, name, *args, **kwargs):
+            # The code is written against redis-py 2.10's zadd(name, score, member)
+            if args and not isinstance(args[0], dict):
+                return super(StrictRedis, self).zadd(name, dict(zip(args[1::2], args[0::2])))
+            return super(StrictRedis, self).zadd(name, *args, **kwargs)
+
+redis.StrictRedis = StrictRedis
+
+import config
+import repo_store
+from collections import OrderedDict
+
+@pytest.fixture(autouse=True)
+def store():
+    """
+    Empty redis for every test
+    """
+    redisStore = redis.StrictRedis()
+    redisStore.flushall()
+    return redisStore
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """
+    Fresh directories for everything the code writes to disk
+    """
+    monkeypatch.setattr(config, 'build_cache_dir', str(tmp_path / 'build_cache'))
+    monkeypatch.setattr(config, 'artifact_store_dir', str(tmp_path / 'artifacts'))
+    monkeypatch.setattr(config, 'snapshot_file', str(tmp_path / 'snapshot.kgr'))
+    return tmp_path
+
+def repo_detail(name, versions=('1.0.0',), description='An addon'):
+    """
+    RepoDetail of a published addon with a download for each of versions
+    """
+    repo_det = repo_store.RepoDetail()
+    repo_det.reponame = name
+    repo_det.description = description
+    repo_det.owner = 'alelec'
+    repo_det.tagnames = {vers: 'v' + vers for vers in versions}
+    repo_det.downloads = {vers: 'https://github.com/alelec/%s/releases/download/v%s/%s.zip' % (name, vers, name)
+                          for vers in versions}
+    repo_det.versions, repo_det.latest_stable, repo_det.latest_prerelease = repo_store.version_index(repo_det.downloads)
+    repo_det.newest_version = repo_det.latest_version
+    repo_det.newest_tagname = 'v' + repo_det.newest_version
+    repo_det.newest_tag_sha = '%040x' % len(versions)
+    repo_det.addon_xml_fragment = '\n<addon id="%s" version="%s"/>' % (name, repo_det.newest_version)
+    return repo_det
+
+def catalogue(*repo_dets):
+    return OrderedDict((repo_det.reponame, repo_det) for repo_det in repo_dets)
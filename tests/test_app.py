@@ -0,0 +1,275 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import os
+import hmac
+import json
+import time
+import redis
+import hashlib
+import pytest
+import config
+import github_handler
+import artifact_store
+from conftest import repo_detail, catalogue
+
+@pytest.fixture
+def kodi_repo_app(monkeypatch):
+    """
+    The web app module, with a worker snapshot that has seen nothing published yet
+    """
+    kodi_repo_app = pytest.importorskip('kodi_repo_app')
+    monkeypatch.setattr(kodi_repo_app, 'snapshot', kodi_repo_app.RepoSnapshot(kodi_repo_app.redisStore))
+    return kodi_repo_app
+
+@pytest.fixture
+def app(kodi_repo_app):
+    return kodi_repo_app.app.test_client()
+
+@pytest.fixture
+def published(store):
+    details = catalogue(repo_detail('plugin.video.one', ['1.0.0', '1.1.0']), repo_detail('plugin.video.two'))
+    github_handler.publish_details(store, details)
+    return details
+
+class RedisDown(object):
+    def __getattr__(self, name):
+        def unavailable(*args, **kwargs):
+            raise redis.ConnectionError("Connection refused")
+        return unavailable
+
+def test_snapshot_follows_generation(kodi_repo_app, store, monkeypatch):
+    monkeypatch.setattr(config, 'details_check_interval', 60)
+    snapshot = kodi_repo_app.snapshot
+    github_handler.publish_details(store, catalogue(repo_detail('plugin.video.one')))
+    assert snapshot.addon('plugin.video.one').newest_version == '1.0.0'
+    assert snapshot.generation == b'1'
+
+    github_handler.publish_details(store, catalogue(repo_detail('plugin.video.one', ['1.0.0', '1.1.0'])))
+    # Trusted until details_check_interval has passed
+    assert snapshot.addon('plugin.video.one').newest_version == '1.0.0'
+
+    snapshot.checked = 0
+    assert snapshot.addon('plugin.video.one').newest_version == '1.1.0'
+    assert snapshot.generation == b'2'
+    assert '<addon id="plugin.video.one" version="1.1.0"/>' in snapshot.addons_xml()[0]
+    assert list(snapshot.details()) == ['plugin.video.one']
+
+def test_addons_xml_conditional_get(app, published):
+    response = app.get('/repo/addons.xml')
+    assert response.status_code == 200
+    assert b'<addon id="plugin.video.one" version="1.1.0"/>' in response.data
+    etag = response.headers['ETag']
+
+    response = app.get('/repo/addons.xml', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # addons.xml.md5 has the same validator
+    md5 = app.get('/repo/addons.xml.md5')
+    assert md5.headers['ETag'] == etag == '"%s"' % md5.data.decode()
+
+def test_zip_redirects(app, published):
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip')
+    assert response.status_code == 302
+    assert response.headers['Location'] == published['plugin.video.one'].downloads['1.1.0']
+
+    response = app.get('/repo/plugin.video.one/plugin.video.one-1.0.0.zip')
+    assert response.headers['Location'] == published['plugin.video.one'].downloads['1.0.0']
+
+    assert app.get('/repo/plugin.video.one/plugin.video.one-9.0.0.zip').status_code == 404
+    assert app.get('/repo/plugin.video.one/plugin.video.two.zip').status_code == 404
+    assert app.get('/repo/plugin.video.nope/plugin.video.nope.zip').status_code == 404
+
+@pytest.fixture
+def local_zip(monkeypatch, published):
+    monkeypatch.setattr(config, 'zip_serving', 'local')
+    path = artifact_store.artifact_path('plugin.video.one', '1.1.0')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as outfile:
+        outfile.write(bytes(range(256)) * 4)
+    return path
+
+def test_local_zip_range(app, local_zip):
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip')
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert len(response.data) == 1024
+    etag = response.headers['ETag']
+
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip', headers={'Range': 'bytes=256-511'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 256-511/1024'
+    assert response.data == bytes(range(256))
+
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip', headers={'Range': 'bytes=2048-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */1024'
+
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip', headers={'Range': 'bytes=0-1,5-6'})
+    assert response.status_code == 200
+    assert response.data == bytes(range(256)) * 4
+
+    # Resuming a download of some other file gets the whole of this one
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip',
+                       headers={'Range': 'bytes=256-511', 'If-Range': '"other"'})
+    assert response.status_code == 200
+    assert len(response.data) == 1024
+
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+def test_local_zip_not_stored_yet(app, local_zip, store):
+    response = app.get('/repo/plugin.video.one/plugin.video.one-1.0.0.zip')
+    assert response.status_code == 302
+    assert 'no-store' in response.headers['Cache-Control']
+    assert store.zscore(config.redis_keys.artifact_lru, 'plugin.video.one/plugin.video.one-1.0.0.zip')
+
+def test_nothing_published(app):
+    response = app.get('/repo/addons.xml')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '60'
+    assert app.get('/repo/addons.xml.md5').status_code == 503
+    assert app.get('/repo/plugin.video.one/plugin.video.one.zip').status_code == 404
+
+    # An empty home page is fine
+    assert app.get('/').status_code == 200
+
+def test_last_known_good_while_redis_down(kodi_repo_app, app, published, monkeypatch):
+    assert app.get('/repo/addons.xml').status_code == 200
+    assert kodi_repo_app.snapshot.addon('plugin.video.one') is not None
+
+    monkeypatch.setattr(kodi_repo_app.snapshot, 'store', RedisDown())
+    kodi_repo_app.snapshot.checked = 0
+    kodi_repo_app.snapshot.clear()
+    assert b'plugin.video.one' in app.get('/repo/addons.xml').data
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip')
+    assert response.headers['Location'] == published['plugin.video.one'].downloads['1.1.0']
+
+def test_disk_snapshot_while_redis_down(kodi_repo_app, app, published, monkeypatch):
+    # A worker starting while redis is down
+    monkeypatch.setattr(kodi_repo_app, 'snapshot', kodi_repo_app.RepoSnapshot(RedisDown()))
+
+    response = app.get('/repo/addons.xml')
+    assert response.status_code == 200
+    assert b'<addon id="plugin.video.one" version="1.1.0"/>' in response.data
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip')
+    assert response.headers['Location'] == published['plugin.video.one'].downloads['1.1.0']
+    assert b'plugin.video.two' in app.get('/').data
+
+def test_home_conditional_get(kodi_repo_app, app, published, monkeypatch):
+    rendered = []
+    render_template = kodi_repo_app.render_template
+    def render(template, **context):
+        rendered.append(template)
+        return render_template(template, **context)
+    monkeypatch.setattr(kodi_repo_app, 'render_template', render)
+
+    response = app.get('/')
+    assert response.status_code == 200
+    assert b'plugin.video.one' in response.data
+    assert app.get('/', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    # Rendered once per generation
+    assert rendered == ['home.html']
+
+    github_handler.publish_details(kodi_repo_app.redisStore, catalogue(repo_detail('plugin.video.three')))
+    kodi_repo_app.snapshot.checked = 0
+    response = app.get('/', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 200
+    assert b'plugin.video.three' in response.data
+
+def test_media_stays_in_store(app, published, monkeypatch, tmp_path):
+    media_store = pytest.importorskip('media_store')
+    monkeypatch.setattr(config, 'media_store_dir', str(tmp_path / 'media'))
+    (tmp_path / 'icon.png').write_bytes(b'outside')
+    media_store.store('plugin.video.one', '1.1.0', {'icon': b'inside', 'changelog': b'changes'})
+    media_store.store('plugin.video.gone', '1.0.0', {'icon': b'unpublished'})
+
+    response = app.get('/repo/plugin.video.one/icon.png')
+    assert response.status_code == 200
+    assert response.data == b'inside'
+    assert app.get('/repo/plugin.video.one/changelog-1.1.0.txt').data == b'changes'
+    assert app.get('/repo/plugin.video.one/fanart.jpg').status_code == 404
+    assert app.get('/repo/plugin.video.two/icon.png').status_code == 404
+    assert app.get('/repo/plugin.video.gone/icon.png').status_code == 404
+    assert app.get('/repo/../icon.png').status_code == 404
+
+def test_media_disabled(app, published):
+    assert app.get('/repo/plugin.video.one/icon.png').status_code == 404
+
+@pytest.fixture
+def purging(monkeypatch):
+    monkeypatch.setattr(config, 'purge_hook', lambda keys: None)
+
+def test_surrogate_keys(app, published, purging):
+    response = app.get('/repo/addons.xml')
+    assert response.headers['Surrogate-Key'].split() == ['addons-xml', 'gen/1']
+    assert response.headers['Surrogate-Control'] == 'max-age=%d' % config.surrogate_max_age
+    assert 'max-age=%d' % config.client_max_age in response.headers['Cache-Control']
+    assert app.get('/').headers['Surrogate-Key'].split() == ['home', 'gen/1']
+
+    response = app.get('/repo/plugin.video.one/plugin.video.one.zip')
+    assert response.headers['Surrogate-Key'].split() == ['addon/plugin.video.one', 'gen/1']
+    response = app.get('/repo/plugin.video.one/plugin.video.one-1.0.0.zip')
+    assert response.headers['Surrogate-Key'].split() == ['version/plugin.video.one/1.0.0', 'gen/1']
+
+def test_no_purge_hook_isnt_kept(app, published):
+    # Nothing would purge the proxy's copy, so it gets the same max-age as clients
+    response = app.get('/repo/addons.xml')
+    assert 'Surrogate-Control' not in response.headers
+    assert 'Surrogate-Key' not in response.headers
+    assert response.headers['Cache-Control'] == 'public, max-age=%d' % config.client_max_age
+
+def test_nothing_published_isnt_kept(app, purging):
+    # No purge follows the first publish, so an empty home page mustn't be kept
+    response = app.get('/')
+    assert 'Surrogate-Control' not in response.headers
+    assert 'Surrogate-Key' not in response.headers
+
+def test_local_zip_not_stored_yet_isnt_kept(app, local_zip, purging):
+    response = app.get('/repo/plugin.video.one/plugin.video.one-1.0.0.zip')
+    assert 'Surrogate-Control' not in response.headers
+
+@pytest.fixture
+def webhook(app, monkeypatch):
+    """
+    POSTs a json payload to the github webhook, signed with the secret unless given a signature
+    """
+    monkeypatch.setattr(config, 'github_webhook_secret', 'secret')
+    def post(event, payload, signature=None):
+        data = json.dumps(payload).encode()
+        if signature is None:
+            signature = 'sha256=' + hmac.new(b'secret', data, hashlib.sha256).hexdigest()
+        return app.post('/hooks/github', data=data, content_type='application/json',
+                        headers={'X-GitHub-Event': event, 'X-Hub-Signature-256': signature})
+    return post
+
+def test_webhook_disabled_without_secret(app):
+    assert app.post('/hooks/github', data=b'{}').status_code == 404
+
+def test_webhook_signature(webhook, store):
+    assert webhook('ping', {}).data == b'pong'
+    assert webhook('ping', {}, signature='sha256=' + '0' * 64).status_code == 403
+    assert webhook('ping', {}, signature='sha1=' + '0' * 40).status_code == 403
+    # Malformed rather than a server error
+    assert webhook('ping', {}, signature=u'sha256=\xe9t\xe9').status_code == 403
+
+def test_webhook_debounces_refresh(webhook, store, monkeypatch):
+    monkeypatch.setattr(config, 'webhook_debounce', 30)
+    payload = {'ref': 'v1.1.0', 'ref_type': 'tag', 'repository': {'name': 'plugin.video.one'}}
+    assert webhook('create', payload).status_code == 202
+    due = store.zscore(config.redis_keys.pending_refresh, 'plugin.video.one')
+    assert time.time() + 25 < due <= time.time() + 30
+
+    # Another event pushes the refresh back rather than adding one
+    time.sleep(0.01)
+    webhook('push', {'ref': 'refs/tags/v1.1.0', 'repository': {'name': 'plugin.video.one'}})
+    assert store.zscore(config.redis_keys.pending_refresh, 'plugin.video.one') > due
+    assert store.zcard(config.redis_keys.pending_refresh) == 1
+
+def test_webhook_ignores_other_events(webhook, store):
+    assert webhook('push', {'ref': 'refs/heads/master', 'repository': {'name': 'plugin.video.one'}}).data == b'ignored'
+    assert webhook('create', {'ref_type': 'branch', 'repository': {'name': 'plugin.video.one'}}).data == b'ignored'
+    assert webhook('release', {}).data == b'ignored'
+    assert not store.zcard(config.redis_keys.pending_refresh)
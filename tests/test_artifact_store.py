@@ -0,0 +1,49 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import os
+import pytest
+import config
+import artifact_store
+from conftest import repo_detail, catalogue
+
+def store_zip(addon_id, vers, size, mtime):
+    path = artifact_store.artifact_path(addon_id, vers)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as outfile:
+        outfile.write(b'x' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+def test_wanted():
+    details = catalogue(repo_detail('plugin.video.one', ['1.0.0', '1.1.0', '2.0.0-beta']))
+    wanted = artifact_store.wanted(details, ['plugin.video.one/plugin.video.one-1.0.0.zip',
+                                             'plugin.video.gone/plugin.video.gone-1.0.0.zip'])
+    assert sorted(vers for addon_id, vers, url in wanted) == ['1.0.0', '1.1.0', '2.0.0-beta']
+    assert sorted(vers for addon_id, vers, url in artifact_store.wanted(details, [])) == ['1.1.0', '2.0.0-beta']
+
+def test_evict_least_recently_requested(store, monkeypatch):
+    monkeypatch.setattr(config, 'artifact_store_max_bytes', 250)
+    details = catalogue(repo_detail('plugin.video.one', ['1.0.0', '1.1.0', '1.2.0']))
+    paths = [store_zip('plugin.video.one', vers, 100, 1000) for vers in ('1.0.0', '1.1.0', '1.2.0')]
+    unpublished = store_zip('plugin.video.one', '0.9.0', 100, 2000)
+    artifact_store.touch(store, 'plugin.video.one', '1.0.0')
+
+    artifact_store.evict(store, details)
+    # Unpublished versions go first, then the least recently requested, never the newest
+    assert not os.path.exists(unpublished)
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+
+def test_sync_queued_once(store, monkeypatch):
+    tasks = pytest.importorskip('kodi_repo_task')
+    queued = []
+    monkeypatch.setattr(tasks.sync_artifact_store, 'delay', lambda: queued.append(1))
+    tasks.enqueue_artifact_sync(store, {})
+    assert queued == []
+
+    monkeypatch.setattr(config, 'zip_serving', 'local')
+    tasks.enqueue_artifact_sync(store, {})
+    tasks.enqueue_artifact_sync(store, {})
+    assert len(queued) == 1
@@ -0,0 +1,69 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import json
+import pytest
+import config
+import cache_purge
+from conftest import repo_detail, catalogue
+
+def test_unchanged_catalogue_purges_nothing():
+    previous = catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two'))
+    details = catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two'))
+    assert cache_purge.changed_keys(previous, details) == []
+
+def test_new_version_purges_only_that_addon():
+    previous = catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two'))
+    details = catalogue(repo_detail('plugin.video.one', ['1.0.0', '1.1.0']), repo_detail('plugin.video.two'))
+    assert cache_purge.changed_keys(previous, details) == [
+        'addon/plugin.video.one', 'version/plugin.video.one/1.1.0', cache_purge.ADDONS_XML, cache_purge.HOME]
+
+def test_added_and_removed_addons():
+    previous = catalogue(repo_detail('plugin.video.one'))
+    details = catalogue(repo_detail('plugin.video.two'))
+    assert cache_purge.changed_keys(previous, details) == [
+        'addon/plugin.video.one', 'version/plugin.video.one/1.0.0',
+        'addon/plugin.video.two', 'version/plugin.video.two/1.0.0',
+        cache_purge.ADDONS_XML, cache_purge.HOME]
+
+def test_first_publish_purges_everything():
+    details = catalogue(repo_detail('plugin.video.one'))
+    assert cache_purge.changed_keys(None, details) == [
+        'addon/plugin.video.one', 'version/plugin.video.one/1.0.0', cache_purge.ADDONS_XML, cache_purge.HOME]
+
+def test_description_change_keeps_version_keys():
+    previous = catalogue(repo_detail('plugin.video.one'))
+    details = catalogue(repo_detail('plugin.video.one', description='Changed'))
+    assert cache_purge.changed_keys(previous, details) == [
+        'addon/plugin.video.one', cache_purge.ADDONS_XML, cache_purge.HOME]
+
+def test_purge_to_callable(monkeypatch):
+    purged = []
+    monkeypatch.setattr(config, 'purge_hook', purged.append)
+    cache_purge.purge(['addon/plugin.video.one'], 3)
+    assert purged == [['addon/plugin.video.one']]
+
+def test_purge_to_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'purge_hook', str(tmp_path / 'purged.jsonl'))
+    cache_purge.purge(['home'], 3)
+    cache_purge.purge([], 4)
+    lines = (tmp_path / 'purged.jsonl').read_text().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])['keys'] == ['home']
+    assert json.loads(lines[0])['generation'] == 3
+
+def test_purge_failure_only_logged(monkeypatch):
+    def hook(keys):
+        raise IOError("proxy unreachable")
+    monkeypatch.setattr(config, 'purge_hook', hook)
+    cache_purge.purge(['home'])
+
+def test_purge_queued_after_workers_notice(monkeypatch):
+    tasks = pytest.importorskip('kodi_repo_task')
+    queued = []
+    monkeypatch.setattr(tasks.purge_surrogate_keys, 'apply_async',
+                        lambda args, countdown: queued.append((args, countdown)))
+    tasks.enqueue_purge(['home'], 3)
+    # Web workers only notice a new generation after details_check_interval
+    assert queued == [((['home'], 3), config.details_check_interval)]
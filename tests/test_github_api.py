@@ -0,0 +1,149 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import json
+import time
+import pytest
+import config
+import requests
+import github_api
+
+def response(status_code, payload=None, headers=None):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.headers.update(headers or {})
+    resp._content = json.dumps(payload).encode() if payload is not None else b''
+    resp.url = 'https://api.github.com/test'
+    return resp
+
+class Session(object):
+    """
+    Hands out canned responses and records the headers of each request
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(headers or {})
+        return self.responses.pop(0)
+
+    post = get
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch):
+    """
+    A scheduler that hasn't seen any responses yet
+    """
+    scheduler = github_api.RequestScheduler()
+    monkeypatch.setattr(github_api, 'scheduler', scheduler)
+    monkeypatch.setattr(config, 'github_retries', 2)
+    return scheduler
+
+def rate_limit_headers(remaining, reset_in, limit=5000):
+    return {'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Reset': str(int(time.time() + reset_in))}
+
+def test_conditional_get(store):
+    url = 'https://api.github.com/repos/alelec/plugin.video.one'
+    session = Session(response(200, {'name': 'plugin.video.one'}, {'ETag': '"abc"'}), response(304))
+    assert github_api.get_json(session, url)[0] == {'name': 'plugin.video.one'}
+    assert store.hexists(config.redis_keys.validators, url)
+
+    # Not modified hands back the stored payload
+    assert github_api.get_json(session, url)[0] == {'name': 'plugin.video.one'}
+    assert 'If-None-Match' not in session.requests[0]
+    assert session.requests[1]['If-None-Match'] == '"abc"'
+
+def test_validators_keyed_by_params():
+    url = 'https://api.github.com/repos/alelec/plugin.video.one/contents/addon.xml'
+    session = Session(response(200, {'sha': 'a'}, {'ETag': '"a"'}), response(200, {'sha': 'b'}, {'ETag': '"b"'}))
+    assert github_api.get_json(session, url, params={'ref': 'v1.0.0'})[0] == {'sha': 'a'}
+    assert github_api.get_json(session, url, params={'ref': 'v1.1.0'})[0] == {'sha': 'b'}
+    assert 'If-None-Match' not in session.requests[1]
+
+def test_not_found_and_errors(store):
+    url = 'https://api.github.com/test'
+    session = Session(response(200, {'name': 'gone'}, {'ETag': '"abc"'}),
+                      response(404, {'message': 'Not Found'}), response(502, {'message': 'Bad Gateway'}))
+    github_api.get_json(session, url)
+    assert github_api.get_json(session, url) == (None, None)
+    assert not store.hexists(config.redis_keys.validators, url)
+    with pytest.raises(github_api.GitHubError):
+        github_api.get_json(session, url)
+
+def test_rate_limited():
+    assert github_api.rate_limited(response(429))
+    assert github_api.rate_limited(response(403, headers={'X-RateLimit-Remaining': '0'}))
+    assert github_api.rate_limited(response(403, {'message': 'You have exceeded a secondary rate limit'}))
+    assert not github_api.rate_limited(response(403, {'message': 'Resource not accessible'}))
+    assert not github_api.rate_limited(response(502))
+
+def test_retries_after_rate_limit():
+    session = Session(response(429), response(200, {'name': 'plugin.video.one'}))
+    assert github_api.get_json(session, 'https://api.github.com/test')[0] == {'name': 'plugin.video.one'}
+    assert len(session.requests) == 2
+
+@pytest.mark.parametrize('call', [
+    lambda session: github_api.get_json(session, 'https://api.github.com/test'),
+    lambda session: github_api.get_raw(session, 'https://api.github.com/test'),
+    lambda session: github_api.post_json(session, 'https://api.github.com/graphql', {}),
+])
+def test_rate_limited_after_retries(call):
+    session = Session(*[response(429) for attempt in range(3)])
+    with pytest.raises(github_api.RateLimitExhausted):
+        call(session)
+    assert len(session.requests) == 3
+
+def test_budget_paced(scheduler, monkeypatch):
+    monkeypatch.setattr(config, 'github_rate_limit_reserve', 50)
+    monkeypatch.setattr(config, 'github_rate_limit_pace', 500)
+    scheduler.observe(response(200, {}, rate_limit_headers(1000, 600)))
+    assert scheduler.delay('https://api.github.com/test') == 0
+
+    # What's left past the reserve is spread over the rest of the window
+    scheduler.observe(response(200, {}, rate_limit_headers(150, 600)))
+    assert 5 < scheduler.delay('https://api.github.com/test') <= 6.1
+
+    scheduler.observe(response(200, {}, rate_limit_headers(50, 600)))
+    assert 590 < scheduler.delay('https://api.github.com/test') <= 600
+
+def test_secondary_rate_limit_backs_off(scheduler):
+    scheduler.observe(response(403, {'message': 'You have exceeded a secondary rate limit'}))
+    assert 55 < scheduler.delay('https://api.github.com/test') <= 60
+    scheduler.observe(response(403, {'message': 'You have exceeded a secondary rate limit'}))
+    assert 115 < scheduler.delay('https://api.github.com/test') <= 120
+
+    scheduler.observe(response(429, headers={'Retry-After': '500'}))
+    assert 495 < scheduler.delay('https://api.github.com/test') <= 500
+
+def test_graphql_budget_kept_apart(scheduler, monkeypatch):
+    monkeypatch.setattr(config, 'github_max_wait', 60)
+    headers = rate_limit_headers(0, 3600)
+    headers['X-RateLimit-Resource'] = 'graphql'
+    scheduler.observe(response(200, {}, headers))
+    assert scheduler.delay('https://api.github.com/graphql') > 3500
+    assert scheduler.delay('https://api.github.com/test') == 0
+
+    # A secondary rate limit on the core api only holds up core requests
+    scheduler.observe(response(403, {'message': 'You have exceeded a secondary rate limit'}))
+    assert 55 < scheduler.delay('https://api.github.com/test') <= 60
+    with pytest.raises(github_api.RateLimitExhausted):
+        github_api.post_json(Session(), 'https://api.github.com/graphql', {})
+
+def test_budget_exhausted_raises(scheduler, monkeypatch):
+    monkeypatch.setattr(config, 'github_max_wait', 60)
+    scheduler.observe(response(200, {}, rate_limit_headers(0, 3600)))
+    with pytest.raises(github_api.RateLimitExhausted):
+        github_api.get_json(Session(), 'https://api.github.com/test')
+
+def test_requests_time_out(monkeypatch):
+    sent = []
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', lambda self, request, **kwargs: sent.append(kwargs))
+    monkeypatch.setattr(config, 'github_timeout', [5, 30])
+    adapter = github_api.TimeoutAdapter()
+    request = requests.Request('GET', 'https://api.github.com/test').prepare()
+    adapter.send(request)
+    adapter.send(request, timeout=300)
+    assert [kwargs['timeout'] for kwargs in sent] == [(5, 30), 300]
@@ -0,0 +1,104 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import github3
+import pytest
+import config
+import github_api
+import github_graphql
+from conftest import repo_detail, catalogue
+
+@pytest.fixture
+def graphql(monkeypatch):
+    """
+    List of GraphQL results to answer queries with in order, the queries asked are appended to .queries
+    """
+    class Results(list):
+        pass
+
+    results = Results()
+    results.queries = []
+    def post_json(session, url, payload):
+        results.queries.append(payload)
+        return results.pop(0)
+    monkeypatch.setattr(github_api, 'login', github3.GitHub)
+    monkeypatch.setattr(github_api, 'post_json', post_json)
+    monkeypatch.setattr(config, 'media_store_dir', None)
+    return results
+
+def catalogue_node(name, versions, zips=None):
+    zips = versions if zips is None else zips
+    return {
+        'name': name, 'nameWithOwner': 'alelec/' + name, 'description': 'An addon', 'homepageUrl': '',
+        'pushedAt': '2015-06-01T00:00:00Z', 'owner': {'login': 'alelec'},
+        'refs': {'pageInfo': {'hasNextPage': False, 'endCursor': None},
+                 'nodes': [{'name': 'v' + vers, 'target': {'oid': '%040d' % i}} for i, vers in enumerate(versions)]},
+        'releases': {'pageInfo': {'hasNextPage': False, 'endCursor': None},
+                     'nodes': [{'tagName': 'v' + vers, 'releaseAssets': {'nodes': [
+                         {'name': name + '.zip', 'downloadUrl': 'https://example.com/%s-%s.zip' % (name, vers)}
+                     ] if vers in zips else []}} for vers in versions]},
+    }
+
+def test_batch_crawl(graphql):
+    graphql.append({'data': {'r0': catalogue_node('plugin.video.one', ['1.0.0', '1.1.0'])}})
+    graphql.append({'data': {'r0': {'object': {'text': '<?xml version="1.0"?>\n<addon id="plugin.video.one"/>\n'}}}})
+
+    details = github_graphql.kodi_repos([('alelec', 'plugin.video.one')])
+    repo_det = details['plugin.video.one']
+    assert repo_det.newest_version == '1.1.0'
+    assert repo_det.newest_tagname == 'v1.1.0'
+    assert repo_det.downloads == {'1.0.0': 'https://example.com/plugin.video.one-1.0.0.zip',
+                                  '1.1.0': 'https://example.com/plugin.video.one-1.1.0.zip'}
+    assert repo_det.addon_xml_fragment == '\n<addon id="plugin.video.one"/>'
+    assert graphql.queries[1]['variables']['x0'] == 'v1.1.0:addon.xml'
+
+def test_unchanged_repo_needs_one_query(graphql):
+    graphql.append({'data': {'r0': catalogue_node('plugin.video.one', ['1.0.0'])}})
+    previous = repo_detail('plugin.video.one')
+    previous.newest_tag_sha = '%040d' % 0
+
+    details = github_graphql.kodi_repos([('alelec', 'plugin.video.one')], catalogue(previous))
+    assert details['plugin.video.one'] is previous
+    assert len(graphql.queries) == 1
+
+def test_missing_zips_queued(graphql):
+    graphql.append({'data': {'r0': catalogue_node('plugin.video.one', ['1.0.0', '1.1.0'], zips=['1.0.0'])}})
+    graphql.append({'data': {'r0': {'object': {'text': '<addon id="plugin.video.one"/>'}}}})
+
+    queued = []
+    details = github_graphql.kodi_repos([('alelec', 'plugin.video.one')],
+                                        build_asset=lambda full_name, vers: queued.append((full_name, vers)))
+    assert queued == [('alelec/plugin.video.one', '1.1.0')]
+    assert details['plugin.video.one'].newest_version == '1.0.0'
+
+def test_null_repository_keeps_previous_details(graphql):
+    graphql.append({
+        'data': {'r0': None, 'r1': None},
+        'errors': [{'type': 'NOT_FOUND', 'path': ['r1'], 'message': "Could not resolve to a Repository"}],
+    })
+    previous = catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two'))
+    details = github_graphql.kodi_repos([('alelec', 'plugin.video.one'), ('alelec', 'plugin.video.two')], previous)
+    # Only the one github says doesn't exist is dropped
+    assert list(details) == ['plugin.video.one']
+    assert details['plugin.video.one'] is previous['plugin.video.one']
+
+def test_failed_query_keeps_previous_details(graphql):
+    graphql.append({'data': None, 'errors': [{'message': "Something went wrong"}]})
+    previous = catalogue(repo_detail('plugin.video.one'))
+    failed = []
+    details = github_graphql.batch_details(github3.GitHub(), [('alelec', 'plugin.video.one'),
+                                                              ('alelec', 'plugin.video.two')],
+                                           previous, failed=failed)
+    assert details == {}
+    assert failed == ['plugin.video.one', 'plugin.video.two']
+
+def test_rate_limited_query_is_unfinished(graphql, monkeypatch):
+    def post_json(session, url, payload):
+        raise github_api.RateLimitExhausted("no budget")
+    monkeypatch.setattr(github_api, 'post_json', post_json)
+    unfinished = []
+    previous = catalogue(repo_detail('plugin.video.one'))
+    details = github_graphql.kodi_repos([('alelec', 'plugin.video.one')], previous, unfinished=unfinished)
+    assert details['plugin.video.one'] is previous['plugin.video.one']
+    assert unfinished == ['plugin.video.one']
@@ -0,0 +1,352 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import os
+import time
+import stat
+import zipfile
+import gzip
+import hashlib
+import pytest
+import config
+import requests
+import repo_store
+import github_api
+import github_handler
+from github3 import GitHubError
+from conftest import repo_detail, catalogue
+
+class Tag(object):
+    def __init__(self, vers, sha=None):
+        self.name = 'v' + vers
+        self.commit = {'sha': sha or '%040d' % len(vers)}
+
+class Asset(object):
+    def __init__(self, url):
+        self.url = url
+
+    def to_json(self):
+        return {'browser_download_url': self.url}
+
+class Owner(object):
+    login = 'alelec'
+
+class Repo(object):
+    description = 'An addon'
+    homepage = ''
+    owner = Owner()
+    pushed_at = None
+
+    def __init__(self, name):
+        self.name = name
+        self.full_name = 'alelec/' + name
+
+@pytest.fixture
+def github(monkeypatch):
+    """
+    {repo: json or exception} github answers each repos request with
+    """
+    answers = {}
+
+    class GitHub(object):
+        _session = None
+
+        def _build_url(self, *parts):
+            return '/'.join(parts)
+
+    def get_json(session, url, params=None):
+        answer = answers[url.split('/')[-1]]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer, None
+
+    monkeypatch.setattr(github_api, 'login', GitHub)
+    monkeypatch.setattr(github_api, 'get_json', get_json)
+    monkeypatch.setattr(github_handler, 'Repository', lambda json, _github: Repo(json['name']))
+    return answers
+
+def test_failed_repo_lookups_are_unfinished(github):
+    class Response(object):
+        status_code = 502
+        def json(self):
+            return {'message': 'Bad Gateway'}
+
+    github['plugin.video.one'] = {'name': 'plugin.video.one'}
+    github['plugin.video.two'] = GitHubError(Response())
+    github['plugin.video.three'] = None
+    unfinished = []
+    repos = github_handler.repositories(unfinished=unfinished)
+    assert [repo.name for repo in repos] == ['plugin.video.one']
+    # Not found is gone for good, anything else keeps its previous details
+    assert unfinished == ['plugin.video.two']
+
+def test_rate_limited_repo_lookups_are_unfinished(github):
+    for name in ('plugin.video.one', 'plugin.video.two', 'plugin.video.three'):
+        github[name] = github_api.RateLimitExhausted("no budget")
+    unfinished = []
+    assert github_handler.repositories(unfinished=unfinished) == []
+    assert sorted(unfinished) == ['plugin.video.one', 'plugin.video.three', 'plugin.video.two']
+
+def test_failed_crawls_keep_previous_details(monkeypatch):
+    def repo_detail_or_fail(repo, previous=None, build_asset=None):
+        if repo.name == 'plugin.video.two':
+            raise github_api.RateLimitExhausted("no budget")
+        if repo.name == 'plugin.video.three':
+            raise ValueError("bad addon.xml")
+        return repo_detail(repo.name, ['1.0.0', '1.1.0'])
+    monkeypatch.setattr(github_handler, 'repo_detail', repo_detail_or_fail)
+
+    previous = catalogue(*[repo_detail(name) for name in ('plugin.video.one', 'plugin.video.two', 'plugin.video.three')])
+    unfinished = []
+    details = github_handler.kodi_repos([Repo(name) for name in previous], previous, unfinished=unfinished)
+    assert list(details) == ['plugin.video.one', 'plugin.video.three', 'plugin.video.two']
+    assert details['plugin.video.one'].newest_version == '1.1.0'
+    assert details['plugin.video.two'] is previous['plugin.video.two']
+    assert details['plugin.video.three'] is previous['plugin.video.three']
+    assert unfinished == ['plugin.video.two']
+
+def test_unfinished_repos_keep_previous_details(store):
+    previous = catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two'))
+    github_handler.publish_details(store, previous)
+
+    details = catalogue(repo_detail('plugin.video.one', ['1.0.0', '1.1.0']))
+    github_handler.complete_refresh(store, previous, details, ['plugin.video.two'], ['plugin.video.one'])
+
+    published = repo_store.load_details(store)
+    assert list(published) == ['plugin.video.one', 'plugin.video.two']
+    assert published['plugin.video.one'].newest_version == '1.1.0'
+    assert published['plugin.video.two'].newest_version == '1.0.0'
+    assert store.smembers(config.redis_keys.crawl_resume) == {b'plugin.video.two'}
+
+def test_artifacts_synced_after_publish(store):
+    synced = []
+    def sync(redisStore, details):
+        synced.append((repo_store.load_details(redisStore)['plugin.video.one'].newest_version, list(details)))
+
+    previous = catalogue(repo_detail('plugin.video.one'))
+    github_handler.publish_details(store, previous)
+    details = catalogue(repo_detail('plugin.video.one', ['1.0.0', '1.1.0']))
+    github_handler.complete_refresh(store, previous, details, [], ['plugin.video.one'], sync=sync)
+    # Still synced when nothing changed, for zips that failed to download or were asked for since
+    github_handler.complete_refresh(store, details, details, [], [], sync=sync)
+    assert synced == [('1.1.0', ['plugin.video.one'])] * 2
+
+@pytest.fixture
+def tags(monkeypatch):
+    """
+    {vers: Tag} repo_tags finds, anything past that fails the test
+    """
+    tags = {}
+    def crawled(*args, **kwargs):
+        raise AssertionError("crawled an unchanged repo")
+    monkeypatch.setattr(github_handler, 'repo_tags', lambda repo: tags)
+    monkeypatch.setattr(github_handler, 'repo_releases', crawled)
+    return tags
+
+def test_unchanged_repo_isnt_crawled(tags):
+    previous = repo_detail('plugin.video.one', ['1.0.0', '1.1.0'])
+    for vers in previous.tagnames:
+        tags[vers] = Tag(vers, previous.newest_tag_sha)
+
+    repo = Repo('plugin.video.one')
+    assert github_handler.repo_detail(repo, previous) is previous
+    assert previous.repo is repo
+
+def test_changed_repo_is_crawled():
+    previous = repo_detail('plugin.video.one', ['1.0.0', '1.1.0'])
+    repo = Repo('plugin.video.one')
+    assert github_handler.repo_unchanged(repo, previous, previous.tagnames, previous.newest_tag_sha)
+
+    assert not github_handler.repo_unchanged(repo, None, previous.tagnames, previous.newest_tag_sha)
+    assert not github_handler.repo_unchanged(repo, previous, {'1.0.0': 'v1.0.0'}, previous.newest_tag_sha)
+    # A tag moved to another commit
+    assert not github_handler.repo_unchanged(repo, previous, previous.tagnames, '%040x' % 99)
+
+    repo.description = 'Changed'
+    assert not github_handler.repo_unchanged(repo, previous, previous.tagnames, previous.newest_tag_sha)
+
+    # A version still waiting for its zip
+    repo = Repo('plugin.video.one')
+    previous.downloads['1.1.0'] = None
+    assert not github_handler.repo_unchanged(repo, previous, previous.tagnames, previous.newest_tag_sha)
+
+def test_static_addons_xml(monkeypatch, tmp_path):
+    outdir = tmp_path / 'static'
+    monkeypatch.setattr(config, 'static_output_dir', str(outdir))
+    assert not github_handler.static_addons_xml_current()
+
+    xml, md5 = github_handler.addons_xml(catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two')))
+    github_handler.write_static_addons_xml((xml, md5))
+    assert github_handler.static_addons_xml_current()
+
+    assert (outdir / 'addons.xml').read_bytes() == xml.encode()
+    assert gzip.decompress((outdir / 'addons.xml.gz').read_bytes()) == xml.encode()
+    assert (outdir / 'addons.xml.md5').read_text() == md5 == hashlib.md5(xml.encode()).hexdigest()
+    # One mtime for nginx's validators, nothing left behind
+    mtimes = {os.stat(str(path)).st_mtime for path in outdir.iterdir()}
+    assert len(mtimes) == 1
+    assert not [path for path in outdir.iterdir() if path.name.startswith('.tmp-')]
+
+def test_failed_static_write_keeps_previous(tmp_path):
+    path = tmp_path / 'addons.xml'
+    github_handler.write_atomic(str(path), b'<addons/>', 1000)
+    with pytest.raises(TypeError):
+        github_handler.write_atomic(str(path), u'not bytes', 2000)
+    assert path.read_bytes() == b'<addons/>'
+    assert os.listdir(str(tmp_path)) == ['addons.xml']
+
+def write_zipball(path, entries):
+    with zipfile.ZipFile(path, 'w') as zout:
+        for name, data in entries:
+            info = zipfile.ZipInfo('alelec-plugin.video.one-abc123/' + name)
+            if isinstance(data, tuple):
+                # (target,) is a symlink
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                data = data[0]
+            else:
+                info.external_attr = (stat.S_IFREG | 0o644) << 16
+            zout.writestr(info, data)
+
+def test_repackage_zip(tmp_path):
+    src = str(tmp_path / 'zipball.zip')
+    dest = str(tmp_path / 'plugin.video.one.zip')
+    write_zipball(src, [
+        ('addon.xml', b'<addon/>'),
+        ('resources/icon.png', b'icon'),
+        ('icon.png', ('resources/icon.png',)),
+        ('fanart.jpg', ('../../etc/passwd',)),
+        ('dangling.txt', ('missing.txt',)),
+        ('.gitignore', b'*.pyc'),
+    ])
+    github_handler.repackage_zip(src, dest, 'plugin.video.one')
+
+    # Top directory renamed, dot files left out and symlinks resolved within the zip or dropped
+    with zipfile.ZipFile(dest) as zin:
+        assert sorted(zin.namelist()) == ['plugin.video.one/addon.xml', 'plugin.video.one/icon.png',
+                                          'plugin.video.one/resources/icon.png']
+        assert zin.read('plugin.video.one/icon.png') == b'icon'
+        assert not stat.S_ISLNK(zin.getinfo('plugin.video.one/icon.png').external_attr >> 16)
+
+def test_cached_build_reused(monkeypatch):
+    def download(url, path=''):
+        raise AssertionError("downloaded a cached build")
+    monkeypatch.setattr(github_handler, 'download', download)
+    tag = Tag('1.0.0')
+    zip_path = os.path.join(config.build_cache_dir, tag.commit['sha'], 'plugin.video.one.zip')
+    os.makedirs(os.path.dirname(zip_path))
+    with open(zip_path, 'wb') as outfile:
+        outfile.write(b'zip')
+    os.utime(zip_path, (1000, 1000))
+
+    assert github_handler.build_addon_zip('plugin.video.one', tag) == zip_path
+    # Marked recently used
+    assert os.stat(zip_path).st_mtime > 1000
+
+def test_build_cache_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'build_cache_max_bytes', 250)
+    cache_dir = tmp_path / 'build_cache'
+    paths = []
+    for age, sha in enumerate(['c', 'b', 'a']):
+        (cache_dir / sha).mkdir(parents=True)
+        path = cache_dir / sha / 'plugin.video.one.zip'
+        path.write_bytes(b'x' * 100)
+        os.utime(str(path), (1000 - age, 1000 - age))
+        paths.append(path)
+    (cache_dir / '.build-tmp').mkdir()
+    (cache_dir / '.build-tmp' / 'zipball.zip').write_bytes(b'x' * 1000)
+
+    # The oldest build is the one just built, so the next oldest goes
+    github_handler.evict_build_cache(str(cache_dir), str(paths[2]))
+    assert [path.exists() for path in paths] == [True, False, True]
+    assert not (cache_dir / 'b').exists()
+    assert (cache_dir / '.build-tmp' / 'zipball.zip').exists()
+
+def test_missing_zips_queued(monkeypatch):
+    releases = {'1.0.0': Asset('https://example.com/1.0.0.zip'), '1.1.0': None}
+    def upload(*args):
+        raise AssertionError("built a zip during the refresh")
+    monkeypatch.setattr(github_handler, 'release_download_asset', lambda repo, release: release)
+    monkeypatch.setattr(github_handler, 'locked_upload_release_asset', upload)
+
+    queued = []
+    downloads = github_handler.repo_downloads(Repo('plugin.video.one'), releases, {},
+                                              build_asset=lambda full_name, vers: queued.append((full_name, vers)))
+    assert downloads == {'1.0.0': 'https://example.com/1.0.0.zip', '1.1.0': None}
+    assert queued == [('alelec/plugin.video.one', '1.1.0')]
+
+def test_no_downloads_yet():
+    tags = {'1.0.0': Tag('1.0.0'), '1.1.0': Tag('1.1.0')}
+    assert github_handler.new_repo_detail(Repo('plugin.video.one'), tags, {}, {'1.0.0': None, '1.1.0': None}) is None
+
+    # Only the versions with a download are advertised
+    repo_det = github_handler.new_repo_detail(Repo('plugin.video.one'), tags, {},
+                                              {'1.0.0': 'https://example.com/1.0.0.zip', '1.1.0': None})
+    assert repo_det.newest_version == '1.0.0'
+    assert repo_det.newest_tagname == 'v1.0.0'
+    assert repo_det.versions == ['1.0.0']
+
+def test_addon_without_download_is_left_out(monkeypatch):
+    monkeypatch.setattr(github_handler, 'repo_detail', lambda repo, previous=None, build_asset=None: previous)
+    previous = catalogue(repo_detail('plugin.video.one'))
+    details = github_handler.kodi_repos([Repo('plugin.video.one'), Repo('plugin.video.two')], previous)
+    assert list(details) == ['plugin.video.one']
+
+def baseline_addons_xml(addon_xmls):
+    """
+    addons.xml as it was built from whole addon.xml files before fragments were stored
+    """
+    _addons_xml = u"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>\n<addons>\n"
+    for xml in addon_xmls:
+        xml = xml.rstrip()
+        if isinstance(xml, bytes):
+            xml = xml.decode()
+        if xml.startswith('<?xml'):
+            xml = xml[xml.index('\n'):]
+        _addons_xml += xml + u"\n\n"
+    return _addons_xml.strip() + u"\n</addons>\n"
+
+@pytest.mark.parametrize('addon_xmls', [
+    [],
+    [b'<?xml version="1.0" encoding="UTF-8"?>\n<addon id="plugin.video.one" version="1.0.0">\n</addon>\n'],
+    [b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n<addon id="plugin.video.one"/>\r\n',
+     u'<addon id="plugin.video.two" name="Tv\u00e5"/>\n\n\n',
+     b'<?xml version="1.0"?>\n\n  <addon id="plugin.video.three">\n    <summary>\xc3\xa9</summary>\n  </addon>'],
+])
+def test_addons_xml_matches_baseline(addon_xmls):
+    details = catalogue()
+    for i, xml in enumerate(addon_xmls):
+        repo_det = repo_detail('plugin.video.%d' % i)
+        repo_det.addon_xml_fragment = repo_store.addon_xml_fragment(xml)
+        details[repo_det.reponame] = repo_det
+
+    xml, md5 = github_handler.addons_xml(details)
+    expected = baseline_addons_xml(addon_xmls)
+    assert xml.encode() == expected.encode()
+    assert md5 == hashlib.md5(expected.encode()).hexdigest()
+
+def test_publish_hands_changed_keys_to_purge(store, monkeypatch):
+    monkeypatch.setattr(config, 'purge_hook', lambda keys: None)
+    def sleep(seconds):
+        raise AssertionError("publish_details slept for %s" % seconds)
+    monkeypatch.setattr(time, 'sleep', sleep)
+
+    purged = []
+    purge = lambda keys, generation: purged.append((keys, generation))
+    previous = catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two'))
+    github_handler.publish_details(store, previous, purge=purge)
+    details = catalogue(repo_detail('plugin.video.one', ['1.0.0', '1.1.0']), repo_detail('plugin.video.two'))
+    github_handler.publish_details(store, details, previous, purge=purge)
+    github_handler.publish_details(store, details, details, purge=purge)
+
+    assert [generation for keys, generation in purged] == [1, 2]
+    assert purged[1][0] == ['addon/plugin.video.one', 'version/plugin.video.one/1.1.0', 'addons-xml', 'home']
+
+def test_download_times_out(monkeypatch, tmp_path):
+    def get(url, timeout=None, **kwargs):
+        assert timeout == (5, 30)
+        raise requests.Timeout("read timed out")
+    monkeypatch.setattr(requests, 'get', get)
+    monkeypatch.setattr(config, 'github_timeout', [5, 30])
+    with pytest.raises(requests.Timeout):
+        github_handler.download('https://api.github.com/zipball/v1.0.0', str(tmp_path / 'zipball.zip'))
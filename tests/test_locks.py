@@ -0,0 +1,109 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import time
+import pytest
+import locks
+import config
+
+def test_lease_is_exclusive(store):
+    first = locks.Lease('lease', 60, store)
+    second = locks.Lease('lease', 60, store)
+    assert first.acquire(heartbeat=False)
+    assert not second.acquire(heartbeat=False)
+
+    first.release()
+    assert second.acquire(heartbeat=False)
+    second.release()
+    assert not store.exists('lease')
+
+def test_release_leaves_a_lease_taken_over(store):
+    lease = locks.Lease('lease', 60, store)
+    assert lease.acquire(heartbeat=False)
+    # Expired and taken by another process
+    store.set('lease', b'other')
+    assert not lease.renew()
+    lease.release()
+    assert store.get('lease') == b'other'
+
+def test_adopt_carries_on_a_lease(store):
+    lease = locks.Lease('lease', 60, store)
+    assert lease.acquire(heartbeat=False)
+
+    adopted = locks.Lease('lease', 60, store, token=lease.token)
+    assert adopted.adopt()
+    adopted.release()
+    assert not store.exists('lease')
+    assert not locks.Lease('lease', 60, store, token=lease.token).adopt()
+
+def test_held_gives_none_while_held_elsewhere(store):
+    with locks.held('lease', 60, store) as lease:
+        assert lease is not None
+        with locks.held('lease', 60, store) as other:
+            assert other is None
+    assert not store.exists('lease')
+
+def test_heartbeat_keeps_lease(store):
+    lease = locks.Lease('lease', 0.3, store)
+    assert lease.acquire()
+    time.sleep(0.5)
+    assert store.get('lease') == lease.token
+    lease.release()
+    assert not lease.lost
+    assert not store.exists('lease')
+
+def test_heartbeat_stops_after_max_hold(store):
+    lease = locks.Lease('lease', 0.3, store, max_hold=0.2)
+    assert lease.acquire()
+    time.sleep(0.8)
+    # A holder stuck that long loses the lease to the next refresh
+    assert lease.lost
+    assert not store.exists('lease')
+    assert locks.Lease('lease', 60, store).acquire(heartbeat=False)
+    lease.release()
+    assert store.exists('lease')
+
+@pytest.fixture
+def tasks():
+    return pytest.importorskip('kodi_repo_task')
+
+@pytest.fixture
+def queued(tasks, monkeypatch):
+    """
+    Full refreshes queued through celery
+    """
+    queued = []
+    monkeypatch.setattr(tasks.periodic_update_kodi_repos_details, 'delay', lambda: queued.append(1))
+    return queued
+
+def test_queued_refreshes_coalesce(tasks, queued):
+    tasks.request_refresh()
+    tasks.request_refresh()
+    assert len(queued) == 1
+
+def test_refresh_during_refresh_runs_once_after(tasks, queued, store):
+    with locks.held(config.redis_keys.refresh_lease, store=store) as lease:
+        tasks.periodic_update_kodi_repos_details()
+        tasks.periodic_update_kodi_repos_details()
+    assert store.get(config.redis_keys.refresh_requested) == b'1'
+    assert queued == []
+
+    tasks.refresh_finished()
+    tasks.refresh_finished()
+    assert len(queued) == 1
+
+def test_webhook_refresh_waits_for_lease(tasks, store, monkeypatch):
+    import github_handler
+    refreshed = []
+    monkeypatch.setattr(github_handler, 'update_kodi_repo_redis',
+                        lambda repo_name, build_asset=None, purge=None, sync=None: refreshed.append(repo_name))
+    store.zadd(config.redis_keys.pending_refresh, time.time() - 1, 'plugin.video.one')
+
+    with locks.held(config.redis_keys.refresh_lease, store=store):
+        tasks.process_pending_refreshes()
+    assert refreshed == []
+
+    tasks.process_pending_refreshes()
+    assert refreshed == ['plugin.video.one']
+    assert not store.zcard(config.redis_keys.pending_refresh)
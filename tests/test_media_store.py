@@ -0,0 +1,70 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import io
+import os
+import sys
+import pytest
+import config
+import media_store
+
+@pytest.fixture(autouse=True)
+def media_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'media_store_dir', str(tmp_path / 'media'))
+    return tmp_path / 'media'
+
+def test_sources():
+    assert media_store.sources(b'<addon id="plugin.video.one"/>') == {
+        'icon': 'icon.png', 'fanart': 'fanart.jpg', 'changelog': 'changelog.txt'}
+    assert media_store.sources(b'''<addon id="plugin.video.one">
+        <extension point="xbmc.addon.metadata">
+            <assets><icon>resources/icon.png</icon><fanart></fanart></assets>
+        </extension>
+    </addon>''') == {'icon': 'resources/icon.png', 'changelog': 'changelog.txt'}
+
+def test_artwork_follows_newest_version(media_dir):
+    media_store.store('plugin.video.one', '1.1.0', {'icon': b'new icon', 'changelog': b'1.1.0 changes'})
+    media_store.store('plugin.video.one', '1.0.0', {'icon': b'old icon', 'fanart': b'old fanart',
+                                                    'changelog': b'1.0.0 changes'})
+
+    addon_dir = media_dir / 'plugin.video.one'
+    assert (addon_dir / 'icon.png').read_bytes() == b'new icon'
+    assert not (addon_dir / 'fanart.jpg').exists()
+    assert (addon_dir / 'changelog-1.0.0.txt').read_bytes() == b'1.0.0 changes'
+    assert (addon_dir / 'changelog-1.1.0.txt').read_bytes() == b'1.1.0 changes'
+    assert media_store.extracted('plugin.video.one', '1.0.0')
+    assert not media_store.extracted('plugin.video.one', '1.2.0')
+
+    # Dropped by a newer version
+    media_store.store('plugin.video.one', '1.2.0', {'fanart': b'fanart'})
+    assert not os.path.lexists(str(addon_dir / 'icon.png'))
+    assert (addon_dir / 'fanart.jpg').read_bytes() == b'fanart'
+
+def test_images_scaled_down(monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    monkeypatch.setattr(config, 'media_icon_size', [64, 64])
+    source = io.BytesIO()
+    Image.new('RGBA', (512, 256)).save(source, 'PNG')
+
+    data = media_store.thumbnail(source.getvalue(), config.media_icon_size, 'PNG')
+    assert Image.open(io.BytesIO(data)).size == (64, 32)
+    # Already small enough
+    assert media_store.thumbnail(data, config.media_icon_size, 'PNG') == data
+    assert media_store.thumbnail(b'not an image', config.media_icon_size, 'PNG') == b'not an image'
+
+def test_served_path(media_dir, tmp_path):
+    media_store.store('plugin.video.one', '1.0.0', {'icon': b'icon'})
+    (tmp_path / 'secret.txt').write_bytes(b'secret')
+    assert media_store.served_path('plugin.video.one', 'icon.png') == media_store.media_path('plugin.video.one', 'icon.png')
+    assert media_store.served_path('plugin.video.one', 'fanart.jpg') is None
+    assert media_store.served_path('..', 'secret.txt') is None
+    assert media_store.served_path('plugin.video.one', '../../secret.txt') is None
+    assert media_store.served_path('plugin.video.one', '') is None
+
+def test_without_pillow_warns_once(monkeypatch, caplog):
+    monkeypatch.setitem(sys.modules, 'PIL', None)
+    monkeypatch.setattr(media_store, '_warned_no_pillow', False)
+    assert media_store.thumbnail(b'not scaled', (256, 256), 'PNG') == b'not scaled'
+    assert media_store.thumbnail(b'not scaled', (256, 256), 'PNG') == b'not scaled'
+    assert len([record for record in caplog.records if 'Pillow' in record.getMessage()]) == 1
@@ -0,0 +1,53 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import pytest
+import metrics
+
+@pytest.fixture(autouse=True)
+def flushed(store):
+    """
+    Nothing buffered from earlier tests
+    """
+    metrics.flush(force=True)
+    store.flushall()
+
+def test_series():
+    assert metrics.series('kodi_repo_refresh_total', {}) == 'kodi_repo_refresh_total'
+    assert (metrics.series('kodi_repo_request_seconds_bucket', {'route': '/', 'le': '0.1', 'status': 200}) ==
+            'kodi_repo_request_seconds_bucket{route="/",status="200",le="0.1"}')
+    assert metrics.series('x', {'path': 'a"b\\c'}) == 'x{path="a\\"b\\\\c"}'
+
+def test_metrics_page(store):
+    kodi_repo_app = pytest.importorskip('kodi_repo_app')
+    app = kodi_repo_app.app.test_client()
+
+    @metrics.refresh('refresh')
+    def refresh():
+        with metrics.stage('publish'):
+            pass
+    refresh()
+    metrics.set_gauge('kodi_repo_github_rate_limit_remaining', 4999, resource='core')
+    app.get('/favicon.ico')
+
+    response = app.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    lines = response.data.decode().splitlines()
+    assert '# TYPE kodi_repo_refresh_total counter' in lines
+    assert 'kodi_repo_refresh_total{kind="refresh",outcome="ok"} 1.0' in lines
+    assert 'kodi_repo_refresh_stage_seconds_count{stage="publish"} 1.0' in lines
+    assert 'kodi_repo_refresh_stage_seconds_bucket{stage="publish",le="+Inf"} 1.0' in lines
+    assert 'kodi_repo_github_rate_limit_remaining{resource="core"} 4999.0' in lines
+    assert 'kodi_repo_request_seconds_count{route="/favicon.<ext>",status="200"} 1.0' in lines
+    # Families with nothing recorded are left out
+    assert '# TYPE kodi_repo_cache_lookups_total counter' not in lines
+
+def test_failed_refresh_counted(store):
+    @metrics.refresh('repo_refresh')
+    def refresh():
+        raise ValueError("bad addon.xml")
+    with pytest.raises(ValueError):
+        refresh()
+    assert 'kodi_repo_refresh_total{kind="repo_refresh",outcome="error"} 1.0' in metrics.render(store).splitlines()
@@ -0,0 +1,97 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import pytest
+import config
+import repo_store
+import github_handler
+import refresh_shards
+from conftest import REPOSITORIES, repo_detail, catalogue
+
+@pytest.fixture
+def github(monkeypatch):
+    """
+    {name: RepoDetail} the crawl finds, repos missing from it have nothing downloadable yet
+    """
+    found = {name: repo_detail(name, ['1.0.0', '1.1.0']) for name in REPOSITORIES}
+
+    def fetch_details(names=None, previous=None, build_asset=None, resume=(), unfinished=None):
+        return dict((name, found[name]) for name in names if name in found)
+
+    monkeypatch.setattr(config, 'refresh_shard_size', 2)
+    monkeypatch.setattr(github_handler, 'fetch_details', fetch_details)
+    return found
+
+def published_versions(store):
+    return dict((name, repo_det.newest_version) for name, repo_det in repo_store.load_details(store).items())
+
+def test_all_shards_published_together(store, github):
+    run_id, shards = refresh_shards.start(store)
+    names = sorted(REPOSITORIES)
+    assert shards == [names[:2], names[2:]]
+    assert refresh_shards.start(store) is None
+
+    assert not refresh_shards.crawl(store, run_id, shards[1])
+    assert not repo_store.is_published(store)
+    assert refresh_shards.crawl(store, run_id, shards[0])
+
+    assert refresh_shards.finish(store, run_id)
+    assert published_versions(store) == dict((name, '1.1.0') for name in REPOSITORIES)
+    assert not store.exists(config.redis_keys.refresh_lease)
+    assert not store.smembers(config.redis_keys.crawl_resume)
+    # Only the marker that stops it being published twice is left
+    assert store.keys(refresh_shards.run_key(run_id, '*')) == [refresh_shards.run_key(run_id, 'finished').encode()]
+    assert not refresh_shards.finish(store, run_id)
+
+def test_deadline_publishes_finished_shards(store, github):
+    previous = catalogue(*[repo_detail(name) for name in REPOSITORIES])
+    github_handler.publish_details(store, previous)
+
+    run_id, shards = refresh_shards.start(store)
+    refresh_shards.crawl(store, run_id, shards[0])
+    assert refresh_shards.finish(store, run_id)
+
+    assert shards[1] == ['plugin.video.two']
+    assert published_versions(store) == {'plugin.video.one': '1.1.0', 'plugin.video.three': '1.1.0',
+                                         'plugin.video.two': '1.0.0'}
+    assert store.smembers(config.redis_keys.crawl_resume) == {b'plugin.video.two'}
+
+    # The straggler is dropped rather than added to a published run
+    assert not refresh_shards.crawl(store, run_id, shards[1])
+    assert published_versions(store)['plugin.video.two'] == '1.0.0'
+
+    # and goes first next time
+    run_id, shards = refresh_shards.start(store)
+    assert shards[0][0] == 'plugin.video.two'
+
+def test_shard_finishing_after_publish_is_dropped(store, github, monkeypatch):
+    run_id, shards = refresh_shards.start(store)
+    fetch_details = github_handler.fetch_details
+    def published_while_crawling(names=None, *args, **kwargs):
+        assert refresh_shards.finish(store, run_id)
+        return fetch_details(names, *args, **kwargs)
+    monkeypatch.setattr(github_handler, 'fetch_details', published_while_crawling)
+
+    assert not refresh_shards.crawl(store, run_id, shards[0])
+    # Nothing left behind without an expiry
+    assert store.keys(refresh_shards.run_key(run_id, '*')) == [refresh_shards.run_key(run_id, 'finished').encode()]
+
+def test_addon_without_download_isnt_a_straggler(store, github):
+    del github['plugin.video.three']
+    run_id, shards = refresh_shards.start(store)
+    for names in shards:
+        refresh_shards.crawl(store, run_id, names)
+    assert refresh_shards.finish(store, run_id)
+
+    assert sorted(published_versions(store)) == ['plugin.video.one', 'plugin.video.two']
+    assert not store.smembers(config.redis_keys.crawl_resume)
+
+def test_expired_lease_isnt_published(store, github):
+    run_id, shards = refresh_shards.start(store)
+    for names in shards:
+        refresh_shards.crawl(store, run_id, names)
+    store.delete(config.redis_keys.refresh_lease)
+
+    assert not refresh_shards.finish(store, run_id)
+    assert not repo_store.is_published(store)
@@ -0,0 +1,116 @@
+###############################################################
+# -*- coding: utf-8 -*-
+__author__ = "Andrew Leech"
+
+import msgpack
+import pytest
+import jsonpickle
+import config
+import repo_store
+from repo_store import RepoDetail
+from conftest import repo_detail, catalogue
+
+def test_record_round_trip():
+    repo_det = repo_detail('plugin.video.one', ['1.0.0', '1.1.0', '2.0.0-beta'])
+    data = repo_store.encode_repo(repo_det)
+    assert data.startswith(repo_store.MAGIC)
+
+    decoded = repo_store.decode_repo(data)
+    assert decoded.to_record() == repo_det.to_record()
+    assert decoded.downloads == repo_det.downloads
+    assert decoded.repo is None
+
+def test_details_round_trip():
+    details = catalogue(repo_detail('plugin.video.two'), repo_detail('plugin.video.one'))
+    decoded = repo_store.decode_details(repo_store.encode_details(details))
+    assert list(decoded) == ['plugin.video.two', 'plugin.video.one']
+
+def test_newer_schema_rejected():
+    data = repo_store.MAGIC + bytes([repo_store.SCHEMA_VERSION + 1]) + msgpack.packb([], use_bin_type=True)
+    with pytest.raises(ValueError):
+        repo_store.decode_repo(data)
+
+def test_legacy_jsonpickle_details():
+    details = catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two', ['0.1.0', '0.2.0']))
+    data = jsonpickle.encode(details).encode()
+
+    decoded = repo_store.decode_details(data)
+    assert list(decoded) == ['plugin.video.one', 'plugin.video.two']
+    assert decoded['plugin.video.two'].downloads == details['plugin.video.two'].downloads
+    assert decoded['plugin.video.two'].newest_version == '0.2.0'
+
+def test_publish_and_load(store):
+    assert not repo_store.is_published(store)
+    assert repo_store.load_details(store) is None
+
+    details = catalogue(repo_detail('plugin.video.two'), repo_detail('plugin.video.one'))
+    assert repo_store.publish(store, details, (u'<addons/>', 'md5')) == 1
+    assert repo_store.publish(store, details, (u'<addons/>', 'md5')) == 2
+
+    assert repo_store.is_published(store)
+    assert list(repo_store.load_details(store)) == ['plugin.video.two', 'plugin.video.one']
+    assert repo_store.load_addon(store, 'plugin.video.one').to_record() == details['plugin.video.one'].to_record()
+    assert repo_store.load_addon(store, 'plugin.video.missing') is None
+    assert repo_store.load_addons_xml(store) == (u'<addons/>', 'md5')
+
+def test_removed_addon_unpublished(store):
+    repo_store.publish(store, catalogue(repo_detail('plugin.video.one'), repo_detail('plugin.video.two')),
+                       (u'<addons/>', 'md5'))
+    repo_store.publish(store, catalogue(repo_detail('plugin.video.two')), (u'<addons/>', 'md5'))
+    assert repo_store.load_addon(store, 'plugin.video.one') is None
+    assert list(repo_store.load_details(store)) == ['plugin.video.two']
+
+def test_legacy_blob_served_until_republished(store):
+    details = catalogue(repo_detail('plugin.video.one'))
+    store.set(config.redis_keys.details, jsonpickle.encode(details))
+    assert repo_store.load_addon(store, 'plugin.video.one').reponame == 'plugin.video.one'
+
+    repo_store.publish(store, catalogue(repo_detail('plugin.video.two')), (u'<addons/>', 'md5'))
+    assert repo_store.load_addon(store, 'plugin.video.one') is None
+    assert not store.exists(config.redis_keys.details)
+
+def test_version_index():
+    downloads = {'1.10.0': 'url', '1.9.0': 'url', '2.0.0-beta': 'url', '3.0.0': None, 'nightly': 'url'}
+    assert repo_store.version_index(downloads) == (['1.9.0', '1.10.0', '2.0.0-beta'], '1.10.0', '2.0.0-beta')
+    assert repo_store.version_index({'0.1.0-alpha': 'url'}) == (['0.1.0-alpha'], None, '0.1.0-alpha')
+
+    repo_det = repo_detail('plugin.video.one', ['1.0.0', '2.0.0-beta'])
+    assert repo_det.latest_version == '1.0.0'
+    repo_det.latest_stable = None
+    assert repo_det.latest_version == '2.0.0-beta'
+
+def test_schema_1_record_gets_version_index():
+    record = repo_detail('plugin.video.one', ['1.0.0', '1.2.0']).to_record()
+    record = record[:RepoDetail.FIELDS.index('versions')]
+    data = repo_store.MAGIC + bytes([1]) + msgpack.packb(record, use_bin_type=True)
+
+    repo_det = repo_store.decode_repo(data)
+    assert repo_det.versions == ['1.0.0', '1.2.0']
+    assert repo_det.latest_version == '1.2.0'
+
+def test_addon_xml_not_stored():
+    repo_det = repo_detail('plugin.video.one')
+    repo_det.addon_xml = b'<?xml version="1.0"?>\n<addon id="plugin.video.one"/>'
+    record = repo_det.to_record()
+    assert record[RepoDetail.FIELDS.index('addon_xml')] is None
+    assert repo_store.decode_repo(repo_store.encode_repo(repo_det)).addon_xml_fragment == repo_det.addon_xml_fragment
+
+def test_schema_3_record_gets_fragment():
+    record = repo_detail('plugin.video.one').to_record()
+    record[RepoDetail.FIELDS.index('addon_xml')] = b'<?xml version="1.0"?>\n<addon id="plugin.video.one"/>\n'
+    record[RepoDetail.FIELDS.index('addon_xml_fragment')] = None
+    data = repo_store.MAGIC + bytes([3]) + msgpack.packb(record, use_bin_type=True)
+
+    repo_det = repo_store.decode_repo(data)
+    assert repo_det.addon_xml_fragment == '\n<addon id="plugin.video.one"/>'
+    assert repo_det.addon_xml is None
+
+def test_snapshot_round_trip():
+    details = catalogue(repo_detail('plugin.video.one'))
+    assert repo_store.load_snapshot() is None
+    repo_store.save_snapshot(7, details, (u'<addons/>', 'md5'))
+
+    generation, loaded, addons_xml = repo_store.load_snapshot()
+    assert generation == 7
+    assert loaded['plugin.video.one'].to_record() == details['plugin.video.one'].to_record()
+    assert addons_xml == (u'<addons/>', 'md5')